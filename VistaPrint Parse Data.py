@@ -1,19 +1,364 @@
 import csv
-from time import clock
+import time
+from time import perf_counter
+from time import process_time
 import datetime
-import pickle
+import zoneinfo
+import calendar
+import hashlib
+import shutil
 from collections import namedtuple
 from collections import OrderedDict
+from operator import itemgetter
+from array import array
 import sys
+import os
+import heapq
+import tempfile
+import multiprocessing
+import json
+import concurrent.futures
+import itertools
+import threading
+import queue
+import zlib
+import gzip
+import io
+import subprocess
+import functools
+import cProfile
+import resource
+import mmap
+import fcntl
+import contextlib
+import struct
+import numpy as np
 
 problem_name = 'vistaprint'
 delim = ';'
 
 missing_val = 'blank'
 missing_int = 9999999
+# value that stands for the values left out of a capped conversion table. It has
+# delim in it, which no value read from the download can, so it never collides
+# with a real value
+other_val = delim + 'other'
+
+sort_memory_mb = 512 # memory budget for each sorted run in external_sort
+sort_max_merge = 128 # most run files merged at once
+hash_memory_mb = 512 # memory budget for the hash table in compress_with_copies(mode='hash')
+hash_partitions = 16 # number of partition files the hash table spills to
+columnar_chunk_rows = 1000000 # rows buffered before the columnar writer appends to its column files
+convert_chunk_rows = 500000 # rows per chunk in convert_to_ints(engine='chunked')
+writer_batch_rows = 50000 # rows per writerows call in RowBatchWriter
+writer_buffer_bytes = 8 * 1024 * 1024 # file buffer size for RowBatchWriter
+read_block_bytes = 8 * 1024 * 1024 # bytes per read in ReadAheadFile
+read_ahead_blocks = 4 # blocks ReadAheadFile reads ahead of the parsing, 0 to read in the parsing thread
+tapad_time_zone = 'America/New_York' # Tapad time stamps are US Eastern time, EST or EDT
+timestamp_layouts = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f']
+timestamp_cache_size = 1000000 # seconds remembered by convert_to_timestamp
+cache_dir = 'tdata_cache' # dataset cache used by load_tdata
+cache_budget_mb = 20480 # disk budget for the dataset cache, least recently used entries are evicted
+cache_min_age_seconds = 600 # cache entries used more recently than this are never evicted
+show_progress = True # print a dot with the count every progress_every rows
+progress_every = 1000000
+profile_stages = set() # stage names to profile, or 'all'. See stage().
+profile_mode = 'cprofile' # 'cprofile' or 'sample'
+sample_interval = 0.005 # seconds between samples with profile_mode='sample'
+rss_sample_interval = 0.05 # seconds between the RSS samples that give a stage's peak RSS
+data_ext = '.csv' # extension of the intermediate files: '.csv', '.csv.gz', '.csv.zst' or '.csv.lz4'
+gzip_level = 1
+zstd_level = 3
+zstd_threads = -1 # compression threads for .zst files, -1 for one per core
+lz4_level = 0
+use_pigz = True # read and write .gz files through pigz when it is installed
+data_encoding = 'utf-8' # text encoding of the data files and conversion tables, whatever the locale
+count_backend = 'dict' # 'dict' or 'compact', how create_int_conversion_tables counts values, see AttrCounter
+count_top_k = None # keep only the top count_top_k values of each attribute (not the depvar), the rest become other_val
+count_sketch_factor = 4 # a capped AttrCounter tracks up to count_sketch_factor * count_top_k candidate values
+table_format = 'csv' # 'csv' or 'binary', which conversion tables load_int_conversion_tables reads, see ConversionTable
+table_memo_size = 1000000 # values a binary ConversionTable remembers the codes of
+event_chunk_rows = 1000000 # rows per chunk in aggregate_events
+event_names = ['impression', 'click', 'Vistaprint_Conversion_Pixel'] # events counted by aggregate_events
+report_time_zone = tapad_time_zone # time buckets are days and hours in this time zone, None for UTC
+cube_chunk_rows = 1000000 # rows per chunk in build_ctr_cube
+cube_min_support = 100 # least impressions + clicks of a value combination written by build_ctr_cube
+bitmap_chunk_rows = 1000000 # rows per chunk in build_bitmap_index
+bitmap_sparse_ratio = 32 # values in fewer than 1 in this many rows are stored as row gaps, see build_bitmap_index
+build_state_file = problem_name + '_build.json' # input fingerprints of the stages run by run_dag
+dag_processes = 4 # stages run_dag runs at once
+
+# Stage metrics. Each pipeline stage is wrapped with @stage(), which records
+# its wall and CPU time (including worker processes) and its peak RSS, the
+# largest of the process's RSS sampled every rss_sample_interval seconds while
+# it runs (worker processes not included). ru_maxrss, the peak of the whole
+# process so far, is recorded as process_peak_rss_mb. The stage reports its rows and files with record_stage, from which
+# rows/sec and bytes read/written are worked out. The results collect in
+# stage_reports; write them out with write_metrics_report.
+# Stages named in profile_stages are run under cProfile (written to
+# <stage>.prof) or, with profile_mode='sample', a sampling profiler that writes
+# the most common lines to <stage>.samples.txt.
+stage_reports = []
+stage_stack = []
+
+def stage(name = None):
+    def wrap(func):
+        stage_name = name or func.__name__
+        @functools.wraps(func)
+        def run_stage(*args, **kwargs):
+            metrics = {'stage': stage_name, 'rows_in': 0, 'rows_out': 0, 'inputs': [], 'outputs': []}
+            stage_stack.append(metrics)
+            profiling = profile_stages == 'all' or stage_name in profile_stages
+            profiler = None
+            if profiling and profile_mode == 'sample':
+                profiler = StackSampler(stage_name + '.samples.txt')
+            elif profiling:
+                profiler = cProfile.Profile()
+            rss = RssSampler()
+            wall = perf_counter()
+            cpu = process_time()
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            try:
+                if profiler is not None:
+                    return profiler.runcall(func, *args, **kwargs)
+                return func(*args, **kwargs)
+            finally:
+                metrics['wall_secs'] = perf_counter() - wall
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                metrics['cpu_secs'] = (process_time() - cpu + usage.ru_utime - children.ru_utime
+                                       + usage.ru_stime - children.ru_stime)
+                metrics['peak_rss_mb'] = rss.finish()
+                stage_stack.pop()
+                finish_stage_metrics(metrics)
+                stage_reports.append(metrics)
+                if isinstance(profiler, cProfile.Profile):
+                    profiler.dump_stats(stage_name + '.prof')
+                    print("Wrote profile", stage_name + '.prof')
+        return run_stage
+    return wrap
+
+# record the rows and files of the stage that is running
+def record_stage(rows_in = None, rows_out = None, inputs = (), outputs = ()):
+    if not stage_stack:
+        return
+    metrics = stage_stack[-1]
+    if rows_in is not None:
+        metrics['rows_in'] = rows_in
+    if rows_out is not None:
+        metrics['rows_out'] = rows_out
+    metrics['inputs'].extend(inputs)
+    metrics['outputs'].extend(outputs)
+
+def finish_stage_metrics(metrics):
+    metrics['bytes_read'] = sum([path_size(name) for name in metrics['inputs']])
+    metrics['bytes_written'] = sum([path_size(name) for name in metrics['outputs']])
+    metrics['rows_per_sec'] = metrics['rows_in'] / metrics['wall_secs'] if metrics['wall_secs'] > 0 else 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    metrics['process_peak_rss_mb'] = maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    peak = metrics['peak_rss_mb']
+    print("[{stage}] {rows_in:,} rows in, {rows_out:,} out, {wall_secs:.2f} secs, {rows_per_sec:,.0f} rows/sec, "
+          "peak RSS {peak} MB, process peak so far {process_peak_rss_mb:,.0f} MB".format(
+              peak='n/a' if peak is None else '{:,.0f}'.format(peak), **metrics))
+
+# Samples the RSS of the process on a thread while a stage runs. finish()
+# stops it and returns the largest sample in MB. The RSS is read from
+# /proc/self/statm, so where there is none (e.g. macOS) the peak is None.
+class RssSampler(object):
+
+    def __init__(self):
+        self.peak = current_rss_mb()
+        self.stop = threading.Event()
+        self.thread = None
+        if self.peak is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        while not self.stop.wait(rss_sample_interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def finish(self):
+        if self.thread is None:
+            return None
+        self.stop.set()
+        self.thread.join()
+        return max(self.peak, current_rss_mb())
+
+# the RSS of this process in MB, None if it can't be read
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+# size of a file, or of all the files in a directory
+def path_size(name):
+    if os.path.isdir(name):
+        return sum([path_size(os.path.join(name, f)) for f in os.listdir(name)])
+    if os.path.exists(name):
+        return os.path.getsize(name)
+    return 0
+
+# Write stage_reports as JSON, or as CSV if the file name ends in .csv
+def write_metrics_report(file_name = problem_name + '_metrics.json', reports = None):
+    if reports is None:
+        reports = stage_reports
+    cols = ['stage', 'rows_in', 'rows_out', 'bytes_read', 'bytes_written', 'wall_secs', 'cpu_secs',
+            'rows_per_sec', 'peak_rss_mb', 'process_peak_rss_mb']
+    with open(file_name, 'w') as f:
+        if file_name.endswith('.csv'):
+            writer = csv.writer(f, delimiter=',')
+            writer.writerow(cols)
+            for r in reports:
+                writer.writerow([r[c] for c in cols])
+        else:
+            json.dump([dict([(c, r[c]) for c in cols + ['inputs', 'outputs']]) for r in reports], f, indent=1)
+    print("Wrote metrics report", file_name)
+
+# print a progress dot with the row count in millions
+def progress(i):
+    if show_progress:
+        print('.{}'.format(i // 1000000), end = "", flush = True)
+
+# Sampling profiler: a thread that looks at the running stage's current line
+# every sample_interval seconds and counts where it is.
+class StackSampler(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.counts = dict()
+        self.stop = threading.Event()
+
+    def runcall(self, func, *args, **kwargs):
+        target = threading.get_ident()
+        thread = threading.Thread(target=self.sample, args=(target,), daemon=True)
+        thread.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop.set()
+            thread.join()
+            self.write()
+
+    def sample(self, target):
+        while not self.stop.wait(sample_interval):
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                where = "{}:{} {}".format(os.path.basename(frame.f_code.co_filename), frame.f_lineno,
+                                          frame.f_code.co_name)
+                self.counts[where] = self.counts.get(where, 0) + 1
+
+    def write(self):
+        total = sum(self.counts.values()) or 1
+        with open(self.file_name, 'w') as f:
+            for where, n in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write("{:6.2f}% {:8} {}\n".format(100.0 * n / total, n, where))
+        print("Wrote profile", self.file_name)
+
+# Compressed files. open_data opens a data file like open(), compressing or
+# decompressing it on the fly when the name ends in .gz, .zst or .lz4. The
+# intermediate files get data_ext. It is plain .csv by default, as compressed
+# files can't be split into chunks for the multi-process stages; set it to
+# '.csv.gz' to write them with fast gzip. The stages' default file names are
+# made from data_ext when they run, so it can be changed after loading.
+# .gz files go through pigz when it is on the path, which decompresses
+# on a separate thread and compresses on all cores. .zst files are compressed
+# with zstd_threads threads and need the zstandard package, .lz4 files need lz4.
+# Byte offsets (find_chunk_offsets) only work on plain files. run_incremental
+# appends to compressed files a gzip member (zstd or lz4 frame) at a time.
+# Text is data_encoding, like the byte level readers (ReadAheadFile,
+# read_chunk_lines), so all of them give the same strings.
+def open_data(file_name, mode = 'r', buffering = -1, newline = None):
+    codec = data_codec(file_name)
+    if codec is None:
+        return open(file_name, mode, buffering=buffering, newline=newline,
+                    encoding=None if 'b' in mode else data_encoding)
+    raw_mode = mode.replace('b', '').replace('t', '') + 'b'
+    if codec == 'gz':
+        if use_pigz and raw_mode in ('rb', 'wb') and shutil.which('pigz'):
+            stream = PigzFile(file_name, raw_mode)
+            stream = io.BufferedReader(stream, 1 << 20) if raw_mode == 'rb' else io.BufferedWriter(stream, 1 << 20)
+        else:
+            stream = gzip.open(file_name, raw_mode, compresslevel=gzip_level)
+    elif codec == 'zst':
+        import zstandard
+        if raw_mode == 'rb':
+            stream = zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), read_across_frames=True,
+                                                                  closefd=True)
+            stream = io.BufferedReader(stream, 1 << 20)
+        else:
+            cctx = zstandard.ZstdCompressor(level=zstd_level, threads=zstd_threads)
+            stream = cctx.stream_writer(open(file_name, raw_mode), closefd=True)
+            stream = io.BufferedWriter(stream, 1 << 20)
+    else:
+        import lz4.frame
+        stream = lz4.frame.open(file_name, raw_mode, compression_level=lz4_level)
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream, newline=newline, encoding=data_encoding)
+
+# 'gz', 'zst' or 'lz4' from the file name, None for a plain file
+def data_codec(file_name):
+    ext = os.path.splitext(str(file_name))[1]
+    if ext in ('.gz', '.gzip'):
+        return 'gz'
+    if ext in ('.zst', '.zstd'):
+        return 'zst'
+    if ext == '.lz4':
+        return 'lz4'
+    return None
+
+# file name without its .csv and compression extensions
+def strip_data_ext(file_name):
+    if data_codec(file_name) is not None:
+        file_name = os.path.splitext(file_name)[0]
+    return os.path.splitext(file_name)[0]
+
+# A .gz file read or written through a pigz process
+class PigzFile(io.RawIOBase):
+
+    def __init__(self, file_name, mode):
+        self.file_name = file_name
+        if mode == 'rb':
+            self.proc = subprocess.Popen(['pigz', '-dc', file_name], stdout=subprocess.PIPE)
+            self.pipe = self.proc.stdout
+        else:
+            self.out = open(file_name, 'wb')
+            self.proc = subprocess.Popen(['pigz', '-c', '-' + str(gzip_level)], stdin=subprocess.PIPE,
+                                         stdout=self.out)
+            self.pipe = self.proc.stdin
+        self.mode = mode
+
+    def readable(self):
+        return self.mode == 'rb'
+
+    def writable(self):
+        return self.mode == 'wb'
+
+    def readinto(self, b):
+        return self.pipe.readinto(b)
+
+    def write(self, b):
+        self.pipe.write(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.pipe.close()
+        code = self.proc.wait()
+        if self.mode == 'wb':
+            self.out.close()
+        if code != 0 and not (self.mode == 'rb' and code < 0):
+            raise IOError("pigz failed on {} with exit code {}".format(self.file_name, code))
 
 # Sequence to run everything.
-# Don't actually run this, since some unix sorts need to be done manually in terminal shell
+# run_pipeline_streaming() does the steps from standardize_file through
+# convert_to_ints without writing the intermediate files.
+# run_dag() runs the same stages, skipping the ones whose inputs haven't changed.
 def run_everything():
     
     # put the downloaded file in standard CSV format, which is semicolon delmited.
@@ -21,7 +366,7 @@ def run_everything():
     standardize_file() # > name_raw.csv
 
     # read the column names from the raw file
-    read_raw_column_names() # This is called by each function that needs it.
+    read_column_names('_raw') # This is called by each function that needs it.
 
     # read the fields to use
     read_field_selections() # This is called by each function that needs it.
@@ -36,30 +381,189 @@ def run_everything():
     convert_to_ints() # > name_int.csv
     
     # sort based on time, most recent first
-    # To get the key range, run the following:
-    sort_keys();
-    #sort --field-separator=';' --key=11,11 --reverse --output=ds3_int_sorted.csv ds3_int.csv
+    sort_by_time() # > name_int_sorted.csv
 
     # split the dataset into tst and trn (e.g. 1/5, 4/5)
-    split_into_tst_trn() # <<< NOT TESTED RECENTLY
+    split_into_tst_trn() # > name_tst_unsorted.csv, name_trn_unsorted.csv
 
     # If you didn't run the above, rename name_int.csv to name_trn_unsorted.csv
 
     # sort both the trn and tst files by depvar and attributes.
-    # To get the key range, run the following:
-    calc_sort_columns();
-    #sort --field-separator=';' --key=1,12  --output=ds3_tst_sorted.csv ds3_tst_unsorted.csv
-    #sort --field-separator=';' --key=1,12  --output=ds3_trn_sorted.csv ds3_trn_unsorted.csv
+    sort_for_compress('tst') # > name_tst_sorted.csv
+    sort_for_compress('trn') # > name_trn_sorted.csv
 
     compress_with_copies('trn')
 
+    # wall/CPU time, rows/sec and bytes for each of the stages above
+    write_metrics_report() # > name_metrics.json
+
+# The stages of run_everything as a dependency graph. A node runs
+# func(*args) after the nodes in after, and is up to date if its outputs exist
+# and its key is the one it was last run with. The key is a hash of the
+# contents of inputs, the values of the config globals and extra. options are
+# keyword arguments for func that don't change its outputs, so they are left
+# out of the key.
+# The conversion tables are one node: create_int_conversion_tables counts all
+# of them in one pass over the reduced file, on dag_processes processes.
+DagNode = namedtuple('DagNode', ['name', 'func', 'args', 'after', 'inputs', 'outputs', 'config', 'extra', 'options'],
+                     defaults=[None])
+
+def pipeline_dag(fieldselection = 'fieldselection.csv'):
+    fields = read_field_selections(fieldselection, trace=False)
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    name = lambda suffix: problem_name + suffix
+    count_config = ['count_backend', 'count_top_k', 'count_sketch_factor', 'other_val']
+    nodes = [DagNode('standardize', 'standardize_file', (), [], [name('_download.csv')], [name('_raw' + data_ext)],
+                     ['data_ext', 'delim'], None),
+             DagNode('reduce', 'reduce_file', (), ['standardize'], [name('_raw' + data_ext), fieldselection],
+                     [name('_reduced' + data_ext)], ['data_ext'], None)]
+    tables = [attr + '_int.csv' for attr in attr_list] + [attr + '_int.bin' for attr in attr_list]
+    nodes.extend([
+        DagNode('tables', 'create_int_conversion_tables', (name('_reduced' + data_ext),), ['reduce'],
+                [name('_reduced' + data_ext), fieldselection], tables + [name('_impression_click_counts.csv')],
+                count_config, None, {'processes': dag_processes}),
+        DagNode('convert', 'convert_to_ints', (), ['reduce', 'tables'],
+                [name('_reduced' + data_ext), fieldselection] + [attr + '_int.csv' for attr in attr_list],
+                [name('_int' + data_ext)], ['data_ext', 'table_format'], None),
+        DagNode('sort_by_time', 'sort_by_time', (), ['convert'], [name('_int' + data_ext), fieldselection],
+                [name('_int_sorted' + data_ext)], ['data_ext'], None),
+        DagNode('split', 'split_into_tst_trn', (), ['sort_by_time'],
+                [name('_int_sorted' + data_ext), name('_impression_click_counts.csv'), fieldselection],
+                [name('_tst_unsorted' + data_ext), name('_trn_unsorted' + data_ext)], ['data_ext'], None)])
+    for file_type in ['tst', 'trn']:
+        nodes.append(DagNode('sort_' + file_type, 'sort_for_compress', (file_type,), ['split'],
+                             [name('_' + file_type + '_unsorted' + data_ext), fieldselection],
+                             [name('_' + file_type + '_sorted' + data_ext)], ['data_ext'], None))
+    nodes.append(DagNode('compress_trn', 'compress_with_copies', ('trn',), ['sort_trn'],
+                         [name('_trn_sorted' + data_ext), name('_reduced' + data_ext), fieldselection],
+                         [name('_trn.csv')], ['data_ext'], None))
+    return OrderedDict([(node.name, node) for node in nodes])
+
+# the key of a node, from its inputs as they are now
+def dag_node_key(node, fingerprints):
+    h = hashlib.sha1()
+    h.update(json.dumps([node.func, node.args, node.extra,
+                         [(f, dag_file_fingerprint(f, fingerprints)) for f in node.inputs],
+                         [(c, globals()[c]) for c in node.config]], default=str).encode())
+    return h.hexdigest()
+
+# sha1 of a file's contents, remembered in fingerprints (the build state's)
+# with the file's size and modification time, so it is only recomputed when
+# the file changes
+def dag_file_fingerprint(file_name, fingerprints):
+    st = os.stat(file_name)
+    entry = fingerprints.get(file_name)
+    if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+        entry = fingerprints[file_name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': file_sha1(file_name)}
+    return entry['sha1']
+
+# Whether node has to run, and its key (None if an input is missing). It does
+# if forced, an input or output is missing, its key isn't the one it last ran
+# with, or it reads a file in pending. A dry run passes the outputs of the
+# nodes that would run before it as pending, as their new contents aren't known.
+def dag_node_stale(node, state, force = False, pending = ()):
+    if not all([os.path.exists(f) for f in node.inputs]):
+        return True, None
+    key = dag_node_key(node, state['fingerprints'])
+    stale = force or any([f in pending for f in node.inputs]) or \
+        state['nodes'].get(node.name, dict()).get('key') != key or \
+        not all([os.path.exists(f) for f in node.outputs])
+    return stale, key
+
+# The build state of run_dag: the key and outputs of each node as it last ran,
+# and the fingerprints of the files their keys were made from. A state file in
+# another layout is ignored, so every node runs once.
+def load_build_state(file_name = None):
+    file_name = file_name or build_state_file
+    state = {'nodes': dict(), 'fingerprints': dict()}
+    if os.path.exists(file_name):
+        with open(file_name, 'r') as f:
+            saved = json.load(f)
+        if 'nodes' in saved and 'fingerprints' in saved:
+            state = saved
+    return state
+
+def save_build_state(state, file_name = None):
+    file_name = file_name or build_state_file
+    with open(file_name + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(file_name + '.tmp', file_name)
+
+# run one node in a worker process and hand back its stage metrics
+def run_dag_node(func, args, options):
+    del stage_reports[:]
+    globals()[func](*args, **(options or {}))
+    return list(stage_reports)
+
+# Run the nodes of pipeline_dag that are out of date, and the ones that come
+# after them, up to targets (node names, all of them if None). Nodes whose
+# after nodes are done run at once, up to processes at a time, each in its
+# own process. With force every node runs, dry_run only prints what would.
+# Returns the names of the nodes that ran.
+def run_dag(targets = None, processes = None, force = False, dry_run = False, fieldselection = 'fieldselection.csv'):
+    processes = processes or dag_processes
+    nodes = pipeline_dag(fieldselection)
+    if targets is None:
+        targets = list(nodes.keys())
+    needed = set()
+    todo = list(targets)
+    while todo:
+        n = todo.pop()
+        if n not in nodes:
+            raise KeyError("No stage named " + str(n))
+        if n not in needed:
+            needed.add(n)
+            todo.extend(nodes[n].after)
+
+    state = load_build_state()
+    done = set()
+    ran = []
+    pending = set() # outputs of the nodes a dry run would run
+    running = dict() # future -> (node, key)
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        while len(done) < len(needed):
+            ready = [n for n in nodes if n in needed and n not in done
+                     and n not in [node.name for node, key in running.values()]
+                     and all([a in done for a in nodes[n].after])]
+            for n in ready:
+                node = nodes[n]
+                stale, key = dag_node_stale(node, state, force, pending)
+                if not stale:
+                    print("Up to date:", n, flush=True)
+                    done.add(n)
+                    continue
+                if dry_run:
+                    print("Would run", n, flush=True)
+                    pending.update(node.outputs)
+                    ran.append(n)
+                    done.add(n)
+                    continue
+                print("Running", n, flush=True)
+                running[pool.submit(run_dag_node, node.func, node.args, node.options)] = (node, key)
+            if not running:
+                continue
+            finished, not_done = concurrent.futures.wait(list(running.keys()),
+                                                         return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                node, key = running.pop(future)
+                stage_reports.extend(future.result())
+                state['nodes'][node.name] = {'key': key, 'outputs': node.outputs}
+                save_build_state(state)
+                done.add(node.name)
+                ran.append(node.name)
+                print("Finished", node.name, flush=True)
+    if not dry_run:
+        save_build_state(state) # the fingerprints of the up to date nodes' inputs
+    return ran
 
 # Put the file into a standard csv format
-def standardize_file(infile_name = problem_name + '_download.csv', outfile_name = problem_name + '_raw.csv'):
-    dataReader = csv.reader(open(infile_name, 'r'), delimiter=delim, quoting=csv.QUOTE_NONE)
+@stage()
+def standardize_file(infile_name = problem_name + '_download.csv', outfile_name = None):
+    if outfile_name is None:
+        outfile_name = problem_name + '_raw' + data_ext
+    dataReader = read_rows(infile_name, delim)
     print ('Reading file {}'.format(infile_name))
-    f = open(outfile_name, 'w')
-    writer = csv.writer(f, delimiter=';')
+    writer = RowBatchWriter(outfile_name, delimiter=';')
     print('Writing file', outfile_name)
 
     line_cnt = 0
@@ -78,56 +582,174 @@ def standardize_file(infile_name = problem_name + '_download.csv', outfile_name
         line = [s.strip() for s in row]
         writer.writerow(line)
         write_cnt += 1
-        if (line_cnt % 100000 == 0):
-            print(line_cnt)
+        if (line_cnt % progress_every == 0): progress(line_cnt)
         #if line_cnt > 10: break
 
+    writer.close()
     print((line_cnt, write_cnt, line_cnt-write_cnt), "lines (read, written, diff)")
+    record_stage(line_cnt, write_cnt, [infile_name], [outfile_name])
 
 # Ignore this. Used for testing.
-def scan_julian2(infile_name = problem_name + '-adjusted.csv', outfile_name = problem_name + '_julian.csv'):
-    path = "/Users/Gil/GilFiles/Tapad Data/vistaprint/"
-    
-    dataReader = csv.reader(open(path+infile_name, 'r'), delimiter=delim, quoting=csv.QUOTE_NONE)
-    print ('Reading file {}'.format(infile_name))
-    f = open(outfile_name, 'w')
-    writer = csv.writer(f, delimiter=';')
-    print('Writing file', outfile_name)
-
-    line_cnt = 0
-    write_cnt = 0
-    d = dict()
-    for row in dataReader:
-        line_cnt += 1
-        if line_cnt == 1:
-            target_cnt = len(row)
-            print("Number of columns found:", target_cnt)
-            continue # skip header
-        if len(row) != target_cnt:
-            print("Skipped:", row)
-            continue
-        dt = datetime.datetime.fromtimestamp(float(row[1]))
-        #print(dt)
-        julian = dt.timetuple().tm_yday
-        if julian not in d:
-            d[julian] = [0,0,0]
-        l = d[julian]
-        if row[0] == 'impression':
-            l[0] += 1
-        if row[0] == 'Vistaprint_Conversion_Pixel':
-            l[1] += 1
-        if row[0] == 'click':
-            l[2] += 1
-            
-
-    return d
-    writer.writerow(line)
-    write_cnt += 1
-    if (line_cnt % 100000 == 0):
-        print(line_cnt)
-    #if line_cnt > 10: break
-
-    print((line_cnt, write_cnt, line_cnt-write_cnt), "lines (read, written, diff)")
+# Count impressions, conversions and clicks per day of the year in the
+# adjusted file, whose first two columns are the action and the unix time.
+# Returns a dict of julian day: [impressions, conversions, clicks] and writes
+# it as a tidy report to outfile_name.
+def scan_julian2(infile_name = problem_name + '-adjusted.csv', outfile_name = problem_name + '_julian.csv',
+                 path = "/Users/Gil/GilFiles/Tapad Data/vistaprint/"):
+    events = ['impression', 'Vistaprint_Conversion_Pixel', 'click']
+    counts = aggregate_events(path + infile_name, outfile_name, bucket='julian', time_column=1, event_column=0,
+                              events=events)
+    return dict([(julian, list(cnts)) for (julian, group), cnts in counts.items()])
+
+time_buckets = ['day', 'hour', 'dow', 'julian']
+dow_names = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# Count the events in a file by time bucket, and by the values of group_by if
+# it's given, and write them as a tidy report: one row of bucket, [group,]
+# event, count per bucket and group seen. The file is read in chunks of
+# event_chunk_rows rows and only the time, event and group columns are pulled
+# out of each chunk; the counting is one numpy.bincount per chunk, over just the
+# group and bucket cells that occur in it (numbered with numpy.unique), so its
+# size doesn't depend on the number of groups or the time span.
+# bucket is one of time_buckets: 'day' (yyyy-mm-dd), 'hour' (of the day),
+# 'dow' (day of week) or 'julian' (day of the year), all in report_time_zone.
+# The time column can hold unix times or Tapad time stamps. Columns are given
+# by name or position, group_by must be the depvar or an attribute in the
+# field selection. Rows with the wrong number of fields are skipped, events
+# not in events are not counted.
+# Returns a dict of (bucket, group): counts, in the order of events.
+@stage()
+def aggregate_events(infile_name = None, outfile_name = problem_name + '_events.csv',
+                     bucket = 'day', group_by = None, time_column = 'created_at', event_column = 'action_id',
+                     events = None, delimiter = delim, fieldselection = 'fieldselection.csv'):
+    if infile_name is None:
+        infile_name = problem_name + '_raw' + data_ext
+    if bucket not in time_buckets:
+        raise ValueError("Unknown time bucket: " + str(bucket))
+    if events is None:
+        events = event_names
+    if group_by is not None:
+        fields = read_field_selections(fieldselection, trace=False)
+        if group_by != fields['depvar_name'] and group_by not in fields['attrs']:
+            raise ValueError("Not the depvar or an attribute in {}: {}".format(fieldselection, group_by))
+    event_codes = dict([(e, i) for i, e in enumerate(events)])
+    n_events = len(events)
+
+    counts = dict()
+    group_codes = dict()
+    group_values = []
+    rows_read = 0
+    skipped = 0
+    with open_data(infile_name, 'r') as f:
+        print("Reading file", infile_name, end="")
+        header = next(csv.reader([f.readline()], delimiter=delimiter, quoting=csv.QUOTE_NONE), [])
+        header = [h.strip() for h in header]
+        num_cols = len(header)
+        time_index = column_position(header, time_column)
+        event_index = column_position(header, event_column)
+        group_index = None if group_by is None else column_position(header, group_by)
+        while True:
+            lines = list(itertools.islice(f, event_chunk_rows))
+            if not lines:
+                break
+            rows_read += len(lines)
+            if set(map(str.count, lines, itertools.repeat(delimiter))) != {num_cols - 1}:
+                good = [line for line in lines if line.count(delimiter) == num_cols - 1]
+                skipped += len(lines) - len(good)
+                lines = good
+                if not lines:
+                    continue
+
+            # split the whole chunk at once, then take the columns we need
+            text = ''.join(lines)
+            if text.endswith('\n'):
+                text = text[:-1]
+            flat = text.replace('\n', delimiter).split(delimiter)
+            event = np.fromiter(map(event_codes.get, flat[event_index::num_cols], itertools.repeat(-1)),
+                                dtype=np.int64, count=len(lines))
+            b = time_bucket(event_times(flat[time_index::num_cols]), bucket)
+            if group_index is None:
+                group = np.zeros(len(lines), dtype=np.int64)
+            else:
+                for v in set(flat[group_index::num_cols]) - group_codes.keys():
+                    group_codes[v] = len(group_values)
+                    group_values.append(v)
+                group = np.fromiter(map(group_codes.__getitem__, flat[group_index::num_cols]),
+                                    dtype=np.int64, count=len(lines))
+
+            # one bincount over the (group, bucket) cells seen, by event
+            keep = event >= 0
+            if not keep.any():
+                continue
+            event, b, group = event[keep], b[keep], group[keep]
+            b0 = int(b.min())
+            n_buckets = int(b.max()) - b0 + 1
+            cells, cell_index = np.unique(group * n_buckets + (b - b0), return_inverse=True)
+            key = cell_index.reshape(-1) * n_events + event
+            cube = np.bincount(key, minlength=len(cells) * n_events).reshape(len(cells), n_events)
+            for k, c in enumerate(cells.tolist()):
+                g, bk = divmod(c, n_buckets)
+                cell = (bk + b0, g)
+                if cell in counts:
+                    counts[cell] += cube[k]
+                else:
+                    counts[cell] = cube[k].copy()
+            progress(rows_read)
+        print()
+    if skipped:
+        print("Skipped {:,} lines with the wrong number of fields".format(skipped))
+
+    if group_by is not None:
+        counts = dict([((b, group_values[g]), c) for (b, g), c in counts.items()])
+    write_event_report(outfile_name, counts, bucket, group_by, events)
+    record_stage(rows_read, len(counts) * n_events, [infile_name], [outfile_name])
+    return counts
+
+# position of a column given by name or number
+def column_position(header, column):
+    if isinstance(column, int):
+        return column
+    if column not in header:
+        raise ValueError("No column {} in {}".format(column, header))
+    return header.index(column)
+
+# a column of unix times or Tapad time stamps as an int64 array of unix times
+def event_times(values):
+    try:
+        return np.asarray(values, dtype=np.float64).astype(np.int64)
+    except ValueError:
+        return convert_to_timestamps(values)
+
+# the time bucket of each unix time in t
+def time_bucket(t, bucket):
+    t = utc_to_local(t, report_time_zone)
+    if bucket == 'hour':
+        return t // 3600 % 24
+    days = t // 86400
+    if bucket == 'dow':
+        return (days + 3) % 7 # 1970-01-01 was a Thursday
+    if bucket == 'julian':
+        d = days.astype('datetime64[D]')
+        return (d - d.astype('datetime64[Y]')).astype(np.int64) + 1
+    return days
+
+def bucket_label(b, bucket):
+    if bucket == 'day':
+        return str(np.datetime64(int(b), 'D'))
+    if bucket == 'dow':
+        return dow_names[b]
+    return b
+
+# write the counts from aggregate_events, one row per bucket, group and event
+def write_event_report(outfile_name, counts, bucket, group_by, events):
+    with open(outfile_name, 'w', newline='', encoding=data_encoding) as f:
+        writer = csv.writer(f)
+        writer.writerow([bucket] + ([group_by] if group_by is not None else []) + ['event', 'count'])
+        for (b, group) in sorted(counts, key=lambda cell: (cell[0], str(cell[1]))):
+            cnts = counts[(b, group)]
+            label = [bucket_label(b, bucket)] + ([group] if group_by is not None else [])
+            writer.writerows([label + [e, int(c)] for e, c in zip(events, cnts)])
+    print("Wrote file", outfile_name)
 
 # Read csv files that define the fields
 def read_field_selections(infile_name = 'fieldselection.csv', trace=True):
@@ -138,7 +760,7 @@ def read_field_selections(infile_name = 'fieldselection.csv', trace=True):
     fields['attrs'] = OrderedDict()
     fields['data'] = OrderedDict()
     
-    dataReader = csv.reader(open(infile_name, 'r'), delimiter=',', quoting=csv.QUOTE_NONE)
+    dataReader = csv.reader(open(infile_name, 'r', encoding=data_encoding), delimiter=',', quoting=csv.QUOTE_NONE)
     print ('Reading file {}'.format(infile_name))
 
     line_cnt = 0
@@ -168,18 +790,86 @@ def read_field_selections(infile_name = 'fieldselection.csv', trace=True):
     return fields
 
 # Read the header line from a csv file and return a namedtuple template
+# A name<suffix>_header.csv sidecar (see stream_header_only) is used instead
+# when the data file is missing or older than it.
 def read_column_names(suffix, trace=True):
-    file_name = problem_name + suffix + '.csv'
-    dataReader = csv.reader(open(file_name, 'r'), delimiter=delim, quoting=csv.QUOTE_NONE)
+    file_name = problem_name + suffix + data_ext
+    header_name = header_file_name(file_name)
+    if os.path.exists(header_name) and (not os.path.exists(file_name) or
+                                        os.path.getmtime(header_name) >= os.path.getmtime(file_name)):
+        file_name = header_name
     print ('Reading file {}'.format(file_name))
     global raw_cols
-    for row in dataReader:
-        raw_cols = row
-        break
+    with open_data(file_name, 'r') as f:
+        for row in csv.reader(f, delimiter=delim, quoting=csv.QUOTE_NONE):
+            raw_cols = row
+            break
     raw_cols = [s.strip() for s in raw_cols]
     if trace:
         print('Column names:', raw_cols)
-    return namedtuple('Fields', raw_cols, verbose=False)
+    return namedtuple('Fields', raw_cols)
+
+# The field selection compiled to column positions in a file. Built once per
+# file, so the row loops index rows directly instead of making a namedtuple
+# per row and looking fields up by name.
+FieldPlan = namedtuple('FieldPlan', ['num_cols', 'depvar_index', 'attr_indices', 'data_indices', 'filter_index',
+                                     'project', 'project_data'])
+
+# compile the field selection against a file's column names. project(row)
+# gives the depvar, attrs and data fields, project_data(row) just the data fields.
+def compile_field_plan(fields, col_names, filter_name = 'action_id'):
+    col_names = list(col_names)
+    depvar_index = col_names.index(fields['depvar_name'])
+    attr_indices = [col_names.index(k) for k in fields['attrs'].keys()]
+    data_indices = [col_names.index(k) for k in fields['data'].keys()]
+    filter_index = col_names.index(filter_name) if filter_name in col_names else None
+    return FieldPlan(len(col_names), depvar_index, attr_indices, data_indices, filter_index,
+                     make_projection([depvar_index] + attr_indices + data_indices),
+                     make_projection(data_indices))
+
+# itemgetter for a list of positions that always returns a tuple
+def make_projection(indices):
+    if len(indices) == 0:
+        return lambda row: ()
+    if len(indices) == 1:
+        i = indices[0]
+        return lambda row: (row[i],)
+    return itemgetter(*indices)
+
+# Time namedtuple-per-row field access against a compiled FieldPlan on the
+# first rows of a file, projecting each row the way reduce_file does.
+def benchmark_field_projection(file_name = None, suffix = '_raw', rows = 1000000):
+    if file_name is None:
+        file_name = problem_name + '_raw' + data_ext
+    fields = read_field_selections(trace=False) # read in the fields to use
+    FieldsNT = read_column_names(suffix, trace=False)
+    with open_data(file_name, 'r') as f:
+        dataReader = csv.reader(f, delimiter=delim, quoting=csv.QUOTE_NONE)
+        next(dataReader) # skip header
+        data = list(itertools.islice(dataReader, rows))
+    print("Projecting {:,} rows".format(len(data)))
+
+    t1 = perf_counter()
+    for row in data:
+        line = FieldsNT._make(row)
+        new_line = [getattr(line, fields['depvar_name'])]
+        for k in fields['attrs'].keys():
+            new_line.append(getattr(line, k))
+        for k in fields['data'].keys():
+            new_line.append(getattr(line, k))
+    t_named = perf_counter() - t1
+
+    t1 = perf_counter()
+    plan = compile_field_plan(fields, FieldsNT._fields)
+    project = plan.project
+    for row in data:
+        new_line = project(row)
+    t_plan = perf_counter() - t1
+
+    for name, t in [('namedtuple', t_named), ('field plan', t_plan)]:
+        print("{:12} {:8.3f} secs  {:,.0f} rows/sec".format(name, t, len(data) / t if t > 0 else 0))
+    print("Speedup: {:.1f}x".format(t_named / t_plan if t_plan > 0 else 0))
+    return t_named, t_plan
 
 # Print the column ranges to sort the csv files with the unix sort command
 def sort_keys(time = 'created_at'):
@@ -199,15 +889,209 @@ def sort_keys(time = 'created_at'):
         print(time, "field not found")
         
             
+# External merge sort of a csv file. Rows are read into runs of about
+# memory_mb, each run is sorted and spilled to a temp file, and the runs are
+# merged with a heap. key_columns is a list of (column index, descending) pairs.
+# Columns that hold integers in the first row are compared as ints.
+@stage()
+def external_sort(infile_name, outfile_name, key_columns, delimiter = ',', memory_mb = None,
+                  header = False, tmp_dir = None):
+    if memory_mb is None:
+        memory_mb = sort_memory_mb
+    budget = memory_mb * 1024 * 1024
+
+    runs = []
+    run = []
+    run_bytes = 0
+    rows_read = 0
+    key = None
+    header_row = None
+    try:
+        print('Sorting file', infile_name, end='')
+        with open_data(infile_name, 'r') as f:
+            dataReader = csv.reader(f, delimiter=delimiter)
+            for row in dataReader:
+                if header and header_row is None:
+                    header_row = row
+                    continue
+                if key is None:
+                    key = make_sort_key(key_columns, row)
+                rows_read += 1
+                if (rows_read % progress_every == 0): progress(rows_read)
+                run.append(row)
+                run_bytes += approx_row_bytes(row)
+                if run_bytes >= budget:
+                    run.sort(key=key)
+                    runs.append(write_sort_run(run, delimiter, tmp_dir))
+                    run = []
+                    run_bytes = 0
+        print()
+        run.sort(key=key)
+        run_cnt = len(runs) + (1 if run or not runs else 0)
+
+        with open_data(outfile_name, 'w') as out:
+            writer = csv.writer(out, delimiter=delimiter)
+            if header_row is not None:
+                writer.writerow(header_row)
+            if not runs:
+                writer.writerows(run)
+            else:
+                if run:
+                    runs.append(write_sort_run(run, delimiter, tmp_dir))
+                run = []
+                # merge in passes if there are more runs than files we want open
+                while len(runs) > sort_max_merge:
+                    merged = []
+                    for i in range(0, len(runs), sort_max_merge):
+                        group = runs[i:i + sort_max_merge]
+                        merged.append(merge_sort_runs(group, key, delimiter, None, tmp_dir))
+                        for name in group:
+                            os.remove(name)
+                    runs = merged
+                merge_sort_runs(runs, key, delimiter, writer, tmp_dir)
+        print("Sorted {:,} rows using {:,} runs. Wrote file {}".format(rows_read, run_cnt, outfile_name))
+        record_stage(rows_read, rows_read, [infile_name], [outfile_name])
+    finally:
+        for name in runs:
+            if os.path.exists(name):
+                os.remove(name)
+    return rows_read
+
+# rough in-memory size of a parsed row held in a sort run
+def approx_row_bytes(row):
+    return 120 + sum([len(v) + 56 for v in row])
+
+# Make a sort key function from (column index, descending) pairs. A third item
+# 'time' marks a time stamp column, which is compared as unix time.
+# A column whose first value is an int compares as ints, and a time column as
+# unix times; a later value that isn't one (e.g. blank) sorts after all of
+# them (before, descending), compared as a string.
+def make_sort_key(key_columns, first_row):
+    convs = []
+    for key_column in key_columns:
+        idx, descending = key_column[0:2]
+        v = first_row[idx]
+        if v.lstrip('-').isdigit():
+            convs.append((idx, negative_int_key if descending else int_key))
+        elif key_column[2:] == ('time',):
+            convs.append((idx, negative_timestamp_key if descending else timestamp_key))
+        else:
+            convs.append((idx, Descending if descending else str))
+    if len(convs) == 1:
+        idx, conv = convs[0]
+        return lambda row: conv(row[idx])
+    return lambda row: tuple([conv(row[idx]) for idx, conv in convs])
+
+def int_key(s):
+    try:
+        return (0, int(s))
+    except ValueError:
+        return (1, s)
+
+def negative_int_key(s):
+    try:
+        return (1, -int(s))
+    except ValueError:
+        return (0, Descending(s))
+
+def timestamp_key(s):
+    try:
+        return (0, convert_to_timestamp(s))
+    except ValueError:
+        return (1, s)
+
+def negative_timestamp_key(s):
+    try:
+        return (1, -convert_to_timestamp(s))
+    except ValueError:
+        return (0, Descending(s))
+
+# wrapper that reverses the ordering of a string in a sort key
+class Descending(object):
+    __slots__ = ('v',)
+    def __init__(self, v):
+        self.v = v
+    def __lt__(self, other):
+        return other.v < self.v
+    def __eq__(self, other):
+        return self.v == other.v
+
+# write one sorted run to a temp file and return its name
+def write_sort_run(run, delimiter, tmp_dir):
+    f = tempfile.NamedTemporaryFile('w', suffix='.run', dir=tmp_dir, delete=False, newline='', encoding=data_encoding)
+    csv.writer(f, delimiter=delimiter).writerows(run)
+    f.close()
+    return f.name
+
+# k-way merge of sorted run files. Writes to writer, or to a new run file if
+# writer is None, in which case the new file name is returned.
+def merge_sort_runs(run_names, key, delimiter, writer, tmp_dir):
+    out = None
+    if writer is None:
+        out = tempfile.NamedTemporaryFile('w', suffix='.run', dir=tmp_dir, delete=False, newline='', encoding=data_encoding)
+        writer = csv.writer(out, delimiter=delimiter)
+    files = [open(name, 'r', newline='', encoding=data_encoding) for name in run_names]
+    try:
+        readers = [csv.reader(f, delimiter=delimiter) for f in files]
+        writer.writerows(heapq.merge(*readers, key=key))
+    finally:
+        for f in files:
+            f.close()
+    if out is not None:
+        out.close()
+        return out.name
+
+# Sort key columns for name_int.csv style files (depvar, attrs, then data fields).
+# With attrs=True the key is the depvar and attributes, plus the column after
+# them, since compress_with_copies compares that too (the action).
+# With time set, that field is added to the key, most recent first.
+# Times in the same second keep their input order.
+def sort_key_columns(attrs = True, time = None):
+    fields = read_field_selections(trace=False) # read in the fields to use
+    num_fields = 1 + len(fields['attrs'])
+    key_columns = []
+    if attrs:
+        key_columns = [(i, False) for i in range(num_fields + 1)]
+    if time is not None:
+        data_list = [k for k in fields['data'].keys()]
+        if time not in data_list:
+            raise ValueError(time + " field not found")
+        key_columns.append((num_fields + data_list.index(time), True, 'time'))
+    return key_columns
+
+# sort the int file by time, most recent first
+def sort_by_time(infile_name = None, outfile_name = None,
+                 time = 'created_at', memory_mb = None):
+    if infile_name is None:
+        infile_name = problem_name + '_int' + data_ext
+    if outfile_name is None:
+        outfile_name = problem_name + '_int_sorted' + data_ext
+    key_columns = sort_key_columns(attrs=False, time=time)
+    external_sort(infile_name, outfile_name, key_columns, delimiter=',', memory_mb=memory_mb)
+
+# sort the tst or trn file by depvar and attributes, ready for compress_with_copies
+def sort_for_compress(file_type, time = None, memory_mb = None):
+    infile_name = problem_name + '_' + file_type + '_unsorted' + data_ext
+    outfile_name = problem_name + '_' + file_type + '_sorted' + data_ext
+    key_columns = sort_key_columns(attrs=True, time=time)
+    external_sort(infile_name, outfile_name, key_columns, delimiter=',', memory_mb=memory_mb)
+
 # reduce the file to just those fields we are interested in
-def reduce_file(infile_name = problem_name + '_raw.csv', outfile_name = problem_name + '_reduced.csv'):
+@stage()
+def reduce_file(infile_name = None, outfile_name = None):
+    if infile_name is None:
+        infile_name = problem_name + '_raw' + data_ext
+    if outfile_name is None:
+        outfile_name = problem_name + '_reduced' + data_ext
     fields = read_field_selections() # read in the fields to use
     FieldsNT = read_column_names('_raw', trace=False)
+    plan = compile_field_plan(fields, FieldsNT._fields)
+    filter_index = plan.filter_index
+    project = plan.project
     
-    dataReader = csv.reader(open(infile_name, 'r'), delimiter=delim, quoting=csv.QUOTE_NONE)
+    dataReader = read_rows(infile_name, delim)
     print ('Reading file {}'.format(infile_name))
-    f = open(outfile_name, 'w')
-    writer = csv.writer(f, delimiter=';')
+    writer = RowBatchWriter(outfile_name, delimiter=';')
     print('Writing file', outfile_name)
 
     line_cnt = 0
@@ -223,34 +1107,23 @@ def reduce_file(infile_name = problem_name + '_raw.csv', outfile_name = problem_
             #print("Line:", line_cnt)
             #print("Target: ", target_cnt, "  Count:", len(row))
             sys.exit()
-            
-        line = FieldsNT._make(row)
 
         # filter any rows here
-        if line.action_id == 'click': continue
+        if row[filter_index] == 'click': continue
         
-        new_line = [];
-
-        # depvar
-        new_line.append(getattr(line, fields['depvar_name']))
-
-        # attributes
-        for k in fields['attrs'].keys():
-            new_line.append(getattr(line, k))
-
-        # other data items
-        for k in fields['data'].keys():
-            new_line.append(getattr(line, k))
+        # depvar, attributes and other data items
+        new_line = project(row)
 
         #print(new_line)
         writer.writerow(new_line)
         write_cnt += 1
         
-        if (line_cnt % 100000 == 0):
-            print(line_cnt)
+        if (line_cnt % progress_every == 0): progress(line_cnt)
         #if line_cnt > 10: break
 
+    writer.close()
     print((line_cnt, write_cnt, line_cnt-write_cnt), "lines (read, written, diff)")
+    record_stage(line_cnt, write_cnt, [infile_name], [outfile_name])
 
 def try_convert2num(s):
     try:
@@ -260,61 +1133,340 @@ def try_convert2num(s):
         return s
     
 # create attr int conversion tables
-def create_int_conversion_tables(file_name = problem_name + '_reduced.csv'):
+# With processes > 1 the file is split into chunks that are counted in a
+# process pool, see count_attr_values_parallel.
+# With count_top_k the file is read twice: the first pass finds the top values
+# of each attribute with a sketch (see AttrCounter), the second counts them
+# exactly and counts everything else as other_val.
+@stage()
+def create_int_conversion_tables(file_name = None, processes = 1):
+    if file_name is None:
+        file_name = problem_name + '_reduced' + data_ext
     fields = read_field_selections(trace=False) # read in the fields to use
     FieldsNT = read_column_names('_reduced', trace=False)
 
     # create a list of attributes to sort on
     attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
     print('fields:', attr_list)
-    
-    cnts = dict()
-    for attr in attr_list:
-        cnts[attr] = dict()
+
+    if processes > 1 and data_codec(file_name) is not None:
+        print("Counting", file_name, "in one process, compressed files can't be split into chunks")
+        processes = 1
+    cnts, impression_cnt, click_cnt = count_attr_values(file_name, FieldsNT._fields, attr_list, processes)
+    if count_top_k is not None:
+        cnts, impression_cnt, click_cnt = recount_top_values(file_name, FieldsNT._fields, attr_list, cnts, processes)
+
+    write_int_conversion_tables(cnts, attr_list, impression_cnt, click_cnt)
+    record_stage(impression_cnt + click_cnt, None, [file_name], [attr + '_int.csv' for attr in attr_list])
+
+# The second pass of a capped count: count the top values found by the first
+# (cnts) exactly, and the rest of each attribute as other_val
+def recount_top_values(file_name, col_names, attr_list, cnts, processes = 1):
+    keep = dict([(attr, [k for k, v in cnts[attr].items() if k != other_val]) for attr in attr_list[1:]])
+    print("Recounting the top", count_top_k, "values of each attribute")
+    return count_attr_values(file_name, col_names, attr_list, processes, keep)
+
+# Count the impressions and clicks of each attribute value in the reduced file.
+# With keep (attr -> values) only those values are counted for an attribute,
+# the rest count as other_val.
+def count_attr_values(file_name, col_names, attr_list, processes = 1, keep = None):
+    if processes > 1:
+        return count_attr_values_parallel(file_name, col_names, attr_list, processes, keep=keep)
+
+    fields = read_field_selections(trace=False) # read in the fields to use
+    cnts = new_attr_counts(attr_list, keep, fields['depvar_name'])
 
     impression_cnt = 0
     click_cnt = 0
+
+    plan = compile_field_plan(fields, col_names)
+    action_index = plan.filter_index
+    count_row = make_row_counter([cnts[attr] for attr in attr_list], [list(col_names).index(attr) for attr in attr_list])
     
     # scan the datafile and collect stats on each attribute
     print("Reading data file", file_name, end="");
-    with open(file_name, 'r') as f:
-        dataReader = csv.reader(f, delimiter=delim, quoting=csv.QUOTE_NONE)
+    with ReadAheadFile(file_name) as f:
+        dataReader = f.rows(delim)
         i = 0
         for row in dataReader:
             i += 1
-            if (i % 1000000 == 0): print('.{}'.format(i // 1000000), end = "")
+            if (i % progress_every == 0): progress(i)
             #if i == 100000: break
             
             if i == 1: continue #skip header line
             
-            r = FieldsNT._make(row)
+            if len(row) != plan.num_cols:
+                raise TypeError("Expected {} fields, got {}: {}".format(plan.num_cols, len(row), row))
             
-            if r.action_id == 'impression':
+            if row[action_index] == 'impression':
                 impression_cnt += 1
+                col = 0
             else:
                 click_cnt += 1
+                col = 1
                 
-            for attr in attr_list:
-                if not getattr(r, attr) in cnts[attr]:
-                    cnts[attr][getattr(r, attr)] = [0,0]
-                if r.action_id == 'impression':
-                    cnts[attr][getattr(r, attr)][0] += 1
-                else:
-                    cnts[attr][getattr(r, attr)][1] += 1
+            count_row(row, col)
     print()
-    
+    return cnts, impression_cnt, click_cnt
+
+# Count the attribute values of the reduced file in a process pool. The file is
+# split at line boundaries into a few chunks per process, each chunk is counted
+# separately and the partial counts are added up, in file order, so capped
+# counts keep the same candidates from run to run.
+def count_attr_values_parallel(file_name, col_names, attr_list, processes, action_name = 'action_id', keep = None):
+    fields = read_field_selections(trace=False) # read in the fields to use
+    plan = compile_field_plan(fields, col_names, action_name)
+    attr_indices = [plan.depvar_index] + plan.attr_indices
+    action_index = plan.filter_index
+    chunks = find_chunk_offsets(file_name, processes * 4)
+    print("Counting", file_name, "in", len(chunks), "chunks on", processes, "processes", end="")
+    keep_lists = [keep.get(attr) if keep else None for attr in attr_list]
+    jobs = [(file_name, start, end, attr_indices, action_index, count_backend, count_top_k, keep_lists)
+            for start, end in chunks]
+
+    cnts = new_attr_counts(attr_list, keep)
+    impression_cnt = 0
+    click_cnt = 0
+    with multiprocessing.Pool(processes) as pool:
+        for part_cnts, part_impressions, part_clicks in pool.imap(count_chunk, jobs):
+            print('.', end="")
+            impression_cnt += part_impressions
+            click_cnt += part_clicks
+            for attr, part in zip(attr_list, part_cnts):
+                merge_attr_counts(cnts[attr], part)
+    print()
+    return cnts, impression_cnt, click_cnt
+
+# add the [impressions, clicks] counts of part into cnts
+def merge_attr_counts(cnts, part):
+    if isinstance(cnts, AttrCounter):
+        cnts.merge(part)
+        return
+    for k, v in part.items():
+        c = cnts.get(k)
+        if c is None:
+            cnts[k] = v
+        else:
+            c[0] += v[0]
+            c[1] += v[1]
+
+# count the attribute values in one chunk of the reduced file. Runs in a worker process.
+def count_chunk(job):
+    file_name, start, end, attr_indices, action_index, backend, top_k, keep_lists = job
+    part_cnts = [new_attr_counter(backend, top_k, i == 0, keep_lists[i]) for i in range(len(attr_indices))]
+    count_row = make_row_counter(part_cnts, attr_indices)
+    impression_cnt = 0
+    click_cnt = 0
+    dataReader = csv.reader(read_chunk_lines(file_name, start, end), delimiter=delim, quoting=csv.QUOTE_NONE)
+    for row in dataReader:
+        if row[action_index] == 'impression':
+            impression_cnt += 1
+            col = 0
+        else:
+            click_cnt += 1
+            col = 1
+        count_row(row, col)
+    return part_cnts, impression_cnt, click_cnt
+
+# Split a file into about num_chunks (start, end) byte ranges that begin on a
+# line boundary. With skip_header the first line is left out.
+def find_chunk_offsets(file_name, num_chunks, skip_header = True):
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        if skip_header:
+            f.readline()
+        first = f.tell()
+        offsets = [first]
+        for i in range(1, num_chunks):
+            pos = first + (size - first) * i // num_chunks
+            if pos <= offsets[-1]:
+                continue
+            # move to the start of the next line
+            f.seek(pos - 1)
+            f.readline()
+            if f.tell() > offsets[-1] and f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return [(offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1) if offsets[i] < offsets[i + 1]]
+
+# read the lines of a file between two byte offsets found by find_chunk_offsets
+def read_chunk_lines(file_name, start, end):
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line.decode(data_encoding)
+
+# The counts for each attribute in attr_list, per count_backend and count_top_k.
+# The depvar (depvar_name, or the first in attr_list) is never capped. keep is
+# for the exact second pass of a capped count, see AttrCounter.
+def new_attr_counts(attr_list, keep = None, depvar_name = None):
+    if depvar_name is None:
+        depvar_name = attr_list[0]
+    cnts = dict()
+    for attr in attr_list:
+        cnts[attr] = new_attr_counter(count_backend, count_top_k, attr == depvar_name, keep.get(attr) if keep else None)
+    return cnts
+
+# capped counters are always compact, including the uncapped one for the depvar
+def new_attr_counter(backend, top_k = None, depvar = False, keep = None):
+    if keep is not None:
+        return AttrCounter(None if depvar else top_k, keep=keep)
+    if top_k is not None:
+        return AttrCounter(None if depvar else top_k)
+    if backend == 'compact':
+        return AttrCounter()
+    elif backend != 'dict':
+        raise ValueError("Unknown count backend: " + str(backend))
+    return dict()
+
+# Returns count_row(row, col), which adds one to the impressions (col=0) or
+# clicks (col=1) of the value in each of attr_indices, in the matching counts
+def make_row_counter(attr_cnts, attr_indices):
+    if all([isinstance(cnts, dict) for cnts in attr_cnts]):
+        pairs = list(zip(attr_indices, attr_cnts))
+        def count_row(row, col):
+            for idx, cnts in pairs:
+                c = cnts.get(row[idx])
+                if c is None:
+                    c = cnts[row[idx]] = [0,0]
+                c[col] += 1
+    else:
+        adds = [(idx, cnts.add) for idx, cnts in zip(attr_indices, attr_cnts)]
+        def count_row(row, col):
+            for idx, add in adds:
+                add(row[idx], col)
+    return count_row
+
+# Impression and click counts per value of one attribute, stored compactly: a
+# dict from each value to its slot and int64 arrays of the counts, instead of a
+# list object per value.
+# With top_k the counter is capped: it tracks at most count_sketch_factor * top_k
+# values, as a heavy hitters sketch (Space-Saving with batched eviction). When
+# it is full the half with the lowest estimated volume is dropped, and their
+# counts go to other_val. A value that comes back starts again from zero, with
+# an error bound (the largest volume dropped so far) added to its estimate.
+# Any value with more than about 2/(count_sketch_factor * top_k) of the rows is
+# always kept. The counts of the kept values are lower bounds, and a value that
+# came in late can have a large error bound, so the sketch doesn't cut its
+# candidates down to top_k: create_int_conversion_tables recounts all of them
+# exactly with keep, the list of values to count, and every other value is
+# counted as other_val. Only that exact count is cut to the top_k values, the
+# rest going to other_val, so the impression and click totals stay exact.
+class AttrCounter(object):
+
+    def __init__(self, top_k = None, keep = None):
+        self.top_k = top_k
+        self.capacity = None if top_k is None else max(2, count_sketch_factor * top_k)
+        self.index = dict()
+        self.values = []
+        self.impressions = array('q')
+        self.clicks = array('q')
+        self.errors = array('q')
+        self.floor = 0
+        self.other = [0, 0]
+        self.finished = False
+        self.closed = keep is not None
+        for value in keep or []:
+            self.new_slot(value, 0)
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value, col, n = 1):
+        i = self.index.get(value)
+        if i is None:
+            if self.closed:
+                self.other[col] += n
+                return
+            i = self.new_slot(value, self.floor)
+        if col:
+            self.clicks[i] += n
+        else:
+            self.impressions[i] += n
+
+    def new_slot(self, value, error):
+        if self.capacity is not None and not self.closed and len(self.values) >= self.capacity:
+            self.prune(self.capacity // 2)
+        i = len(self.values)
+        self.index[value] = i
+        self.values.append(value)
+        self.impressions.append(0)
+        self.clicks.append(0)
+        self.errors.append(error)
+        self.finished = False
+        return i
+
+    # keep the keep values with the highest estimated volume, count the rest as other_val
+    def prune(self, keep):
+        volume = [i + c + e for i, c, e in zip(self.impressions, self.clicks, self.errors)]
+        order = sorted(range(len(self.values)), key=volume.__getitem__, reverse=True)
+        for i in order[keep:]:
+            self.other[0] += self.impressions[i]
+            self.other[1] += self.clicks[i]
+            self.floor = max(self.floor, volume[i])
+        order = order[:keep]
+        self.values = [self.values[i] for i in order]
+        self.index = dict([(v, i) for i, v in enumerate(self.values)])
+        self.impressions = array('q', [self.impressions[i] for i in order])
+        self.clicks = array('q', [self.clicks[i] for i in order])
+        self.errors = array('q', [self.errors[i] for i in order])
+
+    # add the counts of another AttrCounter, e.g. from another chunk
+    def merge(self, part):
+        for value, impressions, clicks, error in zip(part.values, part.impressions, part.clicks, part.errors):
+            i = self.index.get(value)
+            if i is None and self.closed:
+                self.other[0] += impressions
+                self.other[1] += clicks
+                continue
+            if i is None:
+                i = self.new_slot(value, self.floor + error)
+            else:
+                self.errors[i] += error
+            self.impressions[i] += impressions
+            self.clicks[i] += clicks
+        self.other[0] += part.other[0]
+        self.other[1] += part.other[1]
+        self.floor += part.floor
+
+    # (value, (impressions, clicks)) pairs, like the items of a counts dict. A
+    # capped counter gives all its candidates, or with keep the top_k of them.
+    def items(self):
+        if self.top_k is not None and self.closed and not self.finished:
+            if len(self.values) > self.top_k:
+                self.prune(self.top_k)
+            self.finished = True
+        return self.all_items()
+
+    # the same without the cut to top_k, for counts that are added up elsewhere
+    # before the cut (e.g. the shards of distributed_pipeline)
+    def all_items(self):
+        for value, impressions, clicks in zip(self.values, self.impressions, self.clicks):
+            if impressions + clicks > 0:
+                yield value, (impressions, clicks)
+        if self.other[0] + self.other[1] > 0:
+            yield other_val, tuple(self.other)
+
+# A conversion table with an other_val entry. Values that are not in the table
+# get the code of other_val.
+class OtherTable(dict):
+
+    def __missing__(self, key):
+        return self[other_val]
+
+# sort the collected counts and write the <attr>_int.csv conversion tables,
+# plus the overall impression/click counts
+def write_int_conversion_tables(cnts, attr_list, impression_cnt, click_cnt, write_totals = True):
     for attr in attr_list:
         attr_cnt_list = []
         attr_cnts = cnts[attr]
         for k,v in attr_cnts.items():
             attr_cnt_list.append([k, v[0], v[1], "{:.6f}".format(v[1]/(v[0]+v[1]))])
-        #attr_cnt_list.sort(key=lambda item: int(item[0]), reverse=False) # sort on attr value
-        if attr in ['day_of_week', 'hour_of_day']:
-            attr_cnt_list.sort(key=lambda item: int(item[0]), reverse=False) # sort on attr value
-        else:
-            attr_cnt_list.sort(key=lambda item: item[0], reverse=False) # sort on attr value           
-        if attr in ['action_id']:
-             attr_cnt_list.sort(key=lambda item: item[0], reverse=True) # sort on attr value           
+        sort_attr_cnt_list(attr, attr_cnt_list)
            
         # add index number to beginning of list        
         for i in range(len(attr_cnt_list)):
@@ -323,58 +1475,243 @@ def create_int_conversion_tables(file_name = problem_name + '_reduced.csv'):
         # write the file
         fname = attr + "_int.csv"
         print("Writing file", fname)
-        f = open(fname, 'w')
+        f = open(fname, 'w', encoding=data_encoding)
         writer = csv.writer(f, delimiter=',')
         for row in attr_cnt_list:
             #print(row)
             writer.writerow(row)
         f.close()
+        write_binary_table(attr + "_int.bin", [row[1] for row in attr_cnt_list])
 
-        # Write impression/click counts
-        f = open(problem_name + "_impression_click_counts.csv", 'w')
+    # Write impression/click counts
+    if write_totals:
+        f = open(problem_name + "_impression_click_counts.csv", 'w', encoding=data_encoding)
         writer = csv.writer(f, delimiter=',')
         writer.writerow([impression_cnt, click_cnt])
         f.close()
         
     print('Impressions:', impression_cnt, 'Clicks:', click_cnt);
-                                          
-# convert data to ints
-def convert_to_ints(infile = problem_name + '_reduced.csv', outfile = problem_name + '_int.csv'):
 
-    fields = read_field_selections(trace=False) # read in the fields to use
-    FieldsNT = read_column_names('_reduced', trace=False)
-
-    # create a list of attributes to sort on
-    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
-    print('fields:', attr_list)
-    
+# sort [value, ...] lists into conversion table order
+def sort_attr_cnt_list(attr, attr_cnt_list):
+    #attr_cnt_list.sort(key=lambda item: int(item[0]), reverse=False) # sort on attr value
+    if attr in ['day_of_week', 'hour_of_day']:
+        attr_cnt_list.sort(key=lambda item: (item[0] == other_val, int(item[0]) if item[0] != other_val else 0)) # sort on attr value, other_val last
+    else:
+        attr_cnt_list.sort(key=lambda item: item[0], reverse=False) # sort on attr value           
+    if attr in ['action_id']:
+         attr_cnt_list.sort(key=lambda item: item[0], reverse=True) # sort on attr value           
+
+# load the <attr>_int.csv conversion tables, value -> int code
+# With table_format='binary' the tables are ConversionTables over <attr>_int.bin.
+def load_int_conversion_tables(attr_list, suffix = ''):
+    if table_format == 'binary':
+        convert = OrderedDict()
+        for attr in attr_list:
+            convert[attr] = ConversionTable(str(attr) + '_int.bin' + suffix)
+        return convert
+    elif table_format != 'csv':
+        raise ValueError("Unknown table format: " + str(table_format))
     convert = OrderedDict()
     for attr in attr_list:
         convert[attr] = OrderedDict()
         
-    # load conversion tables
     for attr in attr_list:
-        name = str(attr) + '_int.csv'
+        name = str(attr) + '_int.csv' + suffix
         print("Reading",name)
-        with open(name, 'r') as f:
+        with open(name, 'r', encoding=data_encoding) as f:
             dataReader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)
             for row in dataReader:
                 #print(row)
                 convert[attr][row[1]] = int(row[0])
+        if other_val in convert[attr]:
+            convert[attr] = OtherTable(convert[attr])
     #print(convert)
+    return convert
+                                          
+# Binary conversion tables. write_int_conversion_tables also writes each table
+# as <attr>_int.bin, which ConversionTable maps into memory, so loading it
+# takes the same time however big the table is. Layout, little-endian:
+#   header:  b'VPCT0001', number of values n, blob size, code of other_val or -1,
+#            number of hash slots m (a power of two, at least 2n)
+#   offsets: n+1 uint64, value i is blob[offsets[i]:offsets[i+1]] (utf-8)
+#   slots:   m uint32, an open addressing hash index: the slot for a value is
+#            crc32(value) & (m-1), probing forward, and holds code+1, 0 if empty
+#   blob:    the values in code order
+table_magic = b'VPCT0001'
+table_header = struct.Struct('<8sQQqQ')
+
+# write values, in code order, as a binary conversion table
+def write_binary_table(file_name, values):
+    encoded = [str(v).encode() for v in values]
+    offsets = array('Q', [0])
+    for v in encoded:
+        offsets.append(offsets[-1] + len(v))
+    m = 2
+    while m < 2 * len(encoded):
+        m *= 2
+    slots = array('I', bytes(4 * m))
+    for code, v in enumerate(encoded):
+        i = zlib.crc32(v) & (m - 1)
+        while slots[i]:
+            i = (i + 1) & (m - 1)
+        slots[i] = code + 1
+    other = values.index(other_val) if other_val in values else -1
+    header = table_header.pack(table_magic, len(encoded), offsets[-1], other, m)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+        slots.byteswap()
+    with open(file_name, 'wb') as f:
+        f.write(header)
+        f.write(offsets.tobytes())
+        f.write(slots.tobytes())
+        for v in encoded:
+            f.write(v)
+
+# A binary conversion table, see write_binary_table. Works like the value -> code
+# dict from load_int_conversion_tables: table[value] encodes with a hash lookup
+# (remembering up to table_memo_size codes) and values missing from a capped
+# table get the code of other_val. decode(code) gives the value back.
+# encode_many and decode_many do whole columns.
+class ConversionTable(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, blob_size, self.other, m = table_header.unpack_from(self.mm, 0)
+        if magic != table_magic:
+            raise ValueError(file_name + " is not a binary conversion table")
+        if sys.byteorder != 'little':
+            raise ValueError("Binary conversion tables are read on little-endian machines only")
+        view = memoryview(self.mm)
+        start = table_header.size
+        self.offsets = view[start:start + 8 * (self.n + 1)].cast('Q')
+        start += 8 * (self.n + 1)
+        self.slots = view[start:start + 4 * m].cast('I')
+        self.mask = m - 1
+        self.blob = start + 4 * m
+        self.memo = dict()
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, value):
+        return self.find(value) is not None
+
+    def __getitem__(self, value):
+        code = self.memo.get(value)
+        if code is None:
+            code = self.find(value)
+            if code is None:
+                if self.other < 0:
+                    raise KeyError(value)
+                code = self.other
+            if len(self.memo) >= table_memo_size:
+                self.memo.clear()
+            self.memo[value] = code
+        return code
+
+    def get(self, value, default = None):
+        code = self.find(value)
+        return default if code is None else code
+
+    # the code of value, or None
+    def find(self, value):
+        key = str(value).encode()
+        i = zlib.crc32(key) & self.mask
+        while True:
+            slot = self.slots[i]
+            if slot == 0:
+                return None
+            code = slot - 1
+            if self.mm[self.blob + self.offsets[code]:self.blob + self.offsets[code + 1]] == key:
+                return code
+            i = (i + 1) & self.mask
+
+    def decode(self, code):
+        if code < 0 or code >= self.n:
+            raise IndexError(code)
+        return self.mm[self.blob + self.offsets[code]:self.blob + self.offsets[code + 1]].decode()
+
+    # codes for a list of values, as strings with as_str. Each distinct value is looked up once.
+    def encode_many(self, values, as_str = False):
+        codes = dict([(v, self[v]) for v in set(values)])
+        if as_str:
+            codes = dict([(v, str(c)) for v, c in codes.items()])
+        return list(map(codes.__getitem__, values))
+
+    def decode_many(self, codes):
+        values = dict([(c, self.decode(int(c))) for c in set(codes)])
+        return list(map(values.__getitem__, codes))
+
+    # (value, code) pairs in code order
+    def items(self):
+        for code in range(self.n):
+            yield self.decode(code), code
+
+    def close(self):
+        self.offsets.release()
+        self.slots.release()
+        self.mm.close()
+
+# convert data to ints
+# With output_format='columnar' the result is written as a columnar directory
+# (see ColumnarWriter) named like outfile with a .col extension.
+# engine='chunked' converts the file in chunks, see convert_chunks_bulk.
+# It writes the same bytes as the default row by row engine.
+@stage()
+def convert_to_ints(infile = None, outfile = None,
+                    output_format = 'csv', engine = 'python'):
+    if infile is None:
+        infile = problem_name + '_reduced' + data_ext
+    if outfile is None:
+        outfile = problem_name + '_int' + data_ext
+
+    fields = read_field_selections(trace=False) # read in the fields to use
+    FieldsNT = read_column_names('_reduced', trace=False)
+
+    # create a list of attributes to sort on
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    print('fields:', attr_list)
+    
+    # load conversion tables
+    convert = load_int_conversion_tables(attr_list)
     
-    output = open(outfile, 'w')
-    writer = csv.writer(output, delimiter=',')
+    if output_format == 'columnar':
+        outfile = strip_data_ext(outfile) + '.col'
+        output = ColumnarWriter(outfile, attr_list + list(fields['data'].keys()), attr_tables=attr_list)
+        writer = output
+    elif engine == 'chunked':
+        output = open_data(outfile, 'w')
+        writer = csv.writer(output, delimiter=',')
+    else:
+        output = RowBatchWriter(outfile)
+        writer = output
     
 
+    if engine == 'chunked':
+        rows = convert_chunks_bulk(infile, output, writer, FieldsNT._fields, attr_list,
+                                   list(fields['data'].keys()), convert, output_format == 'csv')
+        print("Wrote file", outfile)
+        output.close()
+        record_stage(rows, rows, [infile], [outfile])
+        return
+    elif engine != 'python':
+        raise ValueError("Unknown convert engine: " + str(engine))
+
+    plan = compile_field_plan(fields, FieldsNT._fields)
+    attr_tables = [(i, convert[attr]) for i, attr in zip([plan.depvar_index] + plan.attr_indices, attr_list)]
+    project_data = plan.project_data
+
     # read, convert, and write
-    with open(infile, 'r') as f:
-        dataReader = csv.reader(f, delimiter=delim, quoting=csv.QUOTE_NONE)
+    with ReadAheadFile(infile) as f:
+        dataReader = f.rows(delim)
         i = 0
         print("Reading file", infile, end="")
         for row in dataReader:
             i += 1
-            if (i % 1000000 == 0): print('.{}'.format(i // 1000000), end = "")
+            if (i % progress_every == 0): progress(i)
             if i == 1:
                 #writer.writerow(row) # write the header row
                 print("Skipping header row:", row)
@@ -382,16 +1719,14 @@ def convert_to_ints(infile = problem_name + '_reduced.csv', outfile = problem_na
             #if i > 10: break
 
             #print("Row:", row)
-            r = FieldsNT._make(row)
+            if len(row) != plan.num_cols:
+                raise TypeError("Expected {} fields, got {}: {}".format(plan.num_cols, len(row), row))
 
             # convert the depvar and the attributes
-            new_line = []
-            for attr in attr_list:
-                new_line.append(convert[attr][str(getattr(r, attr))])
+            new_line = [table[row[i]] for i, table in attr_tables]
 
             # copy the data fields
-            for k,v in fields['data'].items():
-                new_line.append(getattr(r,k))
+            new_line.extend(project_data(row))
                 
             #print("New:", new_line)
             writer.writerow(new_line)
@@ -399,10 +1734,1022 @@ def convert_to_ints(infile = problem_name + '_reduced.csv', outfile = problem_na
         print("Wrote file", outfile)
     
     output.close()
+    record_stage(i - 1, i - 1, [infile], [outfile])
+
+# Convert the reduced file in chunks of convert_chunk_rows rows. Each chunk is
+# split in one go and sliced into columns, and the converted chunk is written
+# with a single write. Chunks with a ',' or '"' in them go through the csv
+# writer, so the quoting matches convert_to_ints exactly.
+# The attribute columns go through ConversionTable.encode_many, which looks up
+# each distinct value of a chunk once. The binary tables are used when they
+# are there and not older than the csv ones, even with table_format='csv'.
+# Otherwise each value is looked up in the dict, with the codes as strings.
+def convert_chunks_bulk(infile, output, writer, col_names, attr_list, data_names, convert, plain_csv):
+    num_cols = len(col_names)
+    attr_indices = [col_names.index(attr) for attr in attr_list]
+    data_indices = [col_names.index(k) for k in data_names]
+    tables = []
+    opened = [] # binary tables opened here
+    for attr in attr_list:
+        if isinstance(convert[attr], ConversionTable):
+            tables.append(convert[attr])
+            continue
+        bin_name = str(attr) + '_int.bin'
+        if os.path.exists(bin_name) and os.path.getmtime(bin_name) >= os.path.getmtime(str(attr) + '_int.csv'):
+            opened.append(ConversionTable(bin_name))
+            tables.append(opened[-1])
+            continue
+        table = dict([(k, str(v)) for k, v in convert[attr].items()])
+        tables.append(OtherTable(table) if other_val in table else table)
+    try:
+        return convert_chunks(infile, output, writer, num_cols, attr_indices, data_indices, tables, plain_csv)
+    finally:
+        for table in opened:
+            table.close()
+
+def convert_chunks(infile, output, writer, num_cols, attr_indices, data_indices, tables, plain_csv):
+    with open_data(infile, 'r') as f:
+        print("Reading file", infile, end="")
+        header = next(csv.reader([f.readline()], delimiter=delim, quoting=csv.QUOTE_NONE), None)
+        print("Skipping header row:", header)
+        rows_done = 0
+        while True:
+            lines = list(itertools.islice(f, convert_chunk_rows))
+            if not lines:
+                break
+            if set(map(str.count, lines, itertools.repeat(delim))) != {num_cols - 1}:
+                for line in lines:
+                    if line.count(delim) != num_cols - 1:
+                        row = next(csv.reader([line], delimiter=delim, quoting=csv.QUOTE_NONE), [])
+                        raise TypeError("Expected {} fields, got {}: {}".format(num_cols, len(row), row))
+
+            # split the whole chunk at once, then take every num_cols'th field
+            text = ''.join(lines)
+            if text.endswith('\n'):
+                text = text[:-1]
+            flat = text.replace('\n', delim).split(delim)
+            cols = [flat[i::num_cols] for i in range(num_cols)]
+
+            out_cols = [table.encode_many(cols[i], as_str=True) if isinstance(table, ConversionTable)
+                        else list(map(table.__getitem__, cols[i])) for table, i in zip(tables, attr_indices)]
+            out_cols.extend([cols[i] for i in data_indices])
+            if plain_csv and ',' not in text and '"' not in text:
+                output.write('\r\n'.join(map(','.join, zip(*out_cols))))
+                output.write('\r\n')
+            else:
+                writer.writerows(zip(*out_cols))
+
+            rows_done += len(lines)
+            progress(rows_done)
+        print()
+    return rows_done
+
+# Impression/click/CTR tables for pairs of attributes, and for the triples
+# given, from the int file written by convert_to_ints. Writes one
+# <attr1>__<attr2>[__<attr3>].csv per combination into outdir, with the codes
+# of the attributes (see <attr>_int.csv), impressions, clicks and CTR, for the
+# combinations seen at least min_support times.
+# The codes of a combination are packed into one int64 key (mixed radix over
+# the sizes of the conversion tables) and counted by sorting the keys of each
+# chunk, so only the combinations that occur are stored. With processes > 1
+# the chunks are counted in a process pool. attrs defaults to the attributes
+# in the field selection.
+@stage()
+def build_ctr_cube(infile = None, attrs = None, triples = (), min_support = None,
+                   processes = 1, outdir = problem_name + '_cube', action_name = 'action_id'):
+    if infile is None:
+        infile = problem_name + '_int' + data_ext
+    if min_support is None:
+        min_support = cube_min_support
+    fields = read_field_selections(trace=False) # read in the fields to use
+    col_names = [fields['depvar_name']] + list(fields['attrs'].keys()) + list(fields['data'].keys())
+    if attrs is None:
+        attrs = list(fields['attrs'].keys())
+    combos = list(itertools.combinations(attrs, 2)) + [tuple(t) for t in triples]
+    sizes = dict([(attr, count_lines(attr + '_int.csv')) for attr in set(itertools.chain(*combos))])
+    for combo in combos:
+        if np.prod([float(sizes[attr]) for attr in combo]) >= 2 ** 63:
+            raise ValueError("Too many values to pack into an int64 key: " + ', '.join(combo))
+    plans = [([col_names.index(attr) for attr in combo], [sizes[attr] for attr in combo]) for combo in combos]
+    action_index, impression_value = find_impression_column(fields, action_name)
+
+    if processes > 1 and data_codec(infile) is not None:
+        print("Counting", infile, "in one process, compressed files can't be split into chunks")
+        processes = 1
+    cube = [None] * len(combos)
+    rows = 0
+    if processes > 1:
+        chunks = find_chunk_offsets(infile, processes * 4, skip_header=False)
+        print("Counting", infile, "in", len(chunks), "chunks on", processes, "processes", end="")
+        jobs = [(infile, start, end, len(col_names), action_index, impression_value, plans) for start, end in chunks]
+        with multiprocessing.Pool(processes) as pool:
+            for part_rows, part in pool.imap_unordered(cube_chunk, jobs):
+                print('.', end="")
+                rows += part_rows
+                cube = [merge_key_counts(c, p) for c, p in zip(cube, part)]
+    else:
+        print("Reading file", infile, end="")
+        with open_data(infile, 'r') as f:
+            while True:
+                lines = list(itertools.islice(f, cube_chunk_rows))
+                if not lines:
+                    break
+                part = count_cube_lines(lines, len(col_names), action_index, impression_value, plans)
+                cube = [merge_key_counts(c, p) for c, p in zip(cube, part)]
+                rows += len(lines)
+                progress(rows)
+    print()
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    outputs = []
+    written = 0
+    for combo, (indices, radix), counts in zip(combos, plans, cube):
+        file_name = os.path.join(outdir, '__'.join(combo) + '.csv')
+        written += write_cube_table(file_name, combo, radix, counts, min_support)
+        outputs.append(file_name)
+    record_stage(rows, written, [infile], outputs)
+    return outputs
+
+# count the combinations in one chunk of the int file. Runs in a worker process.
+def cube_chunk(job):
+    file_name, start, end, num_cols, action_index, impression_value, plans = job
+    lines = list(read_chunk_lines(file_name, start, end))
+    return len(lines), count_cube_lines(lines, num_cols, action_index, impression_value, plans)
+
+# Count each combination in plans over lines of the int file. Returns a
+# (keys, impressions, clicks) triple of arrays per combination, keys sorted.
+# A row is an impression when its action column is impression_value, the code
+# of 'impression' when the action is an attribute (see find_impression_column).
+def count_cube_lines(lines, num_cols, action_index, impression_value, plans):
+    text = ''.join(lines)
+    if not lines:
+        cols = [[] for i in range(num_cols)]
+    elif '"' in text:
+        rows = list(csv.reader(lines, delimiter=','))
+        cols = [[row[i] for row in rows] for i in range(num_cols)]
+    else:
+        flat = text.replace('\r\n', '\n').rstrip('\n').replace('\n', ',').split(',')
+        if len(flat) != num_cols * len(lines):
+            raise TypeError("Expected {} fields in each of {} lines".format(num_cols, len(lines)))
+        cols = [flat[i::num_cols] for i in range(num_cols)]
+    codes = dict()
+    for indices, radix in plans:
+        for i in indices:
+            if i not in codes:
+                codes[i] = np.array(cols[i], dtype=np.int64)
+    clicks = np.array(cols[action_index]) != impression_value
+
+    part = []
+    for indices, radix in plans:
+        key = codes[indices[0]].copy()
+        for i, n in zip(indices[1:], radix[1:]):
+            key *= n
+            key += codes[i]
+        part.append(sum_by_key(key, clicks))
+    return part
+
+# sort keys and add up the rows (impressions) and clicks of each distinct key
+def sum_by_key(keys, clicks, impressions = None):
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    clicks = clicks[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    if impressions is None:
+        click_sums = np.add.reduceat(clicks.astype(np.int64), starts)
+        impression_sums = np.diff(np.append(starts, len(keys))) - click_sums
+    else:
+        impressions = impressions[order]
+        click_sums = np.add.reduceat(clicks, starts)
+        impression_sums = np.add.reduceat(impressions, starts)
+    return keys[starts], impression_sums, click_sums
+
+# add the (keys, impressions, clicks) counts of part into counts
+def merge_key_counts(counts, part):
+    if counts is None:
+        return part
+    return sum_by_key(np.concatenate((counts[0], part[0])), np.concatenate((counts[2], part[2])),
+                      np.concatenate((counts[1], part[1])))
+
+# write one cube table: the attribute codes, impressions, clicks and CTR of
+# the keys with at least min_support impressions + clicks
+def write_cube_table(file_name, combo, radix, counts, min_support):
+    keys, impressions, clicks = counts if counts is not None else (np.zeros(0, dtype=np.int64),) * 3
+    keep = impressions + clicks >= min_support
+    keys, impressions, clicks = keys[keep], impressions[keep], clicks[keep]
+    codes = []
+    for n in reversed(radix):
+        keys, c = np.divmod(keys, n)
+        codes.append(c)
+    codes.reverse()
+    print("Writing file", file_name, "with", len(impressions), "rows")
+    with open(file_name, 'w', newline='', encoding=data_encoding) as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(list(combo) + ['impressions', 'clicks', 'ctr'])
+        for row in zip(*(codes + [impressions, clicks])):
+            row = [int(v) for v in row]
+            writer.writerow(row + ["{:.6f}".format(row[-1] / (row[-2] + row[-1]))])
+    return len(impressions)
+
+# Columnar binary format for the int coded data. A dataset is a directory with
+# one <field>.bin file per column, holding a fixed width little-endian array,
+# and a header.json with the row count and schema. Attribute columns hold the
+# codes from <attr>_int.csv in the smallest int type that fits the table. The
+# data may have been converted against another version of the table, so a code
+# column is widened when a code doesn't fit and the header has the type the
+# codes actually needed.
+# Integer data columns are int64. Other data columns are dictionary coded:
+# int32 codes into the value list stored in <field>.values.json.
+# Read it back with open_columnar, which uses numpy.memmap.
+# A data column is inferred as int from the first chunk only if its values are
+# ints written the way str(int) writes them (no '0123' or '+1'), and is
+# widened to dictionary coded when a later value isn't one. The values already
+# written are then the strings of their ints, which are the strings read. The dataset is
+# written to path.tmp and renamed to path by close(), so a failed write never
+# leaves a partial dataset at path.
+class ColumnarWriter(object):
+
+    def __init__(self, path, names, attr_tables = (), dtypes = None, chunk_rows = None):
+        self.path = path
+        self.names = list(names)
+        self.chunk_rows = chunk_rows or columnar_chunk_rows
+        self.rows = 0
+        self.buf = []
+        self.columns = []
+        for i, name in enumerate(self.names):
+            col = {'name': name, 'file': name + '.bin'}
+            if name in attr_tables:
+                col['kind'] = 'code'
+                col['table'] = name + '_int.csv'
+                col['dtype'] = smallest_code_dtype(count_lines(col['table']))
+            elif dtypes is not None and dtypes.get(name) is not None:
+                col['kind'] = 'dict' if dtypes[name] == 'dict' else 'int'
+                col['dtype'] = 'int32' if dtypes[name] == 'dict' else dtypes[name]
+            else:
+                col['kind'] = None # decided from the first chunk
+            self.columns.append(col)
+        self.inferred = set() # columns whose kind was decided from the first chunk
+        self.dicts = [dict() for name in self.names]
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.files = [open(os.path.join(self.tmp_path, col['file']), 'wb') for col in self.columns]
+        print('Writing columnar dataset', path)
+
+    def writerow(self, row):
+        self.buf.append(row)
+        if len(self.buf) >= self.chunk_rows:
+            try:
+                self.flush()
+            except BaseException:
+                self.abort()
+                raise
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if not self.buf:
+            return
+        n = len(self.buf)
+        for i, values in enumerate(zip(*self.buf)):
+            col = self.columns[i]
+            if col['kind'] is None:
+                infer_column_kind(col, values)
+                self.inferred.add(i)
+            if col['kind'] == 'int' and i in self.inferred and not all([is_plain_int(v) for v in values]):
+                self.widen_to_dict(i)
+            if col['kind'] == 'dict':
+                d = self.dicts[i]
+                codes = []
+                for v in values:
+                    c = d.get(v)
+                    if c is None:
+                        c = d[v] = len(d)
+                    codes.append(c)
+                values = codes
+            try:
+                values = [int(v) for v in values]
+            except ValueError:
+                raise ValueError("Column {} is not an integer column, row {}".format(col['name'], self.rows + 1))
+            if col['kind'] == 'code':
+                lo = min(values)
+                hi = max(values)
+                if lo < 0 or hi > np.iinfo(col['dtype']).max:
+                    self.widen_codes(i, 'int64' if lo < 0 else smallest_code_dtype(hi + 1))
+            arr = np.array(values, dtype=col['dtype'])
+            self.files[i].write(arr.astype(np.dtype(col['dtype']).newbyteorder('<'), copy=False).tobytes())
+        self.rows += n
+        self.buf = []
+
+    # recode an inferred int column as a dictionary coded one, the values
+    # already written become the strings of those ints
+    def widen_to_dict(self, i):
+        col = self.columns[i]
+        print("Column", col['name'], "has values that aren't ints, storing it dictionary coded")
+        file_name = os.path.join(self.tmp_path, col['file'])
+        self.files[i].close()
+        d = self.dicts[i]
+        with open(file_name, 'rb') as old, open(file_name + '.widen', 'wb') as new:
+            while True:
+                ints = np.fromfile(old, dtype='<i8', count=self.chunk_rows)
+                if len(ints) == 0:
+                    break
+                codes = []
+                for v in map(str, ints.tolist()):
+                    c = d.get(v)
+                    if c is None:
+                        c = d[v] = len(d)
+                    codes.append(c)
+                new.write(np.array(codes, dtype='<i4').tobytes())
+        os.replace(file_name + '.widen', file_name)
+        self.files[i] = open(file_name, 'ab')
+        col['kind'] = 'dict'
+        col['dtype'] = 'int32'
+
+    # rewrite the codes already written to a code column in a wider int type
+    def widen_codes(self, i, dtype):
+        col = self.columns[i]
+        print("Column", col['name'], "has codes beyond its table, storing it as", dtype)
+        file_name = os.path.join(self.tmp_path, col['file'])
+        self.files[i].close()
+        with open(file_name, 'rb') as old, open(file_name + '.widen', 'wb') as new:
+            while True:
+                codes = np.fromfile(old, dtype=np.dtype(col['dtype']).newbyteorder('<'), count=self.chunk_rows)
+                if len(codes) == 0:
+                    break
+                new.write(codes.astype(np.dtype(dtype).newbyteorder('<')).tobytes())
+        os.replace(file_name + '.widen', file_name)
+        self.files[i] = open(file_name, 'ab')
+        col['dtype'] = dtype
+
+    def close(self):
+        try:
+            self.flush()
+        except BaseException:
+            self.abort()
+            raise
+        for f in self.files:
+            f.close()
+        for i, col in enumerate(self.columns):
+            if col['kind'] is None: # no rows
+                col['kind'] = 'int'
+                col['dtype'] = 'int64'
+            if col['kind'] == 'dict':
+                col['values'] = col['name'] + '.values.json'
+                values = sorted(self.dicts[i], key=self.dicts[i].get)
+                with open(os.path.join(self.tmp_path, col['values']), 'w') as f:
+                    json.dump(values, f)
+        header = {'rows': self.rows, 'byteorder': 'little', 'columns': self.columns}
+        with open(os.path.join(self.tmp_path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+        print('Wrote {:,} rows to {}'.format(self.rows, self.path))
+
+    # close the files and remove what was written
+    def abort(self):
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+# set the kind of a data column from its first values: int64 if they are all plain integers
+def infer_column_kind(col, values):
+    if all([is_plain_int(v) for v in values]):
+        col['kind'] = 'int'
+        col['dtype'] = 'int64'
+    else:
+        col['kind'] = 'dict'
+        col['dtype'] = 'int32'
+
+# True if v is an int written as str(int) writes it, so it can be given back from the int
+def is_plain_int(v):
+    s = str(v)
+    try:
+        return str(int(s)) == s
+    except ValueError:
+        return False
+
+# smallest unsigned int type that holds n codes
+def smallest_code_dtype(n):
+    for dtype in ['uint8', 'uint16', 'uint32']:
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return 'int64'
+
+def count_lines(file_name):
+    with open(file_name, 'rb') as f:
+        return sum([1 for line in f])
+
+# convert an existing name_int.csv to the columnar format
+@stage()
+def int_csv_to_columnar(infile = None, outdir = problem_name + '_int.col'):
+    if infile is None:
+        infile = problem_name + '_int' + data_ext
+    fields = read_field_selections(trace=False) # read in the fields to use
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    writer = ColumnarWriter(outdir, attr_list + list(fields['data'].keys()), attr_tables=attr_list)
+    print("Reading file", infile)
+    with open_data(infile, 'r') as f:
+        writer.writerows(csv.reader(f, delimiter=','))
+    writer.close()
+    record_stage(writer.rows, writer.rows, [infile], [outdir])
+
+def read_columnar_header(path):
+    with open(os.path.join(path, 'header.json'), 'r') as f:
+        return json.load(f)
+
+# Open the columns of a columnar dataset without reading them into memory.
+# Returns an OrderedDict of column name -> read only numpy.memmap.
+def open_columnar(path, columns = None):
+    header = read_columnar_header(path)
+    arrays = OrderedDict()
+    for col in header['columns']:
+        if columns is not None and col['name'] not in columns:
+            continue
+        dtype = np.dtype(col['dtype']).newbyteorder('<')
+        if header['rows'] == 0:
+            arrays[col['name']] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[col['name']] = np.memmap(os.path.join(path, col['file']), dtype=dtype, mode='r',
+                                            shape=(header['rows'],))
+    return arrays
+
+# the values of a dictionary coded column, indexed by code
+def columnar_values(path, name):
+    header = read_columnar_header(path)
+    for col in header['columns']:
+        if col['name'] == name:
+            if col['kind'] != 'dict':
+                raise ValueError(name + " is not a dictionary coded column")
+            with open(os.path.join(path, col['values']), 'r') as f:
+                return json.load(f)
+    raise KeyError(name)
+
+# Streaming pipeline. Each stage below is a generator that takes an iterator of
+# rows and yields rows, so standardize, filter/reduce and int conversion can be
+# chained over one read of the downloaded file. The first row through each stage
+# is the header. Counts for the summary are kept in the stats dict.
+
+# standardize: skip lines with the wrong number of columns and strip the fields
+def stream_standardize(rows, stats):
+    target_cnt = None
+    for row in rows:
+        stats['read'] += 1
+        if target_cnt is None:
+            target_cnt = len(row)
+            print("Number of columns found:", target_cnt)
+        if len(row) != target_cnt:
+            continue
+        stats['standardized'] += 1
+        yield [s.strip() for s in row]
+
+# reduce: drop filtered rows and keep only the depvar, attrs and data fields
+def stream_reduce(rows, fields, stats, filter_name = 'action_id', filter_value = 'click'):
+    header = None
+    for row in rows:
+        if header is None:
+            header = row
+            plan = compile_field_plan(fields, header, filter_name)
+            filter_index = plan.filter_index
+            project = plan.project
+            stats['reduced'] += 1
+            yield list(project(header))
+            continue
+        if len(row) != plan.num_cols:
+            print("Wrong number of columns:", row)
+            sys.exit()
+        if row[filter_index] == filter_value: continue
+        stats['reduced'] += 1
+        yield project(row)
+
+# count: collect the [impressions, clicks] per attribute value, pass rows through
+def stream_count(rows, attr_list, cnts, stats, action_name = 'action_id'):
+    first = True
+    for row in rows:
+        if first:
+            first = False
+            count_row = make_row_counter([cnts[attr] for attr in attr_list], [row.index(attr) for attr in attr_list])
+            action_index = row.index(action_name)
+            yield row
+            continue
+        if row[action_index] == 'impression':
+            stats['impressions'] += 1
+            col = 0
+        else:
+            stats['clicks'] += 1
+            col = 1
+        count_row(row, col)
+        yield row
+
+# int conversion: map the depvar and the attributes to ints, drop the header
+def stream_to_ints(rows, attr_list, convert, stats):
+    first = True
+    for row in rows:
+        if first:
+            first = False
+            num_attrs = len(attr_list)
+            tables = [convert[attr] for attr in attr_list]
+            continue
+        new_line = [t[v] for t, v in zip(tables, row)]
+        new_line.extend(row[num_attrs:])
+        stats['converted'] += 1
+        yield new_line
+
+# write each row to a file as it passes through
+def stream_write(rows, writer):
+    for row in rows:
+        writer.writerow(row)
+        yield row
+
+# run a stream to the end, writing it to a csv file
+def drain_to_csv(rows, outfile_name, delimiter):
+    print('Writing file', outfile_name)
+    with open_data(outfile_name, 'w') as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        i = 0
+        for row in rows:
+            i += 1
+            if (i % progress_every == 0): progress(i)
+            writer.writerow(row)
+    print()
+
+# Run standardize_file, reduce_file, create_int_conversion_tables and
+# convert_to_ints as one stream over the downloaded file.
+# If the <attr>_int.csv tables already exist (use_existing_tables=True) this is a
+# single read of the download. Otherwise the tables depend on counts over the
+# whole file, so the first pass writes name_reduced.csv while counting and the
+# second pass converts it. With count_top_k the first pass's counts are only a
+# sketch, so the reduced file is read once more in between to recount the top
+# values exactly, as create_int_conversion_tables does.
+# name_raw.csv is only written with write_intermediates.
+@stage()
+def run_pipeline_streaming(infile_name = problem_name + '_download.csv', outfile_name = None,
+                           write_intermediates = False, use_existing_tables = False):
+    if outfile_name is None:
+        outfile_name = problem_name + '_int' + data_ext
+    fields = read_field_selections(trace=False) # read in the fields to use
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    print('fields:', attr_list)
+
+    raw_name = problem_name + '_raw' + data_ext
+    reduced_name = problem_name + '_reduced' + data_ext
+    stats = dict.fromkeys(['read', 'standardized', 'reduced', 'impressions', 'clicks', 'converted'], 0)
+    open_files = []
+
+    print('Reading file', infile_name)
+    infile = open_data(infile_name, 'r')
+    open_files.append(infile)
+    rows = csv.reader(infile, delimiter=delim, quoting=csv.QUOTE_NONE)
+    rows = stream_standardize(rows, stats)
+    if write_intermediates:
+        f = open_data(raw_name, 'w')
+        open_files.append(f)
+        print('Writing file', raw_name)
+        rows = stream_write(rows, csv.writer(f, delimiter=';'))
+    rows = stream_reduce(rows, fields, stats)
+
+    if use_existing_tables:
+        convert = load_int_conversion_tables(attr_list)
+        if write_intermediates:
+            f = open_data(reduced_name, 'w')
+            open_files.append(f)
+            print('Writing file', reduced_name)
+            rows = stream_write(rows, csv.writer(f, delimiter=';'))
+        else:
+            # later stages read the column names from the reduced file header,
+            # kept in a sidecar so an existing reduced file isn't overwritten
+            rows = stream_header_only(rows, header_file_name(reduced_name))
+        rows = stream_to_ints(rows, attr_list, convert, stats)
+        drain_to_csv(rows, outfile_name, ',')
+    else:
+        cnts = new_attr_counts(attr_list)
+        rows = stream_count(rows, attr_list, cnts, stats)
+        drain_to_csv(rows, reduced_name, ';')
+        if count_top_k is not None:
+            FieldsNT = read_column_names('_reduced', trace=False)
+            cnts = recount_top_values(reduced_name, FieldsNT._fields, attr_list, cnts)[0]
+        write_int_conversion_tables(cnts, attr_list, stats['impressions'], stats['clicks'])
+
+    for f in open_files:
+        f.close()
+    if not use_existing_tables:
+        convert_to_ints(reduced_name, outfile_name)
+
+    print((stats['read'], stats['standardized'], stats['read'] - stats['standardized']), "lines (read, written, diff) standardize")
+    print((stats['standardized'], stats['reduced'], stats['standardized'] - stats['reduced']), "lines (read, written, diff) reduce")
+    record_stage(stats['read'], stats['reduced'], [infile_name], [outfile_name])
+    return stats
+
+# write only the header row of a stream to a file
+def stream_header_only(rows, outfile_name):
+    first = True
+    for row in rows:
+        if first:
+            first = False
+            with open(outfile_name, 'w', encoding=data_encoding) as f:
+                csv.writer(f, delimiter=';').writerow(row)
+        yield row
+
+# name_reduced.csv.gz -> name_reduced_header.csv, the header sidecar of a data file
+def header_file_name(file_name):
+    return strip_data_ext(file_name) + '_header.csv'
+
+# Incremental processing for downloads that only ever grow at the end.
+# run_incremental keeps a checkpoint (name_checkpoint.json) with the byte
+# offset and row count reached in the download and the size and row count of
+# each file it appends to. Each run only reads the new tail of the download:
+#  - new rows are standardized, filtered and reduced into the plain temp file
+#    name_reduced_new.csv, and counted
+#  - their counts are added to the <attr>_int.csv tables. Values that are new
+#    get the next free codes (or count as other_val in a capped table), so
+#    existing codes never change
+#  - the new rows are appended to name_reduced and, converted, to name_int.
+#    They are sorted by time like sort_by_time, split into tst and trn and
+#    appended to name_tst_unsorted and name_trn_unsorted
+#  - the new trn rows are compressed with copies and merged into name_trn.csv
+#    by merge_copies_file, which only parses the lines around them
+# The split is split_into_tst_trn's 'time' mode with a time_cutoff or its
+# 'hash' mode on key_column, which look at each row alone. The time prefix
+# split needs the whole file, so it can't be done incrementally.
+# The first run (no checkpoint) starts all these files afresh, and writes the
+# same files as standardize_file through compress_with_copies('trn') with that
+# split, apart from the sorted and raw intermediates. Later runs keep the codes
+# of the first, so their files differ from a full run's only in the codes.
+# The appended files get data_ext like the full pipeline's. A compressed one
+# gets a new gzip member (zstd or lz4 frame) each run, so it can still be cut
+# back to the checkpoint. The download must be a plain file.
+# Tables, counts and name_trn.csv are written to temp files and renamed in
+# once the checkpoint records them, so an interrupted run can be rerun safely.
+@stage()
+def run_incremental(infile_name = problem_name + '_download.csv', time_cutoff = None, key_column = None,
+                    tst_fraction = 0.2, seed = '', time_name = 'created_at',
+                    checkpoint_name = problem_name + '_checkpoint.json'):
+    fields = read_field_selections(trace=False) # read in the fields to use
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    col_names = attr_list + list(fields['data'].keys())
+    num_attrs = len(attr_list)
+    reduced_name = problem_name + '_reduced' + data_ext
+    int_name = problem_name + '_int' + data_ext
+    tst_name = problem_name + '_tst_unsorted' + data_ext
+    trn_name = problem_name + '_trn_unsorted' + data_ext
+    compressed_name = problem_name + '_trn.csv'
+    new_name = problem_name + '_reduced_new.csv'
+    new_int_name = problem_name + '_int_new.csv'
+    new_sorted_name = problem_name + '_int_new_sorted.csv'
+    appended = [reduced_name, int_name, tst_name, trn_name]
+
+    split = {'time_cutoff': time_cutoff, 'key_column': key_column, 'tst_fraction': tst_fraction, 'seed': seed,
+             'time_name': time_name}
+    cp = load_checkpoint(checkpoint_name)
+    first_run = cp is None
+    if first_run:
+        if time_cutoff is None and key_column is None:
+            raise ValueError("run_incremental needs a time_cutoff or a key_column to split tst and trn")
+        cp = {'download': {'file': infile_name, 'offset': 0, 'rows': 0, 'header': None},
+              'split': split,
+              'files': dict([(name, {'offset': 0, 'rows': 0}) for name in appended]),
+              'compress': {'rows_in': 0, 'rows_out': 0}}
+    elif (time_cutoff is not None or key_column is not None) and split != cp['split']:
+        raise ValueError("The split differs from the checkpoint's, rerun the full pipeline to change it")
+    elif sorted(cp['files']) != sorted(appended):
+        raise ValueError("data_ext differs from the checkpoint's, rerun the full pipeline to change it")
+    split = cp['split']
+    in_test = make_split_test(col_names, split['time_cutoff'], split['time_name'], split['key_column'],
+                              split['tst_fraction'], split['seed'])
+
+    # drop anything an interrupted run appended after the checkpoint
+    for name in appended:
+        offset = cp['files'][name]['offset']
+        if os.path.exists(name) and os.path.getsize(name) > offset:
+            print("Truncating", name, "to checkpoint offset", offset)
+            with open(name, 'r+b') as f:
+                f.truncate(offset)
+        elif offset > 0 and (not os.path.exists(name) or os.path.getsize(name) < offset):
+            raise ValueError(name + " is shorter than the checkpoint, rerun the full pipeline")
+
+    if data_codec(infile_name) is not None:
+        raise ValueError("run_incremental reads the download at byte offsets, it can't be compressed: " + infile_name)
+    start = cp['download']['offset']
+    size = os.path.getsize(infile_name)
+    if size < start:
+        raise ValueError(infile_name + " is shorter than the checkpoint, rerun the full pipeline")
+    print("Reading {} from byte {:,} ({:,} new bytes)".format(infile_name, start, size - start))
+
+    # standardize, filter and reduce the new rows into new_name, and count them.
+    # Later runs count exactly; new values of a capped table become other_val
+    # in update_int_conversion_tables.
+    stats = dict.fromkeys(['read', 'standardized', 'reduced', 'impressions', 'clicks', 'tst', 'trn'], 0)
+    if first_run:
+        cnts = new_attr_counts(attr_list)
+    else:
+        cnts = dict([(attr, new_attr_counter(count_backend)) for attr in attr_list])
+    count_row = make_row_counter([cnts[attr] for attr in attr_list], list(range(num_attrs)))
+    header = cp['download']['header']
+    plan = compile_field_plan(fields, header) if header is not None else None
+    offset = start
+    with open(new_name, 'w', encoding=data_encoding) as out:
+        writer = csv.writer(out, delimiter=';')
+        if header is not None:
+            writer.writerow(plan.project(header))
+        for line in read_complete_lines(infile_name, start):
+            offset += len(line)
+            row = next(csv.reader([line.decode(data_encoding)], delimiter=delim, quoting=csv.QUOTE_NONE), [])
+            stats['read'] += 1
+            if header is None:
+                header = [v.strip() for v in row]
+                plan = compile_field_plan(fields, header)
+                writer.writerow(plan.project(header))
+                continue
+            if len(row) != plan.num_cols:
+                continue
+            stats['standardized'] += 1
+            row = [v.strip() for v in row]
+            if row[plan.filter_index] == 'click': continue
+            new_line = plan.project(row)
+            writer.writerow(new_line)
+            stats['reduced'] += 1
+
+            # count the depvar and attributes
+            if row[plan.filter_index] == 'impression':
+                stats['impressions'] += 1
+                count_row(new_line, 0)
+            else:
+                stats['clicks'] += 1
+                count_row(new_line, 1)
+    print((stats['read'], stats['reduced'], stats['read'] - stats['reduced']), "lines (read, written, diff)")
+    if header is None or (stats['reduced'] == 0 and not first_run):
+        os.remove(new_name)
+        if not first_run:
+            cp['download']['offset'] = offset
+            cp['download']['rows'] += stats['read']
+            save_checkpoint(cp, checkpoint_name)
+        print("No new rows")
+        return stats
+    reduced_header = plan.project(header)
+
+    pending = []
+    if first_run:
+        if count_top_k is not None:
+            cnts = recount_top_values(new_name, reduced_header, attr_list, cnts)[0]
+        write_int_conversion_tables(cnts, attr_list, stats['impressions'], stats['clicks'])
+    else:
+        pending.extend(update_int_conversion_tables(cnts, attr_list, stats['impressions'], stats['clicks']))
+
+    # append the new reduced rows to the reduced file, and convert them into
+    # the int file and new_int_name
+    convert = load_int_conversion_tables(attr_list, '' if first_run else '.tmp')
+    tables = [convert[attr] for attr in attr_list]
+    with open(new_name, 'rb') as f:
+        reduced_start = len(f.readline())
+    converted = 0
+    with open_data(reduced_name, 'a') as reduced_out, open_data(int_name, 'a') as int_out, \
+            open(new_int_name, 'w', encoding=data_encoding) as new_int_out:
+        reduced_writer = csv.writer(reduced_out, delimiter=';')
+        int_writer = csv.writer(int_out, delimiter=',')
+        new_int_writer = csv.writer(new_int_out, delimiter=',')
+        if first_run:
+            reduced_writer.writerow(reduced_header)
+        dataReader = csv.reader(read_chunk_lines(new_name, reduced_start, os.path.getsize(new_name)),
+                                delimiter=delim, quoting=csv.QUOTE_NONE)
+        for row in dataReader:
+            reduced_writer.writerow(row)
+            new_line = [t[v] for t, v in zip(tables, row)]
+            new_line.extend(row[num_attrs:])
+            int_writer.writerow(new_line)
+            new_int_writer.writerow(new_line)
+            converted += 1
+    print("Appended {:,} rows to {} and {}".format(converted, reduced_name, int_name))
+
+    # sort the new rows by time, split them into tst and trn, and merge the
+    # trn rows, compressed with copies, into the compressed file
+    external_sort(new_int_name, new_sorted_name, sort_key_columns(attrs=False, time=split['time_name']))
+    time_index = col_names.index(split['time_name'])
+    newer = lambda row, old: negative_timestamp_key(row[time_index]) < negative_timestamp_key(old[time_index])
+    compressed_tmp = compressed_name + '.tmp'
+    with open_data(tst_name, 'a') as tst_out, open_data(trn_name, 'a') as trn_out:
+        tst_writer = csv.writer(tst_out, delimiter=',')
+        trn_writer = csv.writer(trn_out, delimiter=',')
+        def split_rows(rows):
+            for row in rows:
+                if in_test(row):
+                    tst_writer.writerow(row)
+                    stats['tst'] += 1
+                else:
+                    trn_writer.writerow(row)
+                    stats['trn'] += 1
+                    yield row
+        with open(new_sorted_name, 'r', encoding=data_encoding) as f:
+            rows = split_rows(csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE))
+            new_rows = hash_aggregate(rows, num_attrs + 1, hash_memory_mb) #all attrs, plus the action
+            inserted = merge_copies_file(None if first_run else compressed_name, new_rows, compressed_tmp,
+                                         num_attrs + 1, newer)
+    pending.append((compressed_tmp, compressed_name))
+    print("Split {:,} new rows into {:,} tst and {:,} trn".format(converted, stats['tst'], stats['trn']))
+    print("Merged {:,} new trn rows into {} ({:,} new rows)".format(stats['trn'], compressed_name, inserted))
+
+    # record the new offsets and the files to rename, then rename them
+    cp['download']['offset'] = offset
+    cp['download']['rows'] += stats['read']
+    cp['download']['header'] = header
+    for name, rows in [(reduced_name, converted), (int_name, converted), (tst_name, stats['tst']),
+                       (trn_name, stats['trn'])]:
+        cp['files'][name]['offset'] = os.path.getsize(name)
+        cp['files'][name]['rows'] += rows
+    cp['compress']['rows_in'] += stats['trn']
+    cp['compress']['rows_out'] += inserted
+    cp['pending'] = pending
+    save_checkpoint(cp, checkpoint_name)
+    finish_checkpoint(cp, checkpoint_name)
+    for name in [new_name, new_int_name, new_sorted_name]:
+        os.remove(name)
+    record_stage(stats['read'], converted, [infile_name], appended + [compressed_name])
+    return stats
+
+# Merge rows compressed with copies, in the order hash_aggregate gives them,
+# into file_name, a compress_with_copies output in the same order, writing
+# outfile_name. The place of each new row is found by galloping and then
+# bisecting over the byte offsets of file_name, and the lines in between are
+# copied as they are, so only the lines near the new rows are parsed. A new
+# row whose key (its first key_len columns) is already there adds its copies
+# to that line, which keeps its other columns unless prefer(new row, old row)
+# is True. file_name None is an empty file. Returns the number of new lines.
+def merge_copies_file(file_name, rows, outfile_name, key_len, prefer = None):
+    size = os.path.getsize(file_name) if file_name is not None else 0
+    f = open(file_name, 'rb') if file_name is not None else io.BytesIO()
+    parse = lambda line: next(csv.reader([line.decode(data_encoding)], delimiter=',', quoting=csv.QUOTE_NONE))
+    line_buf = io.StringIO()
+    line_writer = csv.writer(line_buf, delimiter=',')
+    key = None
+
+    # the first line start at or after offset
+    def line_start(offset):
+        if offset <= 0:
+            return 0
+        if offset >= size:
+            return size
+        f.seek(offset - 1)
+        f.readline()
+        return f.tell()
+
+    # the first line at or after the line start lo whose key isn't below k
+    def find(k, lo):
+        step = 1 << 12
+        hi = lo
+        while hi < size:
+            f.seek(hi)
+            line = f.readline()
+            if key(parse(line)) >= k:
+                break
+            lo = hi + len(line)
+            hi = line_start(lo + step)
+            step *= 2
+        while lo < hi:
+            start = line_start((lo + hi) // 2)
+            if start >= hi:
+                start = lo
+            f.seek(start)
+            line = f.readline()
+            if key(parse(line)) < k:
+                lo = start + len(line)
+            else:
+                hi = start
+        return lo
+
+    def copy_lines(out, start, end):
+        f.seek(start)
+        while start < end:
+            block = f.read(min(1 << 20, end - start))
+            if not block:
+                break
+            out.write(block)
+            start += len(block)
+
+    def write_row(out, row):
+        line_buf.seek(0)
+        line_buf.truncate()
+        line_writer.writerow(row)
+        out.write(line_buf.getvalue().encode(data_encoding))
+
+    inserted = 0
+    pos = 0
+    try:
+        with open(outfile_name, 'wb') as out:
+            for row in rows:
+                if key is None:
+                    key = make_sort_key([(i, False) for i in range(key_len)], row)
+                at = find(key(row), pos)
+                copy_lines(out, pos, at)
+                pos = at
+                old = None
+                if at < size:
+                    f.seek(at)
+                    line = f.readline()
+                    old = parse(line)
+                if old is not None and old[:key_len] == row[:key_len]:
+                    kept = row if prefer is not None and prefer(row, old) else old
+                    write_row(out, kept[:-1] + [int(old[-1]) + int(row[-1])])
+                    pos = at + len(line)
+                else:
+                    write_row(out, row)
+                    inserted += 1
+            copy_lines(out, pos, size)
+    finally:
+        f.close()
+    return inserted
+
+# Read a checkpoint. Renames recorded by a run that stopped before finishing
+# them are done first.
+def load_checkpoint(checkpoint_name):
+    if not os.path.exists(checkpoint_name):
+        return None
+    with open(checkpoint_name, 'r') as f:
+        cp = json.load(f)
+    if cp.get('pending'):
+        finish_checkpoint(cp, checkpoint_name)
+    return cp
+
+def save_checkpoint(cp, checkpoint_name):
+    tmp_name = checkpoint_name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(cp, f, indent=1)
+    os.replace(tmp_name, checkpoint_name)
+
+# rename the temp files recorded in the checkpoint into place
+def finish_checkpoint(cp, checkpoint_name):
+    for tmp_name, final_name in cp.get('pending', []):
+        if os.path.exists(tmp_name):
+            os.replace(tmp_name, final_name)
+    cp['pending'] = []
+    save_checkpoint(cp, checkpoint_name)
+
+# read the complete lines (ending in a newline) of a file from a byte offset, as bytes
+def read_complete_lines(file_name, start):
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break # still being written
+            yield line
+
+# Add new counts to the <attr>_int.csv tables. Existing values keep their codes,
+# values seen for the first time get the next codes, in table order, unless the
+# table has an other_val entry, which they are added to instead. The
+# updated tables are written to temp files; returns (temp name, final name) pairs.
+def update_int_conversion_tables(cnts, attr_list, impression_cnt, click_cnt):
+    renames = []
+    for attr in attr_list:
+        fname = attr + "_int.csv"
+        table = []
+        with open(fname, 'r', encoding=data_encoding) as f:
+            for row in csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE):
+                table.append([int(row[0]), row[1], int(row[2]), int(row[3])])
+        index = dict([(row[1], row) for row in table])
+        new_values = []
+        for k, v in cnts[attr].items():
+            row = index.get(k, index.get(other_val)) # a capped table counts new values as other_val
+            if row is None:
+                new_values.append([k, v[0], v[1]])
+            else:
+                row[2] += v[0]
+                row[3] += v[1]
+        sort_attr_cnt_list(attr, new_values)
+        for v in new_values:
+            table.append([len(table)] + v)
+        print("Updating file", fname, "with", len(new_values), "new values")
+        with open(fname + '.tmp', 'w', encoding=data_encoding) as f:
+            writer = csv.writer(f, delimiter=',')
+            for row in table:
+                writer.writerow(row + ["{:.6f}".format(row[3]/(row[2]+row[3]))])
+        renames.append((fname + '.tmp', fname))
+        write_binary_table(attr + "_int.bin.tmp", [row[1] for row in table])
+        renames.append((attr + "_int.bin.tmp", attr + "_int.bin"))
+
+    # update impression/click counts
+    fname = problem_name + "_impression_click_counts.csv"
+    with open(fname, 'r', encoding=data_encoding) as f:
+        row = next(csv.reader(f, delimiter=','))
+    with open(fname + '.tmp', 'w', encoding=data_encoding) as f:
+        csv.writer(f, delimiter=',').writerow([int(row[0]) + impression_cnt, int(row[1]) + click_cnt])
+    renames.append((fname + '.tmp', fname))
+    return renames
 
 # Compress duplicates by using copies field. Assumes data file is sorted.
 # If there is a time stamp field, it is set to 0.
-def compress_with_copies(file_type, time_stamp_name = "created_at"):
+# With mode='hash' the unsorted file is grouped in a hash table instead, see
+# compress_with_copies_hash.
+@stage()
+def compress_with_copies(file_type, time_stamp_name = "created_at", mode = 'sorted', memory_mb = None):
+    if mode == 'hash':
+        return compress_with_copies_hash(file_type, memory_mb)
+    elif mode != 'sorted':
+        raise ValueError("Unknown compress mode: " + str(mode))
+
     fields = read_field_selections(trace=False) # read in the fields to use
     FieldsNT = read_column_names('_reduced', trace=False)
 
@@ -420,12 +2767,12 @@ def compress_with_copies(file_type, time_stamp_name = "created_at"):
     # create a list of attributes to dup check on
     attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
 
-    infile_name = problem_name + '_' + file_type + '_sorted.csv'
+    infile_name = problem_name + '_' + file_type + '_sorted' + data_ext
     print('Compressing file:', infile_name);
     
     outfile_name = problem_name + '_' + file_type + '.csv'
     print("Creating file", outfile_name)
-    outfile = open(outfile_name, 'w')
+    outfile = open(outfile_name, 'w', encoding=data_encoding)
     out_writer = csv.writer(outfile, delimiter=',')
 
     num_attrs = len(attr_list) # all attributes to compare are at the front
@@ -444,7 +2791,7 @@ def compress_with_copies(file_type, time_stamp_name = "created_at"):
     max_copies = -1 # max number of copies seen
     
     print('Reading file', infile_name, end='')
-    with open(infile_name, 'r') as f:
+    with open_data(infile_name, 'r') as f:
         dataReader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)
         for row in dataReader:
             lines_read += 1
@@ -458,7 +2805,7 @@ def compress_with_copies(file_type, time_stamp_name = "created_at"):
             else:
                 depvar_read[row[0]] = 1
                 
-            if (lines_read % 1000000 == 0): print('.{}'.format(lines_read // 1000000), end = "")
+            if (lines_read % progress_every == 0): progress(lines_read)
 
             if first:
                 first = False
@@ -487,10 +2834,14 @@ def compress_with_copies(file_type, time_stamp_name = "created_at"):
     if new_row[0] in depvar_written:
         depvar_written[new_row[0]] += 1
     else:
-        depvar_written[new_row[0]] = 0
+        depvar_written[new_row[0]] = 1
 
     outfile.close()
     print()
+    print_compress_stats(lines_read, lines_written, depvar_read, depvar_written)
+    record_stage(lines_read, lines_written, [infile_name], [outfile_name])
+
+def print_compress_stats(lines_read, lines_written, depvar_read, depvar_written):
     print("Rows read: {:,}  written: {:,}  diff: {:,}  ratio: {:,.3f}".format(lines_read, lines_written,
                                                                                      lines_read - lines_written,
                                                                                      lines_read / lines_written))
@@ -501,7 +2852,333 @@ def compress_with_copies(file_type, time_stamp_name = "created_at"):
         print(k,v)
         #print("Depvar {:,}: {:,} lines written".format(k, v))
 
-    
+# Compress duplicates without sorting first. Reads name_<file_type>_unsorted.csv,
+# groups the rows on the depvar, attributes and action in a hash table and
+# writes the same copies format as compress_with_copies, in sorted key order.
+def compress_with_copies_hash(file_type, memory_mb = None, tmp_dir = None):
+    if memory_mb is None:
+        memory_mb = hash_memory_mb
+    fields = read_field_selections(trace=False) # read in the fields to use
+
+    # create a list of attributes to dup check on
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    num_attrs = len(attr_list) # all attributes to compare are at the front
+
+    infile_name = problem_name + '_' + file_type + '_unsorted' + data_ext
+    print('Compressing file:', infile_name);
+
+    outfile_name = problem_name + '_' + file_type + '.csv'
+    print("Creating file", outfile_name)
+
+    stats = {'read': 0}
+    depvar_read = dict() # number of depvar values read
+    depvar_written = dict() # number of depvar values written
+    lines_written = 0
+
+    # count the rows and depvar values on the way in
+    def counted(rows):
+        for row in rows:
+            stats['read'] += 1
+            depvar_read[row[0]] = depvar_read.get(row[0], 0) + 1
+            if (stats['read'] % progress_every == 0): progress(stats['read'])
+            yield row
+
+    print('Reading file', infile_name, end='')
+    with open_data(infile_name, 'r') as f, open(outfile_name, 'w', encoding=data_encoding) as outfile:
+        out_writer = csv.writer(outfile, delimiter=',')
+        dataReader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)
+        for new_row in hash_aggregate(counted(dataReader), num_attrs + 1, memory_mb, tmp_dir): #all attrs, plus the action
+            out_writer.writerow(new_row)
+            lines_written += 1
+            depvar_written[new_row[0]] = depvar_written.get(new_row[0], 0) + 1
+    print()
+    print_compress_stats(stats['read'], lines_written, depvar_read, depvar_written)
+    record_stage(stats['read'], lines_written, [infile_name], [outfile_name])
+
+# Group rows on their first key_len columns in a hash table and yield each group
+# as its first row plus a copies count, in the order sort_for_compress gives.
+# When the table passes memory_mb the groups are spilled to hashed partition
+# files and each partition is aggregated in turn (recursively if it is still
+# too big), then the sorted partitions are merged.
+# With weighted=True the last column of each row is already a copies count.
+def hash_aggregate(rows, key_len, memory_mb, tmp_dir = None, weighted = False, depth = 0):
+    budget = memory_mb * 1024 * 1024
+    groups = dict()
+    used = 0
+    key = None
+    partitions = None
+    writers = None
+    for row in rows:
+        if key is None:
+            key = make_sort_key([(i, False) for i in range(key_len)], row)
+        if weighted:
+            n = int(row[-1])
+            row = row[:-1]
+        else:
+            n = 1
+        k = tuple(row[:key_len])
+        g = groups.get(k)
+        if g is not None:
+            g[1] += n
+            continue
+        groups[k] = [row, n]
+        used += approx_row_bytes(row) + 200
+        if used >= budget and depth < 8:
+            if partitions is None:
+                partitions = [tempfile.NamedTemporaryFile('w', suffix='.part', dir=tmp_dir, delete=False, newline='',
+                                                          encoding=data_encoding)
+                              for i in range(hash_partitions)]
+                writers = [csv.writer(f, delimiter=',') for f in partitions]
+            spill_hash_groups(groups, writers, depth)
+            groups = dict()
+            used = 0
+
+    if partitions is None:
+        for row, n in sorted(groups.values(), key=lambda g: key(g[0])):
+            yield row + [n]
+        return
+
+    spill_hash_groups(groups, writers, depth)
+    groups = None
+    for f in partitions:
+        f.close()
+    runs = []
+    files = []
+    try:
+        for f in partitions:
+            with open(f.name, 'r', newline='', encoding=data_encoding) as pf:
+                part_rows = hash_aggregate(csv.reader(pf, delimiter=','), key_len, memory_mb, tmp_dir, True, depth + 1)
+                runs.append(write_sort_run(part_rows, ',', tmp_dir))
+            os.remove(f.name)
+        files = [open(name, 'r', newline='', encoding=data_encoding) for name in runs]
+        readers = [csv.reader(f, delimiter=',') for f in files]
+        for row in heapq.merge(*readers, key=key):
+            row[-1] = int(row[-1])
+            yield row
+    finally:
+        for f in files:
+            f.close()
+        for name in [f.name for f in partitions] + runs:
+            if os.path.exists(name):
+                os.remove(name)
+
+# write the groups of a hash table to partition files, with their copies
+def spill_hash_groups(groups, writers, depth):
+    num = len(writers)
+    for k, g in groups.items():
+        writers[hash((depth,) + k) % num].writerow(g[0] + [g[1]])
+
+# Bitmap indexes over name_<file_type>.csv from compress_with_copies. For each
+# of the depvar, the attributes and the action column there is one bitmap per
+# value, bit i set if row i has the value, stored zlib compressed in
+# <column>.bmp in outdir. A value in fewer than 1 in bitmap_sparse_ratio rows
+# is stored as the zlib compressed gaps between its rows instead of its bits.
+# header.json has the row count and where each bitmap is, and copies.bin has
+# the copies column as int64, and marks the columns that hold int codes.
+# Query it with BitmapIndex.
+# The file is read a chunk of bitmap_chunk_rows rows at a time and the row
+# numbers of each value in a chunk are written to <column>.bmp.tmp, then the
+# bitmaps are made from them one value at a time.
+@stage()
+def build_bitmap_index(file_type = 'trn', outdir = None, action_name = 'action_id'):
+    fields = read_field_selections(trace=False) # read in the fields to use
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    col_names = attr_list + list(fields['data'].keys()) + ['copies']
+    columns = attr_list + ([action_name] if action_name in fields['data'] else [])
+    indices = [col_names.index(c) for c in columns]
+    infile_name = problem_name + '_' + file_type + '.csv'
+    if outdir is None:
+        outdir = problem_name + '_' + file_type + '.idx'
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    num_cols = len(col_names)
+    tmp_names = [os.path.join(outdir, c + '.bmp.tmp') for c in columns]
+    tmp_files = [open(name, 'wb') for name in tmp_names]
+    pieces = [dict() for c in columns] # value -> [(offset, count)] in the column's tmp file
+    rows = 0
+    with open(infile_name, 'r', encoding=data_encoding) as f, open(os.path.join(outdir, 'copies.bin'), 'wb') as copies_file:
+        print("Reading file", infile_name, end="")
+        while True:
+            lines = list(itertools.islice(f, bitmap_chunk_rows))
+            if not lines:
+                break
+            chunk_rows = [row for row in csv.reader(lines, delimiter=',', quoting=csv.QUOTE_NONE)]
+            for row in chunk_rows:
+                if len(row) != num_cols:
+                    raise TypeError("Expected {} fields, got {}: {}".format(num_cols, len(row), row))
+            np.array([row[-1] for row in chunk_rows], dtype='<i8').tofile(copies_file)
+            for c, i in enumerate(indices):
+                values, inverse = np.unique(np.array([row[i] for row in chunk_rows]), return_inverse=True)
+                order = np.argsort(inverse, kind='stable')
+                bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+                row_ids = (order + rows).astype('<u8')
+                for v in range(len(values)):
+                    pieces[c].setdefault(str(values[v]), []).append((tmp_files[c].tell(), bounds[v + 1] - bounds[v]))
+                    row_ids[bounds[v]:bounds[v + 1]].tofile(tmp_files[c])
+            rows += len(chunk_rows)
+            progress(rows)
+        print()
+    for tmp in tmp_files:
+        tmp.close()
+
+    header = {'rows': rows, 'file': infile_name, 'columns': OrderedDict()}
+    outputs = [os.path.join(outdir, 'copies.bin')]
+    for c, column in enumerate(columns):
+        file_name = column + '.bmp'
+        bitmaps = OrderedDict()
+        with open(tmp_names[c], 'rb') as tmp, open(os.path.join(outdir, file_name), 'wb') as f:
+            for value in sorted(pieces[c], key=lambda v: (len(v), v)):
+                parts = []
+                for offset, count in pieces[c][value]:
+                    tmp.seek(offset)
+                    parts.append(np.fromfile(tmp, dtype='<u8', count=count))
+                row_ids = np.concatenate(parts)
+                if len(row_ids) * bitmap_sparse_ratio < rows:
+                    kind = 'gaps'
+                    data = zlib.compress(np.diff(row_ids, prepend=np.uint64(0)).tobytes())
+                else:
+                    kind = 'bits'
+                    data = zlib.compress(row_ids_to_bits(row_ids, rows))
+                bitmaps[value] = [f.tell(), len(data), kind]
+                f.write(data)
+        os.remove(tmp_names[c])
+        pieces[c] = None
+        header['columns'][column] = {'file': file_name, 'values': bitmaps, 'coded': column in attr_list}
+        outputs.append(os.path.join(outdir, file_name))
+        print("Wrote file", os.path.join(outdir, file_name), "with", len(bitmaps), "bitmaps")
+    with open(os.path.join(outdir, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=1)
+    record_stage(rows, rows, [infile_name], outputs)
+    return outdir
+
+# the bitmap of rows rows with the bits of row_ids (sorted, no repeats) set,
+# as little-endian bytes. The bits of the row ids that share a byte are or'ed
+# together, so only the bytes are allocated, not a bool per row.
+def row_ids_to_bits(row_ids, rows):
+    bits = np.zeros((rows + 7) // 8, dtype=np.uint8)
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    if len(row_ids):
+        byte_ids = row_ids >> 3
+        starts = np.flatnonzero(np.diff(byte_ids, prepend=-1))
+        bits[byte_ids[starts]] = np.bitwise_or.reduceat(np.left_shift(1, row_ids & 7).astype(np.uint8), starts)
+    return bits.tobytes()
+
+# Queries over an index from build_bitmap_index. A bitmap is a Python int with
+# bit i set for row i, so predicates combine with & (and), | (or) and
+# invert(). Values are the values in the file, the codes from <attr>_int.csv
+# for the depvar and attributes, except in between(), whose bounds are on the
+# values themselves and are mapped to codes through <attr>_int.csv (read from
+# the current directory, like the rest of the pipeline).
+#   idx = BitmapIndex('vistaprint_trn.idx')
+#   q = idx.eq('device', 3) & idx.between('hour_of_day', 9, 17)
+#   idx.count(q), idx.weighted_count(q), idx.row_ids(q)
+#   idx.where(device=3, browser=[0, 5]) # codes, like eq and isin
+class BitmapIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json'), 'r') as f:
+            self.header = json.load(f)
+        self.rows = self.header['rows']
+        self.columns = self.header['columns']
+        self.all = (1 << self.rows) - 1
+        self.bitmaps = dict()
+        self.tables = dict()
+        self.copies = None
+
+    # the values of a column that have a bitmap
+    def values(self, column):
+        return list(self.column(column)['values'].keys())
+
+    def column(self, column):
+        if column not in self.columns:
+            raise KeyError("No bitmap index for " + str(column))
+        return self.columns[column]
+
+    # rows where column == value
+    def eq(self, column, value):
+        key = (column, str(value))
+        bm = self.bitmaps.get(key)
+        if bm is None:
+            col = self.column(column)
+            where = col['values'].get(str(value))
+            if where is None:
+                return 0
+            with open(os.path.join(self.path, col['file']), 'rb') as f:
+                f.seek(where[0])
+                data = zlib.decompress(f.read(where[1]))
+            if where[2] == 'gaps':
+                data = row_ids_to_bits(np.cumsum(np.frombuffer(data, dtype='<u8')), self.rows)
+            bm = int.from_bytes(data, 'little')
+            self.bitmaps[key] = bm
+        return bm
+
+    # rows where column is any of values
+    def isin(self, column, values):
+        bm = 0
+        for v in values:
+            bm |= self.eq(column, v)
+        return bm
+
+    # code -> value of a coded column, from its conversion table
+    def table(self, column):
+        if column not in self.tables:
+            with open(str(column) + '_int.csv', 'r', encoding=data_encoding) as f:
+                self.tables[column] = dict([(row[0], row[1]) for row in
+                                            csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)])
+        return self.tables[column]
+
+    # rows where the value of column is from lo to hi, both included. With int
+    # bounds only the int values are compared, as ints; otherwise the values
+    # are compared as strings.
+    def between(self, column, lo, hi):
+        if self.column(column).get('coded'):
+            table = self.table(column)
+            values = [(code, table.get(code)) for code in self.values(column)]
+        else:
+            values = [(v, v) for v in self.values(column)]
+        if isinstance(lo, int) and isinstance(hi, int):
+            keep = [k for k, v in values if v is not None and v.lstrip('-').isdigit() and lo <= int(v) <= hi]
+        else:
+            keep = [k for k, v in values if v is not None and str(lo) <= v <= str(hi)]
+        return self.isin(column, keep)
+
+    def invert(self, bm):
+        return self.all & ~bm
+
+    # rows matching every column=value given. A list, set, tuple or range value
+    # matches any of its values.
+    def where(self, **predicates):
+        bm = self.all
+        for column, value in predicates.items():
+            if isinstance(value, (list, set, tuple, range)):
+                bm &= self.isin(column, value)
+            else:
+                bm &= self.eq(column, value)
+        return bm
+
+    # numpy array of the row numbers in bm. Only the nonzero bytes are unpacked.
+    def row_ids(self, bm):
+        bits = np.frombuffer(bm.to_bytes((self.rows + 7) // 8, 'little'), dtype=np.uint8)
+        byte_ids = np.flatnonzero(bits)
+        byte_rows, bit_ids = np.nonzero(np.unpackbits(bits[byte_ids, None], axis=1, bitorder='little'))
+        return byte_ids[byte_rows] * 8 + bit_ids
+
+    # number of rows in bm
+    def count(self, bm):
+        return bm.bit_count()
+
+    # number of rows in bm, each counted copies times
+    def weighted_count(self, bm):
+        if self.copies is None:
+            if self.rows == 0:
+                self.copies = np.zeros(0, dtype='<i8')
+            else:
+                self.copies = np.memmap(os.path.join(self.path, 'copies.bin'), dtype='<i8', mode='r',
+                                        shape=(self.rows,))
+        return int(self.copies[self.row_ids(bm)].sum())
+
 
 def str2int(s):
     if s == str(missing_val):
@@ -528,45 +3205,122 @@ def to_int(val):
         return missing_int
 
 # convert Tapad string to unix time
+# Tapad times look like 2014-05-01 12:34:56 or 2014-05-01 12:34:56.789 and are
+# local times in tapad_time_zone, so -4h in summer (EDT) and -5h in winter
+# (EST), as the old strftime('%s') path gave on a machine in that zone. That
+# layout is sliced apart directly and the result is cached by the second, so
+# repeated seconds are a dict lookup. Other layouts go through strptime with
+# timestamp_layouts. Fractions of a second are dropped.
+timestamp_cache = dict()
 def convert_to_timestamp(s):
-    if s.find('.') == -1:
-        d = datetime.datetime.strptime(s+"EDT","%Y-%m-%d %H:%M:%S%Z")
-    else:
-        d = datetime.datetime.strptime(s+"EDT","%Y-%m-%d %H:%M:%S.%f%Z")
-    time_stamp = int(d.strftime("%s"))
-    return time_stamp
+    key = s[:19]
+    t = timestamp_cache.get(key)
+    if t is not None and (len(s) == 19 or s[19] == '.'):
+        return t
+    if is_tapad_time(s):
+        y, mo, d, h = int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13])
+        t = calendar.timegm((y, mo, d, h, int(s[14:16]), int(s[17:19]))) - local_utc_offset(y, mo, d, h)
+        if len(timestamp_cache) >= timestamp_cache_size:
+            timestamp_cache.clear()
+        timestamp_cache[key] = t
+        return t
+    for layout in timestamp_layouts:
+        try:
+            d = datetime.datetime.strptime(s, layout)
+        except ValueError:
+            continue
+        return calendar.timegm(d.timetuple()) - local_utc_offset(d.year, d.month, d.day, d.hour)
+    raise ValueError("Unrecognized time stamp: " + s)
+
+# Offset from UTC in seconds of tapad_time_zone at a local date and hour,
+# cached by the hour. In the hour repeated when DST ends the first (EDT) one
+# is used.
+utc_offset_cache = dict()
+def local_utc_offset(y, mo, d, h):
+    key = (y, mo, d, h)
+    offset = utc_offset_cache.get(key)
+    if offset is None:
+        zone = zoneinfo.ZoneInfo(tapad_time_zone)
+        offset = int(datetime.datetime(y, mo, d, h, tzinfo=zone).utcoffset().total_seconds())
+        utc_offset_cache[key] = offset
+    return offset
+
+# local times (seconds since 1970-01-01 on the wall clock) of the unix times
+# in the int64 array t, in the time zone named zone_name (None for UTC)
+def utc_to_local(t, zone_name):
+    if zone_name is None or len(t) == 0:
+        return t
+    zone = zoneinfo.ZoneInfo(zone_name)
+    hours, inverse = np.unique(t // 3600, return_inverse=True)
+    offsets = np.array([datetime.datetime.fromtimestamp(int(h) * 3600, zone).utcoffset().total_seconds()
+                        for h in hours], dtype=np.int64)
+    return t + offsets[inverse.reshape(-1)]
+
+# check for the yyyy-mm-dd hh:mm:ss[.fff] layout
+def is_tapad_time(s):
+    return (len(s) >= 19 and s[4] == '-' and s[7] == '-' and s[10] == ' ' and s[13] == ':' and s[16] == ':'
+            and (len(s) == 19 or s[19] == '.') and s[0:4].isdigit() and s[5:7].isdigit() and s[8:10].isdigit()
+            and s[11:13].isdigit() and s[14:16].isdigit() and s[17:19].isdigit())
+
+# Convert a whole column of Tapad times to a numpy int64 array of unix times.
+# If every value has the yyyy-mm-dd hh:mm:ss[.fff] layout numpy parses the
+# column in one go, otherwise each value goes through convert_to_timestamp.
+def convert_to_timestamps(values):
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    a = np.asarray(values, dtype=str)
+    if (np.char.str_len(a) >= 19).all() and set([v[19:20] for v in values]) <= set(['', '.']):
+        try:
+            local = a.astype('U19').astype('datetime64[s]').astype(np.int64)
+        except ValueError:
+            local = None
+        if local is not None:
+            # the offset of each distinct local hour
+            hours, inverse = np.unique(local // 3600, return_inverse=True)
+            offsets = []
+            for h in hours.astype('datetime64[h]').tolist():
+                offsets.append(local_utc_offset(h.year, h.month, h.day, h.hour))
+            return local - np.array(offsets, dtype=np.int64)[inverse.reshape(-1)]
+    return np.fromiter(map(convert_to_timestamp, values), dtype=np.int64, count=len(values))
       
 
-# Split dataset into test and training/val. Test is the first part of the dataset, 
-# which have been sorted by decreasing date/time
-# **** This has not been used/tested recently ****
-def split_into_tst_trn(infile = problem_name + "_int_sorted.csv"):
-    # Read number of data records
-    impressions = 0
-    clicks = 0
-    with open('DS3_impression_click_counts.csv', 'r') as f:
-        dataReader = csv.reader(f, delimiter=delim, quoting=csv.QUOTE_NONE)
-        print("Scanning file", infile, end="")
-        i = 0
-        for row in dataReader:
-            i += 1
-            if (i % 1000000 == 0): print('.{}'.format(i // 1000000), end = "")
-            impressions = int(row[0])
-            clicks = int(row[1])
-        print()
-        print("{:,} impressions, {:,} clicks, {:.6} ctr".format(
-            impressions, clicks, clicks/(clicks+impressions)))
-
-    skip_list = []
-    tst_size = int((impressions + clicks) / 5)  # Magic number
-
-    tst_cnt = 0
-
-    test = open(problem_name + '_tst_unsorted.csv', 'w')
-    test_writer = csv.writer(test, delimiter=',')
-    
-    train = open(problem_name + '_trn_unsorted.csv', 'w')
-    train_writer = csv.writer(train, delimiter=',')
+# Split dataset into test and training/val in one pass, without counting it first.
+# Writes name_tst_unsorted.csv and name_trn_unsorted.csv. Modes:
+#  'time'       - test is the first part of the dataset, which has been sorted
+#                 by decreasing date/time (sort_by_time): the first tst_fraction
+#                 of the rows, taken from name_impression_click_counts.csv. With
+#                 time_cutoff, the rows at or after it go to test instead
+#  'stratified' - every row of each class (impressions and clicks) is assigned
+#                 in turn, so each class gets exactly tst_fraction in test
+#  'hash'       - a row goes to test if the crc32 of its key_column value is in
+#                 the tst_fraction part of the range, so the same key always
+#                 lands on the same side
+@stage()
+def split_into_tst_trn(infile = None, mode = 'time', tst_fraction = 0.2,
+                       time_cutoff = None, time_name = 'created_at', key_column = None, seed = ''):
+    if infile is None:
+        infile = problem_name + '_int_sorted' + data_ext
+    fields = read_field_selections(trace=False) # read in the fields to use
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    col_names = attr_list + list(fields['data'].keys())
+    action_index, impression_value = find_impression_column(fields)
+
+    if mode == 'time' and time_cutoff is None:
+        with open(problem_name + '_impression_click_counts.csv', 'r', encoding=data_encoding) as f:
+            row = next(csv.reader(f, delimiter=','))
+        tst_size = int((int(row[0]) + int(row[1])) * tst_fraction)
+    elif mode == 'time':
+        row_in_test = make_split_test(col_names, time_cutoff, time_name)
+    elif mode == 'hash':
+        if key_column is None:
+            raise ValueError("hash mode needs a key_column")
+        row_in_test = make_split_test(col_names, key_column=key_column, tst_fraction=tst_fraction, seed=seed)
+    elif mode != 'stratified':
+        raise ValueError("Unknown split mode: " + str(mode))
+    seen = [0, 0] # rows of each class seen so far, for stratified
+
+    test = RowBatchWriter(problem_name + '_tst_unsorted' + data_ext)
+    train = RowBatchWriter(problem_name + '_trn_unsorted' + data_ext)
 
     trn_cnt = 0
     trn_impress = 0
@@ -574,58 +3328,435 @@ def split_into_tst_trn(infile = problem_name + "_int_sorted.csv"):
     tst_cnt = 0
     tst_impress = 0
     tst_clicks = 0
-    with open(infile, 'r') as f:
-        print("Partitioning file", infile, end="")
+    try:
+        with open_data(infile, 'r') as f:
+            print("Partitioning file", infile, end="")
 
-        dataReader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)
-        i = 0
-        for row in dataReader:
-            i += 1
-            if (i % 1000000 == 0): print('.{}'.format(i // 1000000), end = "")
-            
-            r = D1(*row)
-            
-            if i > tst_size:
-                train_writer.writerow(row)
-                trn_cnt += 1
-                if (r.action_id == '0'):
-                    trn_impress += 1
+            dataReader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE)
+            i = 0
+            for row in dataReader:
+                i += 1
+                if (i % progress_every == 0): progress(i)
+
+                click = row[action_index] != impression_value
+                if mode == 'stratified':
+                    n = seen[click]
+                    seen[click] += 1
+                    in_test = int((n + 1) * tst_fraction) > int(n * tst_fraction)
+                elif mode == 'time' and time_cutoff is None:
+                    in_test = i <= tst_size
                 else:
-                    trn_clicks += 1
-            else:
-                test_writer.writerow(row)
-                tst_cnt += 1
-                if (r.action_id == '0'):
-                    tst_impress += 1
+                    in_test = row_in_test(row)
+
+                if in_test:
+                    test.writerow(row)
+                    tst_cnt += 1
+                    if click:
+                        tst_clicks += 1
+                    else:
+                        tst_impress += 1
                 else:
-                    tst_clicks += 1
-        print()
-                
-    test.close()   
-    train.close()
-    print('Test size {:,}, impressions: {:,}, clicks: {:,}. ctr: {:.6f}'.format(tst_cnt, tst_impress, tst_clicks, tst_clicks/tst_cnt))
-    print('Train size {:,}, impressions: {:,}, clicks: {:,}. ctr: {:.6f}'.format(trn_cnt, trn_impress, trn_clicks, trn_clicks/trn_cnt))
-    print('Wrote file:', problem_name + '_tst_unsorted.csv');
-    print('Wrote file:', problem_name + '_trn_unsorted.csv');
+                    train.writerow(row)
+                    trn_cnt += 1
+                    if click:
+                        trn_clicks += 1
+                    else:
+                        trn_impress += 1
+            print()
+    finally:
+        test.close()
+        train.close()
+    print('Test size {:,}, impressions: {:,}, clicks: {:,}. ctr: {:.6f}'.format(tst_cnt, tst_impress, tst_clicks, tst_clicks/max(tst_cnt, 1)))
+    print('Train size {:,}, impressions: {:,}, clicks: {:,}. ctr: {:.6f}'.format(trn_cnt, trn_impress, trn_clicks, trn_clicks/max(trn_cnt, 1)))
+    print('Wrote file:', problem_name + '_tst_unsorted' + data_ext);
+    print('Wrote file:', problem_name + '_trn_unsorted' + data_ext);
+    record_stage(tst_cnt + trn_cnt, tst_cnt + trn_cnt, [infile],
+                 [problem_name + '_tst_unsorted' + data_ext, problem_name + '_trn_unsorted' + data_ext])
+
+# The test of the splits that look at each row alone: the 'time' split with a
+# time_cutoff, or else the 'hash' split on key_column. Returns in_test(row).
+def make_split_test(col_names, time_cutoff = None, time_name = 'created_at', key_column = None,
+                    tst_fraction = 0.2, seed = ''):
+    if time_cutoff is not None:
+        time_index = col_names.index(time_name)
+        if not str(time_cutoff).isdigit():
+            time_cutoff = convert_to_timestamp(time_cutoff)
+        time_cutoff = int(time_cutoff)
+        def in_test(row):
+            t = row[time_index]
+            return (int(t) if t.isdigit() else convert_to_timestamp(t)) >= time_cutoff
+        return in_test
+    key_index = col_names.index(key_column)
+    hash_limit = int(tst_fraction * (1 << 32))
+    seed_crc = zlib.crc32(seed.encode())
+    return lambda row: zlib.crc32(row[key_index].encode(), seed_crc) < hash_limit
+
+# Position of action_id in the int coded files, and the value it has for an
+# impression: the code of 'impression' if action_id is the depvar or an
+# attribute, otherwise 'impression' itself.
+def find_impression_column(fields, action_name = 'action_id'):
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    col_names = attr_list + list(fields['data'].keys())
+    if action_name not in col_names:
+        raise ValueError(action_name + " is not in the field selection")
+    if action_name in attr_list:
+        table = load_int_conversion_tables([action_name])[action_name]
+        return col_names.index(action_name), str(table.get('impression', 0))
+    return col_names.index(action_name), 'impression'
+
+# Reads a data file on a separate thread, read_block_bytes at a time and up to
+# read_ahead_blocks ahead, so the disk (and the decompression of .gz, .zst and
+# .lz4 files) overlaps with the parsing. The blocks are cut at line ends and
+# each one is split into lines and parsed in one go. Lines are as open_data
+# gives them, with universal newlines. On a single core with the file in the
+# page cache there is nothing to overlap, and blocks_ahead=0 (no thread) is a
+# little faster.
+#   with ReadAheadFile(file_name) as f:
+#       for row in f.rows(delim): ...
+class ReadAheadFile(object):
+
+    def __init__(self, file_name, block_bytes = None, blocks_ahead = None):
+        self.file_name = file_name
+        self.f = open_data(file_name, 'rb')
+        self.block_bytes = block_bytes or read_block_bytes
+        self.encoding = data_encoding
+        self.error = None
+        self.stopped = False
+        if blocks_ahead is None:
+            blocks_ahead = read_ahead_blocks
+        self.queue = None
+        self.thread = None
+        if blocks_ahead > 0:
+            self.queue = queue.Queue(maxsize=blocks_ahead)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped:
+                data = self.f.read(self.block_bytes)
+                self.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self.error = e
+            self.put(b'')
+
+    def put(self, data):
+        while not self.stopped:
+            try:
+                self.queue.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    # the lines of the file, a block at a time, without their line ends
+    def line_blocks(self):
+        carry = b''
+        while True:
+            data = self.queue.get() if self.queue is not None else self.f.read(self.block_bytes)
+            if self.error is not None:
+                raise self.error
+            if not data:
+                break
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                carry += data
+                continue
+            yield self.split_lines(carry + data[:end])
+            carry = data[end:]
+        if carry:
+            yield self.split_lines(carry + b'\n')
+
+    def split_lines(self, data):
+        text = data.decode(self.encoding)
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        lines = text.split('\n')
+        lines.pop() # after the last line end
+        return lines
+
+    def rows(self, delimiter = ','):
+        for lines in self.line_blocks():
+            for row in csv.reader(lines, delimiter=delimiter, quoting=csv.QUOTE_NONE):
+                yield row
+
+    def close(self):
+        if self.f is None:
+            return
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# the rows of a data file, read ahead on a thread (see ReadAheadFile)
+def read_rows(file_name, delimiter = ','):
+    with ReadAheadFile(file_name) as f:
+        for row in f.rows(delimiter):
+            yield row
+
+# csv writer that collects rows into batches and hands them to its own thread,
+# which writes them with writerows into a file with a large buffer, so writing
+# overlaps with the caller's work. close() waits for the writes to finish.
+class RowBatchWriter(object):
+
+    def __init__(self, file_name, delimiter = ',', batch_rows = None, buffer_bytes = None):
+        self.file_name = file_name
+        self.f = open_data(file_name, 'w', buffering=buffer_bytes or writer_buffer_bytes)
+        self.writer = csv.writer(self.f, delimiter=delimiter)
+        self.batch_rows = batch_rows or writer_batch_rows
+        self.batch = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=4)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def writerow(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_rows:
+            if self.error is not None:
+                raise self.error
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.writerows(batch)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        if self.thread is None:
+            return
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.f.close()
+        if self.error is not None:
+            raise self.error
 
 # Vika, if you are running lots of experiments, it helps to be able to load a
-# dataset from a pickle file. It is much faster than reading a CSV file.
-
-# dump the training data using pickle
-def dump_tdata_raw (tdata):
-    t1 = clock()
-    pickle.dump(tdata,open( "tdataraw.p", "wb"))
-    t2 = clock()
-    print ("Dumped tdata in", format(t2 - t1, "5.3g"), "secs")
-    
-# load the raw training data
-def load_tdata_raw ():
-    t1 = clock()
-    t = pickle.load( open( "tdataraw.p", "rb" ) )
-    t2 = clock()
+# dataset from the cache. It is much faster than reading a CSV file.
+#
+# load_tdata keeps a columnar copy (see ColumnarWriter) of a data file in
+# cache_dir, keyed by a hash of the file contents and of fieldselection.csv, so
+# a changed file or field selection gets a new entry and experiments running at
+# the same time don't overwrite each other. Columns are memory mapped when they
+# are first used. Entries that haven't been used recently are evicted once the
+# cache is over cache_budget_mb.
+# Processes sharing the cache coordinate with flock: cache_lock() guards
+# fingerprints.json and the opening and evicting of entries, and an open
+# CachedDataset holds a shared lock on its entry, so it is never evicted from
+# under a process that is using it.
+
+# load a data file (e.g. name_trn.csv) through the cache
+def load_tdata(source_file = None, fieldselection = 'fieldselection.csv', delimiter = ','):
+    if source_file is None:
+        source_file = problem_name + '_int' + data_ext
+    t1 = perf_counter()
+    key = dataset_cache_key(source_file, fieldselection)
+    entry = os.path.join(cache_dir, key)
+    t = None
+    while t is None:
+        if not os.path.exists(os.path.join(entry, 'header.json')):
+            print("Caching", source_file, "as", entry)
+            build_cache_entry(source_file, entry, fieldselection, delimiter)
+        with cache_lock():
+            if os.path.exists(os.path.join(entry, 'header.json')): # not evicted in the meantime
+                t = CachedDataset(entry)
+                os.utime(entry) # mark as recently used
+    evict_cache(keep = key)
+    t2 = perf_counter()
     print ("Loaded tdata in ", format(t2 - t1, "5.3g"), "secs")
     return t
 
+# cache key for a data file and field selection
+def dataset_cache_key(source_file, fieldselection = 'fieldselection.csv'):
+    h = hashlib.sha1()
+    h.update(file_fingerprint(source_file).encode())
+    with open(fieldselection, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+# sha1 of a file's contents. The hash is remembered in cache_dir/fingerprints.json
+# with the file's size and modification time, so it is only recomputed when the
+# file changes. The file is hashed outside the cache lock and the index is
+# reread under it before the update, so concurrent runs don't drop entries.
+def file_fingerprint(file_name):
+    st = os.stat(file_name)
+    path = os.path.abspath(file_name)
+    with cache_lock():
+        entry = read_fingerprints().get(path)
+    if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return entry['sha1']
+
+    sha1 = file_sha1(file_name)
+    with cache_lock():
+        index = read_fingerprints()
+        index[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1}
+        index_name = os.path.join(cache_dir, 'fingerprints.json')
+        tmp_name = index_name + '.' + str(os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_name, index_name)
+    return sha1
+
+def file_sha1(file_name):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(1 << 23)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def read_fingerprints():
+    index_name = os.path.join(cache_dir, 'fingerprints.json')
+    if not os.path.exists(index_name):
+        return dict()
+    with open(index_name, 'r') as f:
+        return json.load(f)
+
+# exclusive lock on the cache directory, across processes. Not reentrant.
+@contextlib.contextmanager
+def cache_lock():
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Write the columnar copy of a data file. It is built in a temp directory and
+# renamed into place, so a reader never sees a half written entry.
+# Files with one more column than the field selection (e.g. name_trn.csv) get
+# a copies column.
+def build_cache_entry(source_file, entry, fieldselection, delimiter):
+    fields = read_field_selections(fieldselection, trace=False) # read in the fields to use
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    names = attr_list + list(fields['data'].keys())
+    tmp_entry = entry + '.tmp' + str(os.getpid())
+    if os.path.exists(tmp_entry):
+        shutil.rmtree(tmp_entry)
+    try:
+        with open_data(source_file, 'r') as f:
+            dataReader = csv.reader(f, delimiter=delimiter)
+            first = next(dataReader, None)
+            if first is not None and len(first) == len(names) + 1:
+                names.append('copies')
+            writer = ColumnarWriter(tmp_entry, names, attr_tables=attr_list)
+            if first is not None:
+                writer.writerow(first)
+            writer.writerows(dataReader)
+            writer.close()
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            pass # another process built the same entry first
+    finally:
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+
+# Remove the least recently used cache entries until the cache fits in budget_mb.
+# The entry named keep is never removed, nor are entries used in the last
+# cache_min_age_seconds or open in some process (see CachedDataset).
+def evict_cache(budget_mb = None, keep = None):
+    if budget_mb is None:
+        budget_mb = cache_budget_mb
+    if not os.path.isdir(cache_dir):
+        return
+    with cache_lock():
+        entries = []
+        total = 0
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if not os.path.isdir(path) or '.tmp' in name:
+                continue
+            size = sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+            entries.append((os.path.getmtime(path), size, name))
+            total += size
+        entries.sort()
+        min_mtime = time.time() - cache_min_age_seconds
+        for mtime, size, name in entries:
+            if total <= budget_mb * 1024 * 1024:
+                break
+            if name == keep or mtime > min_mtime:
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                f = open(os.path.join(path, 'header.json'), 'r')
+            except OSError:
+                f = None # a broken entry
+            try:
+                if f is not None:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue # open in another process
+                print("Evicting cache entry", name)
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+            finally:
+                if f is not None:
+                    f.close()
+
+# A cached dataset. Columns are opened as memory maps the first time they are used:
+# t['site'] gives the int codes for site, t.values('created_at') the values of
+# a dictionary coded column.
+class CachedDataset(object):
+
+    def __init__(self, path):
+        self.path = path
+        # held until close(), so evict_cache leaves the entry alone
+        self.lock_file = open(os.path.join(path, 'header.json'), 'r')
+        fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+        self.header = read_columnar_header(path)
+        self.columns = [col['name'] for col in self.header['columns']]
+        self.rows = self.header['rows']
+        self.arrays = dict()
+
+    def close(self):
+        self.arrays = dict()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            if name not in self.columns:
+                raise KeyError(name)
+            self.arrays[name] = open_columnar(self.path, [name])[name]
+        return self.arrays[name]
+
+    def __len__(self):
+        return self.rows
+
+    def values(self, name):
+        return columnar_values(self.path, name)
+
 # utility functions
 
 # print the first 5 items in a list
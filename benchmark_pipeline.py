@@ -0,0 +1,225 @@
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import time
+
+from pipeline_loader import load_pipeline
+
+# Synthetic data and benchmarks for the parsing pipeline in "VistaPrint Parse Data.py".
+# generate_download writes a name_download.csv shaped like the real export,
+# and run_benchmark runs the pipeline stages on it and compares their
+# throughput and memory with a stored baseline.
+#
+#   python benchmark_pipeline.py 1M                  # run, compare with the baseline
+#   python benchmark_pipeline.py 10M --save-baseline # run and store as the baseline
+
+bench_dir = "benchmark_data" # one sub directory per size
+baseline_file = "benchmark_baseline.json"
+sizes = {'1M': 1000000, '10M': 10000000, '100M': 100000000}
+regression_tolerance = 0.10 # rows/sec more than 10% below the baseline is reported as slower
+
+# columns of the download, after id, action_id and created_at: (name, cardinality, type).
+# Values are drawn with a Zipf like skew, so a few values are common and most are rare.
+# day_of_week and hour_of_day are worked out from created_at.
+attr_columns = [('device', 4, 'str'),
+                ('site', 2000, 'str'),
+                ('country', 200, 'str'),
+                ('day_of_week', 7, 'int'),
+                ('hour_of_day', 24, 'int'),
+                ('browser', 60, 'str'),
+                ('campaign_id', 5000, 'int')]
+depvar_name = 'device'
+extra_columns = ['user_agent', 'referrer'] # columns the field selection leaves out
+value_skew = 1.1
+click_rate = 0.02
+conversion_rate = 0.005
+start_time = '2014-05-01' # created_at is spread evenly over days days from start_time
+days = 28
+# time stamp layouts with their share of the rows, as in the Tapad exports
+timestamp_mix = [('%Y-%m-%d %H:%M:%S', 0.7), ('%Y-%m-%d %H:%M:%S.%f', 0.25), ('%Y-%m-%dT%H:%M:%S', 0.05)]
+bad_line_rate = 0.001 # rows with missing columns, which standardize_file drops
+chunk_rows = 100000
+seed = 1
+
+# the stages run by the benchmark, in order, as (function, args)
+bench_stages = [('standardize_file', ()),
+                ('reduce_file', ()),
+                ('create_int_conversion_tables', ()),
+                ('convert_to_ints', ()),
+                ('sort_by_time', ()),
+                ('split_into_tst_trn', ()),
+                ('sort_for_compress', ('trn',)),
+                ('compress_with_copies', ('trn',))]
+
+
+# rows given as 1M, 10M, ... or a number
+def parse_rows(s):
+    if s in sizes:
+        return sizes[s]
+    return int(s)
+
+# cumulative weights of a Zipf like distribution over n values
+def zipf_weights(n, skew = value_skew):
+    total = 0.0
+    cum = []
+    for k in range(n):
+        total += 1.0 / (k + 1) ** skew
+        cum.append(total)
+    return cum
+
+# the values of an attribute column
+def attr_values(name, cardinality, kind):
+    if kind == 'int':
+        return [str(v) for v in range(cardinality)]
+    return ['{}{}'.format(name, v) for v in range(cardinality)]
+
+# Write a download file with rows rows, semicolon delimited with a header line,
+# like the real export.
+def generate_download(file_name, rows, seed = seed):
+    rnd = random.Random(seed)
+    header = ['id', 'action_id', 'created_at'] + [name for name, n, kind in attr_columns] + extra_columns
+    start = time.mktime(time.strptime(start_time, '%Y-%m-%d'))
+    span = days * 86400
+    day_names = [time.strftime('%Y-%m-%d', time.localtime(start + d * 86400 + 3600)) for d in range(days)]
+    first_dow = time.localtime(start + 3600).tm_wday
+
+    columns = []
+    for name, n, kind in attr_columns:
+        if name not in ('day_of_week', 'hour_of_day'):
+            columns.append((name, attr_values(name, n, kind), zipf_weights(n)))
+    layouts = [layout for layout, share in timestamp_mix]
+    layout_weights = [share for layout, share in timestamp_mix]
+    actions = ['impression', 'click', 'conversion']
+    action_weights = [1 - click_rate - conversion_rate, click_rate, conversion_rate]
+    agents = ['Mozilla/5.0 ({})'.format(v) for v in range(50)]
+    agent_weights = zipf_weights(len(agents))
+
+    print("Writing {:,} rows to {}".format(rows, file_name), end="")
+    with open(file_name, 'w') as f:
+        f.write(';'.join(header) + '\n')
+        done = 0
+        while done < rows:
+            n = min(chunk_rows, rows - done)
+            cols = dict()
+            for name, values, cum in columns:
+                cols[name] = rnd.choices(values, cum_weights=cum, k=n)
+            action = rnd.choices(actions, action_weights, k=n)
+            layout = rnd.choices(layouts, layout_weights, k=n)
+            agent = rnd.choices(agents, cum_weights=agent_weights, k=n)
+            lines = []
+            for i in range(n):
+                t = int(rnd.random() * span)
+                day, secs = divmod(t, 86400)
+                hour = secs // 3600
+                stamp = '{} {:02d}:{:02d}:{:02d}'.format(day_names[day], hour, secs // 60 % 60, secs % 60)
+                if layout[i] != layouts[0]:
+                    if 'T' in layout[i]:
+                        stamp = stamp.replace(' ', 'T')
+                    if layout[i].endswith('.%f'):
+                        stamp += '.{:03d}'.format(rnd.randrange(1000))
+                row = [str(done + i), action[i], stamp]
+                for name, n_values, kind in attr_columns:
+                    if name == 'day_of_week':
+                        row.append(str((first_dow + day) % 7))
+                    elif name == 'hour_of_day':
+                        row.append(str(hour))
+                    else:
+                        row.append(cols[name][i])
+                row.append(' ' + agent[i] + ' ')
+                row.append('')
+                if rnd.random() < bad_line_rate:
+                    row = row[:-3]
+                lines.append(';'.join(row))
+            f.write('\n'.join(lines))
+            f.write('\n')
+            done += n
+            print('.', end="", flush=True)
+    print()
+
+# Write the fieldselection.csv to go with generate_download
+def generate_fieldselection(file_name = 'fieldselection.csv'):
+    with open(file_name, 'w') as f:
+        f.write('# generated by benchmark_pipeline.py\n')
+        for name, n, kind in attr_columns:
+            if name == depvar_name:
+                f.write('dep_var,{},{}\n'.format(name, kind))
+        for name, n, kind in attr_columns:
+            if name != depvar_name:
+                f.write('attr,{},{}\n'.format(name, kind))
+        f.write('data,action_id,str\n')
+        f.write('data,created_at,time\n')
+
+# Make the data directory for a size, generating the download if it isn't there
+def prepare_data(rows):
+    data_dir = os.path.join(bench_dir, str(rows))
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    pipeline = load_pipeline()
+    download = os.path.join(data_dir, pipeline.problem_name + '_download.csv')
+    if not os.path.exists(download):
+        generate_download(download + '.tmp', rows)
+        os.replace(download + '.tmp', download)
+    generate_fieldselection(os.path.join(data_dir, 'fieldselection.csv'))
+    return data_dir
+
+# Run one stage in the data directory and return its metrics. Each stage runs
+# in its own process, so the peak RSS is that of the stage alone.
+def run_stage(data_dir, name, args):
+    pipeline = load_pipeline()
+    pipeline.show_progress = False
+    os.chdir(data_dir)
+    getattr(pipeline, name)(*args)
+    return pipeline.stage_reports
+
+# Run bench_stages on rows rows and compare them with the baseline. With
+# save_baseline the results are stored as the new baseline for this size.
+def run_benchmark(rows, save_baseline = False, stages = None):
+    if stages is None:
+        stages = bench_stages
+    data_dir = os.path.abspath(prepare_data(rows))
+    results = []
+    for name, args in stages:
+        with concurrent.futures.ProcessPoolExecutor(1) as pool:
+            reports = pool.submit(run_stage, data_dir, name, args).result()
+        report = reports[-1] # the outermost stage finishes last
+        report['label'] = ' '.join([name] + [str(a) for a in args])
+        results.append(report)
+
+    baseline = dict()
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+    print_benchmark(rows, results, baseline.get(str(rows), dict()))
+
+    if save_baseline:
+        baseline[str(rows)] = dict([(r['label'], r) for r in results])
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=1)
+        print("Saved baseline for {:,} rows to {}".format(rows, baseline_file))
+    return results
+
+def print_benchmark(rows, results, baseline):
+    print()
+    print("Benchmark, {:,} rows".format(rows))
+    print("{:32} {:>12} {:>9} {:>13} {:>9} {:>9} {:>8}".format('stage', 'rows in', 'secs', 'rows/sec',
+                                                                'MB/sec', 'RSS MB', 'vs base'))
+    for r in results:
+        mb_per_sec = (r['bytes_read'] + r['bytes_written']) / (1024 * 1024) / r['wall_secs'] if r['wall_secs'] > 0 else 0
+        base = baseline.get(r['label'])
+        compare = ''
+        if base is not None and base['rows_per_sec'] > 0:
+            ratio = r['rows_per_sec'] / base['rows_per_sec']
+            compare = '{:.2f}x'.format(ratio)
+            if ratio < 1 - regression_tolerance:
+                compare += ' SLOWER'
+        print("{:32} {:>12,} {:>9.2f} {:>13,.0f} {:>9.1f} {:>9,.0f} {:>8}".format(r['label'], r['rows_in'], r['wall_secs'],
+                                                                               r['rows_per_sec'], mb_per_sec,
+                                                                               r['peak_rss_mb'] or 0, compare))
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    for size in args or ['1M']:
+        run_benchmark(parse_rows(size), save_baseline='--save-baseline' in sys.argv)
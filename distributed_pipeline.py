@@ -0,0 +1,396 @@
+import concurrent.futures
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pipeline_loader
+from pipeline_loader import load_pipeline, pipeline_script
+
+# Sharded runs of the parsing pipeline in "VistaPrint Parse Data.py", for
+# downloads too big for one box. run_distributed splits the download into
+# shards and runs the pipeline on them in two phases through a backend:
+#  - count:   each shard is standardized and reduced, and its attribute value
+#             counts are written to counts.json. The counts are gathered and
+#             added up, and the <attr>_int.csv tables are written from the
+#             totals, so the codes are the same as a run on the whole file.
+#             With count_top_k the shards' counts are estimates: every value
+#             any shard kept is sent back to them in keep.json, they recount
+#             those exactly (recount) and the totals are cut to count_top_k.
+#  - convert: the tables are sent to the shards, which convert to ints, split
+#             into tst and trn and compress trn with copies. The compressed
+#             shards are merged into name_trn.csv (adding the copies of rows
+#             found in several shards) and the tst shards are concatenated
+#             into name_tst_unsorted.
+# Backends: LocalBackend (a process pool on this machine), SSHBackend (a list
+# of hosts, reached with ssh and scp) and EC2Backend (SSH on EC2 instances
+# started for the job and stopped after it).
+#
+#   python distributed_pipeline.py                       # local process pool
+#   python distributed_pipeline.py --hosts host1,host2   # over ssh
+#   python distributed_pipeline.py --ec2 4               # on 4 new EC2 instances
+
+work_dir = "shards"
+shard_block_rows = 100000 # compressed downloads are dealt out to the shards in blocks of rows
+max_retries = 1
+ssh_options = ['-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=accept-new']
+remote_dir = "vistaprint_shards" # on the remote hosts, relative to the home directory
+remote_python = "python3"
+ssh_slots = 4 # shards run at once on each ssh host
+ec2_user = "ec2-user"
+ec2_terminate = False # terminate the instances after the job instead of stopping them
+ec2_boot_seconds = 60 # wait after the instances are running, for sshd to come up
+
+
+# Split the download into num_shards shard directories under work_dir, each with
+# a part of the download (with the header line) and a copy of fieldselection.csv.
+# A plain file is split at line boundaries; a compressed one is dealt out in
+# blocks of shard_block_rows rows. Returns the shard directories.
+def split_into_shards(infile_name, num_shards, work_dir = work_dir, fieldselection = 'fieldselection.csv'):
+    pipeline = load_pipeline()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    for name in os.listdir(work_dir):
+        if name.startswith('shard_'):
+            shutil.rmtree(os.path.join(work_dir, name))
+    shard_dirs = [os.path.abspath(os.path.join(work_dir, 'shard_{:03d}'.format(i))) for i in range(num_shards)]
+    download_name = pipeline.problem_name + '_download.csv'
+    print("Splitting", infile_name, "into", num_shards, "shards in", work_dir)
+
+    if pipeline.data_codec(infile_name) is None:
+        chunks = pipeline.find_chunk_offsets(infile_name, num_shards)
+        shard_dirs = shard_dirs[:len(chunks)]
+        with open(infile_name, 'rb') as f:
+            header = f.readline()
+            for shard_dir, (start, end) in zip(shard_dirs, chunks):
+                os.makedirs(shard_dir)
+                f.seek(start)
+                with open(os.path.join(shard_dir, download_name), 'wb') as out:
+                    out.write(header)
+                    left = end - start
+                    while left > 0:
+                        block = f.read(min(left, 1 << 24))
+                        if not block:
+                            break
+                        out.write(block)
+                        left -= len(block)
+    else:
+        outs = []
+        for shard_dir in shard_dirs:
+            os.makedirs(shard_dir)
+            outs.append(open(os.path.join(shard_dir, download_name), 'w', encoding=pipeline.data_encoding))
+        try:
+            with pipeline.open_data(infile_name, 'r') as f:
+                header = f.readline()
+                for out in outs:
+                    out.write(header)
+                for i in itertools.count():
+                    lines = list(itertools.islice(f, shard_block_rows))
+                    if not lines:
+                        break
+                    outs[i % len(outs)].writelines(lines)
+        finally:
+            for out in outs:
+                out.close()
+
+    for shard_dir in shard_dirs:
+        shutil.copy(fieldselection, shard_dir)
+    return shard_dirs
+
+
+# Tasks, run in a shard directory by a backend's worker
+
+# standardize and reduce the shard and write its counts to counts.json
+def count_task(pipeline):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    write_shard_counts(pipeline)
+
+# count the values in keep.json exactly, the rest as other_val, into counts.json
+def recount_task(pipeline):
+    with open('keep.json', 'r') as f:
+        keep = json.load(f)
+    write_shard_counts(pipeline, keep)
+
+def write_shard_counts(pipeline, keep = None):
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + [k for k in fields['attrs'].keys()]
+    FieldsNT = pipeline.read_column_names('_reduced', trace=False)
+    cnts, impression_cnt, click_cnt = pipeline.count_attr_values(pipeline.problem_name + '_reduced' + pipeline.data_ext,
+                                                                 FieldsNT._fields, attr_list, keep=keep)
+    counts = {'attr_list': attr_list, 'impressions': impression_cnt, 'clicks': click_cnt, 'counts': dict()}
+    for attr in attr_list:
+        # a capped count is cut to count_top_k on the totals, not on each shard
+        items = cnts[attr].all_items() if isinstance(cnts[attr], pipeline.AttrCounter) else cnts[attr].items()
+        counts['counts'][attr] = [[k, v[0], v[1]] for k, v in items]
+    with open('counts.json', 'w') as f:
+        json.dump(counts, f)
+
+# with the global tables in place, convert, split and compress the shard.
+# The shards aren't sorted by time and the counts are the global ones, so the
+# split is stratified rather than the time prefix split.
+def convert_task(pipeline):
+    pipeline.convert_to_ints()
+    pipeline.split_into_tst_trn(pipeline.problem_name + '_int' + pipeline.data_ext, mode='stratified')
+    pipeline.compress_with_copies('trn', mode='hash')
+
+tasks = {'count': count_task, 'recount': recount_task, 'convert': convert_task}
+
+# run a task in a shard directory. Returns the shard directory.
+def run_task(task, shard_dir):
+    pipeline = load_pipeline()
+    os.chdir(shard_dir)
+    tasks[task](pipeline)
+    return shard_dir
+
+
+# Runs the shards in a process pool on this machine
+class LocalBackend(object):
+
+    def __init__(self, processes = None):
+        self.slots = processes or multiprocessing.cpu_count()
+        self.executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.slots)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    # Copy put_files into each shard and run task on all of them. The files
+    # named in get_files are left in the shard directories.
+    def run(self, task, shard_dirs, put_files = (), get_files = ()):
+        for shard_dir in shard_dirs:
+            for name in put_files:
+                shutil.copy(name, shard_dir)
+        futures = [self.executor.submit(run_task, task, shard_dir) for shard_dir in shard_dirs]
+        return [f.result() for f in futures]
+
+
+# Runs the shards on other machines over ssh. The pipeline scripts are copied
+# to remote_dir on each host by start(). A shard is copied to a host the first
+# time it runs there and stays on that host, so later tasks only send the
+# put_files and fetch the get_files. Each host runs up to slots shards at once.
+class SSHBackend(LocalBackend):
+
+    def __init__(self, hosts = (), slots = ssh_slots):
+        self.hosts = list(hosts)
+        self.host_slots = slots
+        self.placement = dict()
+        self.executor = None
+
+    @property
+    def slots(self):
+        return len(self.hosts) * self.host_slots
+
+    def start(self):
+        if not self.hosts:
+            raise ValueError("No hosts to run on")
+        for host in self.hosts:
+            self.ssh(host, 'mkdir -p ' + remote_dir)
+            self.scp([pipeline_script, pipeline_loader.__file__, os.path.abspath(__file__)],
+                     host + ':' + remote_dir + '/')
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.slots)
+
+    def run(self, task, shard_dirs, put_files = (), get_files = ()):
+        for i, shard_dir in enumerate(shard_dirs):
+            if shard_dir not in self.placement:
+                self.placement[shard_dir] = self.hosts[i % len(self.hosts)]
+        futures = [self.executor.submit(self.run_shard, task, shard_dir, put_files, get_files)
+                   for shard_dir in shard_dirs]
+        return [f.result() for f in futures]
+
+    def run_shard(self, task, shard_dir, put_files, get_files):
+        host = self.placement[shard_dir]
+        name = os.path.basename(shard_dir)
+        remote_shard = remote_dir + '/' + name
+        for attempt in range(max_retries + 1):
+            try:
+                if not self.placed(host, name):
+                    self.scp(['-r', shard_dir], host + ':' + remote_dir + '/')
+                if put_files:
+                    self.scp(list(put_files), host + ':' + remote_shard + '/')
+                self.ssh(host, 'cd {} && {} {} --task {} {}'.format(remote_dir, remote_python,
+                                                                   os.path.basename(__file__), task, name))
+                for f in get_files:
+                    self.scp([host + ':' + remote_shard + '/' + f], os.path.join(shard_dir, f))
+                print("Ran", task, "on", name, "at", host)
+                return shard_dir
+            except subprocess.CalledProcessError as e:
+                print("Failed", task, "on", name, "at", host, "attempt", attempt + 1, ":", e)
+                if attempt == max_retries:
+                    raise
+
+    def placed(self, host, name):
+        return subprocess.run(['ssh'] + ssh_options + [host, 'test -d ' + remote_dir + '/' + name]).returncode == 0
+
+    def ssh(self, host, command):
+        subprocess.run(['ssh'] + ssh_options + [host, command], check=True)
+
+    def scp(self, sources, dest):
+        subprocess.run(['scp', '-q'] + ssh_options + sources + [dest], check=True)
+
+
+# SSH on EC2 instances that are started for the job and stopped (or
+# terminated, with ec2_terminate) when it ends. Uses start_stop_amazon_instances.
+class EC2Backend(SSHBackend):
+
+    def __init__(self, count, slots = ssh_slots):
+        super().__init__([], slots)
+        self.count = count
+        self.conn = None
+        self.instances = []
+
+    # If the instances don't come up (an EC2 error, a timeout, or ssh/scp
+    # failing), they are stopped again before the error is raised
+    def start(self):
+        import boto.exception
+        import start_stop_amazon_instances as ec2
+        self.conn = ec2.connect()
+        print("Starting", self.count, "EC2 instances")
+        self.instances = ec2.start_instances(self.conn, self.count)
+        try:
+            names = ec2.wait_until_running(self.instances)
+            time.sleep(ec2_boot_seconds)
+            self.hosts = [ec2_user + '@' + name for name in names]
+            super().start()
+        except (boto.exception.BotoServerError, boto.exception.BotoClientError, RuntimeError,
+                subprocess.CalledProcessError, OSError):
+            self.stop()
+            raise
+
+    def stop(self):
+        super().stop()
+        if self.instances:
+            import start_stop_amazon_instances as ec2
+            ids = ec2.stop_instances(self.conn, [instance.id for instance in self.instances], terminate=ec2_terminate)
+            print("Terminated" if ec2_terminate else "Stopped", "EC2 instances", ids)
+            self.instances = []
+
+
+# Run the pipeline on a download split into num_shards shards (by default one
+# per backend slot). The tables, name_trn.csv and name_tst_unsorted are written
+# to the current directory, like the single machine pipeline.
+def run_distributed(infile_name = None, backend = None, num_shards = None, fieldselection = 'fieldselection.csv'):
+    pipeline = load_pipeline()
+    if infile_name is None:
+        infile_name = pipeline.problem_name + '_download.csv'
+    if backend is None:
+        backend = LocalBackend()
+    wall = time.perf_counter()
+    with backend:
+        shard_dirs = split_into_shards(infile_name, num_shards or backend.slots, fieldselection=fieldselection)
+
+        backend.run('count', shard_dirs, get_files=['counts.json'])
+        keep = None
+        if pipeline.count_top_k is not None:
+            keep = write_shard_keep(pipeline, shard_dirs)
+            backend.run('recount', shard_dirs, put_files=['keep.json'], get_files=['counts.json'])
+        attr_list, impression_cnt, click_cnt = merge_shard_counts(pipeline, shard_dirs, keep)
+
+        tables = [attr + '_int.csv' for attr in attr_list] + [attr + '_int.bin' for attr in attr_list]
+        tables.append(pipeline.problem_name + '_impression_click_counts.csv')
+        trn_name = pipeline.problem_name + '_trn.csv'
+        tst_name = pipeline.problem_name + '_tst_unsorted' + pipeline.data_ext
+        backend.run('convert', shard_dirs, put_files=tables, get_files=[trn_name, tst_name])
+        rows_in, rows_out = merge_shard_trn(pipeline, shard_dirs, len(attr_list))
+        concat_shard_files(shard_dirs, tst_name)
+    print("Ran {} shards in {:.1f} secs: {:,} impressions, {:,} clicks, {:,} trn rows compressed to {:,}".format(
+        len(shard_dirs), time.perf_counter() - wall, impression_cnt, click_cnt, rows_in, rows_out))
+    return shard_dirs
+
+# Write keep.json, the values of each attribute that any shard kept in a capped
+# count, for the shards to recount exactly. Returns them.
+def write_shard_keep(pipeline, shard_dirs, file_name = 'keep.json'):
+    keep = dict()
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'counts.json'), 'r') as f:
+            part = json.load(f)
+        for attr in part['attr_list'][1:]:
+            keep.setdefault(attr, set()).update([k for k, i, c in part['counts'][attr] if k != pipeline.other_val])
+    keep = dict([(attr, sorted(values)) for attr, values in keep.items()])
+    with open(file_name, 'w') as f:
+        json.dump(keep, f)
+    return keep
+
+# Add up the counts.json of the shards and write the conversion tables. With
+# keep (a capped count) the totals go into counters like recount_top_values',
+# which keep the count_top_k values with the most rows.
+def merge_shard_counts(pipeline, shard_dirs, keep = None):
+    cnts = None
+    impression_cnt = 0
+    click_cnt = 0
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'counts.json'), 'r') as f:
+            part = json.load(f)
+        attr_list = part['attr_list']
+        if cnts is None and keep is not None:
+            cnts = pipeline.new_attr_counts(attr_list, keep)
+        elif cnts is None:
+            cnts = dict([(attr, dict()) for attr in attr_list])
+        impression_cnt += part['impressions']
+        click_cnt += part['clicks']
+        for attr in attr_list:
+            if keep is not None:
+                for k, i, c in part['counts'][attr]:
+                    cnts[attr].add(k, 0, i)
+                    cnts[attr].add(k, 1, c)
+            else:
+                pipeline.merge_attr_counts(cnts[attr], dict([(k, [i, c]) for k, i, c in part['counts'][attr]]))
+    pipeline.write_int_conversion_tables(cnts, attr_list, impression_cnt, click_cnt)
+    return attr_list, impression_cnt, click_cnt
+
+# merge the compressed trn shards into name_trn.csv, adding up the copies
+def merge_shard_trn(pipeline, shard_dirs, num_attrs):
+    trn_name = pipeline.problem_name + '_trn.csv'
+    files = [open(os.path.join(shard_dir, trn_name), 'r', encoding=pipeline.data_encoding) for shard_dir in shard_dirs]
+    rows_in = 0
+    rows_out = 0
+    try:
+        rows = itertools.chain(*[csv.reader(f, delimiter=',') for f in files])
+        with open(trn_name, 'w', encoding=pipeline.data_encoding) as out:
+            writer = csv.writer(out, delimiter=',')
+            for row in pipeline.hash_aggregate(rows, num_attrs + 1, pipeline.hash_memory_mb, weighted=True): #all attrs, plus the action
+                writer.writerow(row)
+                rows_in += row[-1]
+                rows_out += 1
+    finally:
+        for f in files:
+            f.close()
+    print("Wrote file", trn_name)
+    return rows_in, rows_out
+
+# Concatenate a file from each shard. Compressed files concatenate as they are:
+# gzip, zstd and lz4 all read a file of several streams as one.
+def concat_shard_files(shard_dirs, name):
+    with open(name, 'wb') as out:
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, name), 'rb') as f:
+                shutil.copyfileobj(f, out, 1 << 24)
+    print("Wrote file", name)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--task']:
+        run_task(sys.argv[2], sys.argv[3])
+        sys.exit()
+    if sys.argv[1:2] == ['--hosts']:
+        run_distributed(backend=SSHBackend(sys.argv[2].split(',')))
+    elif sys.argv[1:2] == ['--ec2']:
+        run_distributed(backend=EC2Backend(int(sys.argv[2])))
+    else:
+        run_distributed()
@@ -0,0 +1,26 @@
+import importlib.util
+import os
+import sys
+
+# "VistaPrint Parse Data.py" can't be imported by name, so the scripts that
+# drive it load it with load_pipeline.
+
+pipeline_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "VistaPrint Parse Data.py")
+module_name = "vistaprint_parse_data"
+
+# Load the parsing pipeline from its script, once per process. It is put in
+# sys.modules like an imported module, so its functions can be pickled for a
+# process pool (e.g. create_int_conversion_tables with processes > 1).
+def load_pipeline():
+    pipeline = sys.modules.get(module_name)
+    if pipeline is not None:
+        return pipeline
+    spec = importlib.util.spec_from_file_location(module_name, pipeline_script)
+    pipeline = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = pipeline
+    try:
+        spec.loader.exec_module(pipeline)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return pipeline
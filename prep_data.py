@@ -1,7 +1,9 @@
-import pandas 
+import numpy as np
+import pandas
 from pandas import *
 
-import pandas.util.testing as tm; tm.N = 3
+unpivot_chunk_columns = 64 # columns per long format block from unpivot_chunks
+
 def unpivot(frame):
     N, K = frame.shape
     data = {'value' : frame.values.ravel('F'),
@@ -9,7 +11,80 @@ def unpivot(frame):
             'date' : np.tile(np.asarray(frame.index), K)}
     return DataFrame(data, columns=['date', 'variable', 'value'])
 
-df = unpivot(tm.makeTimeDataFrame())
-pivoted_data=df.pivot(index='date', columns='variable', values='value')
+# Unpivot a group of columns at a time. Yields long format frames like unpivot,
+# one per columns_per_chunk columns, so only one group is copied at once.
+# variable is a Categorical over all the columns of frame, so its codes are
+# the column positions, which pivot_chunks uses directly.
+def unpivot_chunks(frame, columns_per_chunk = unpivot_chunk_columns):
+    N, K = frame.shape
+    columns = Index(frame.columns)
+    dates = np.asarray(frame.index)
+    for start in range(0, K, columns_per_chunk):
+        end = min(start + columns_per_chunk, K)
+        values = frame.iloc[:, start:end].to_numpy().ravel('F')
+        codes = np.arange(start, end, dtype=smallest_code_dtype(K)).repeat(N)
+        data = {'value' : values,
+                'variable' : Categorical.from_codes(codes, categories=columns),
+                'date' : np.tile(dates, end - start)}
+        yield DataFrame(data, columns=['date', 'variable', 'value'])
+
+def smallest_code_dtype(n):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+# Put values into a wide array at (row code, column code), like df.pivot on
+# codes. out is preallocated (it can be a numpy.memmap); if it is None a
+# shape array of fill is made. A code given twice keeps the last value.
+def pivot_codes(row_codes, col_codes, values, shape, out = None, fill = np.nan, dtype = np.float64):
+    if out is None:
+        out = np.full(shape, fill, dtype=dtype)
+    out[row_codes, col_codes] = values
+    return out
+
+# Build the wide frame from long format blocks (from unpivot_chunks or any
+# frames with date, variable and value columns) without concatenating them:
+# each block's dates and variables are turned into row and column codes and
+# its values are put straight into the output array.
+# index and columns are the wide frame's labels; found from the blocks if not
+# given, which needs them all in memory at once.
+def pivot_chunks(chunks, index = None, columns = None, dtype = np.float64, out = None):
+    if index is None or columns is None:
+        chunks = list(chunks)
+        if index is None:
+            index = Index(pandas.unique(np.concatenate([np.asarray(c['date']) for c in chunks]))).sort_values()
+        if columns is None:
+            columns = Index(pandas.unique(np.concatenate([np.asarray(c['variable']) for c in chunks]))).sort_values()
+    index = Index(index)
+    columns = Index(columns)
+    if out is None:
+        out = np.full((len(index), len(columns)), np.nan, dtype=dtype)
+    for chunk in chunks:
+        row_codes = index.get_indexer(chunk['date'])
+        variable = chunk['variable']
+        if isinstance(variable.dtype, CategoricalDtype) and variable.cat.categories.equals(columns):
+            col_codes = variable.cat.codes.to_numpy()
+        else:
+            col_codes = columns.get_indexer(variable)
+        if (row_codes < 0).any() or (col_codes < 0).any():
+            raise KeyError("Block has dates or variables that are not in index or columns")
+        pivot_codes(row_codes, col_codes, chunk['value'].to_numpy(), out.shape, out)
+    return DataFrame(out, index=index, columns=columns, copy=False)
+
+# small time series frame, like pandas' old makeTimeDataFrame
+def make_time_frame(rows = 3, columns = 'ABCD'):
+    index = bdate_range('2000-01-03', periods=rows, name='date')
+    return DataFrame(np.random.randn(rows, len(columns)), index=index, columns=list(columns))
+
+
+if __name__ == '__main__':
+    frame = make_time_frame()
+    df = unpivot(frame)
+    pivoted_data=df.pivot(index='date', columns='variable', values='value')
+
+    print(pivoted_data)
 
-print pivoted_data
+    # the same, a column group at a time
+    pivoted_chunks = pivot_chunks(unpivot_chunks(frame, 2), frame.index, frame.columns)
+    print(pivoted_chunks)
@@ -1,12 +1,51 @@
+import time
 import boto.ec2
-conn = boto.ec2.connect_to_region("us-west-2",
-aws_access_key_id='<aws access key>',
-aws_secret_access_key='<aws secret key>')
 
-conn.run_instances('<ami-image-id>')
-# do some processing
+region = "us-west-2"
+aws_access_key_id = '<aws access key>'
+aws_secret_access_key = '<aws secret key>'
+image_id = '<ami-image-id>'
+instance_type = 'm3.xlarge'
+key_name = None # key pair for ssh to the instances
+security_groups = None
 
-reservations = conn.get_all_instances()
-my_instance_ids = reservations.instances
-conn.stop_instances(instance_ids=my_instance_ids)
+def connect(region = region):
+    return boto.ec2.connect_to_region(region,
+                                      aws_access_key_id=aws_access_key_id,
+                                      aws_secret_access_key=aws_secret_access_key)
 
+# launch count instances and return them
+def start_instances(conn, count = 1, image_id = image_id, instance_type = instance_type):
+    reservation = conn.run_instances(image_id, min_count=count, max_count=count, instance_type=instance_type,
+                                     key_name=key_name, security_groups=security_groups)
+    return reservation.instances
+
+# wait for the instances to be running, returns their public DNS names
+def wait_until_running(instances, timeout = 600, poll_seconds = 10):
+    deadline = time.time() + timeout
+    for instance in instances:
+        while instance.update() != 'running':
+            if time.time() > deadline:
+                raise RuntimeError("Instance {} is still {}".format(instance.id, instance.state))
+            time.sleep(poll_seconds)
+    return [instance.public_dns_name for instance in instances]
+
+# Stop (or terminate) the given instances. The ids must be given: an empty
+# list is an error rather than every instance in the account.
+def stop_instances(conn, instance_ids, terminate = False):
+    instance_ids = list(instance_ids or [])
+    if not instance_ids:
+        raise ValueError("stop_instances needs the ids of the instances to stop")
+    if terminate:
+        conn.terminate_instances(instance_ids=instance_ids)
+    else:
+        conn.stop_instances(instance_ids=instance_ids)
+    return instance_ids
+
+
+if __name__ == '__main__':
+    conn = connect()
+    instances = start_instances(conn)
+    # do some processing
+
+    stop_instances(conn, [instance.id for instance in instances])
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_pipeline import generate_download, generate_fieldselection
+from pipeline_loader import load_pipeline
+
+download_rows = 3000 # rows of the download generated by data_dir
+
+
+@pytest.fixture
+def pipeline():
+    return load_pipeline()
+
+
+# A temporary directory, made the current one, with the benchmark's
+# fieldselection.csv and a generated name_download.csv of download_rows rows.
+@pytest.fixture
+def data_dir(pipeline, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    generate_fieldselection()
+    generate_download(pipeline.problem_name + '_download.csv', download_rows)
+    return tmp_path
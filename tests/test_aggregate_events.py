@@ -0,0 +1,70 @@
+import csv
+from collections import defaultdict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+
+# the report aggregate_events should write, counted a row at a time
+def naive_report(pipeline, file_name, bucket, group_by, time_column='created_at'):
+    events = pipeline.event_names
+    zone = ZoneInfo(pipeline.report_time_zone)
+    with open(file_name) as f:
+        rows = list(csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONE))
+    header = [h.strip() for h in rows[0]]
+    counts = defaultdict(lambda: [0] * len(events))
+    for row in rows[1:]:
+        if len(row) != len(header) or row[header.index('action_id')] not in events:
+            continue
+        t = row[header.index(time_column)]
+        t = int(t) if t.isdigit() else pipeline.convert_to_timestamp(t)
+        local = datetime.fromtimestamp(t, zone)
+        sort_key = {'day': local.date().toordinal(), 'hour': local.hour, 'dow': local.weekday(),
+                    'julian': local.timetuple().tm_yday}[bucket]
+        label = {'day': local.strftime('%Y-%m-%d'), 'dow': pipeline.dow_names[local.weekday()]}.get(bucket, str(sort_key))
+        group = [row[header.index(group_by)]] if group_by else []
+        counts[(sort_key, tuple(group), label)][events.index(row[header.index('action_id')])] += 1
+    report = [[bucket] + ([group_by] if group_by else []) + ['event', 'count']]
+    for sort_key, group, label in sorted(counts):
+        for e, c in zip(events, counts[(sort_key, group, label)]):
+            report.append([label] + list(group) + [e, str(c)])
+    return report
+
+
+def read_report(file_name):
+    with open(file_name) as f:
+        return list(csv.reader(f))
+
+
+@pytest.mark.parametrize('bucket', ['day', 'hour', 'dow', 'julian'])
+@pytest.mark.parametrize('group_by', [None, 'site'])
+def test_aggregate_events_matches_naive_counts(pipeline, data_dir, monkeypatch, bucket, group_by):
+    monkeypatch.setattr(pipeline, 'event_chunk_rows', 700)
+    pipeline.standardize_file()
+    raw = pipeline.problem_name + '_raw.csv'
+    counts = pipeline.aggregate_events(bucket=bucket, group_by=group_by)
+    report = read_report(pipeline.problem_name + '_events.csv')
+    assert report == naive_report(pipeline, raw, bucket, group_by)
+    assert sum(int(row[-1]) for row in report[1:]) == sum(int(c.sum()) for c in counts.values())
+
+
+def test_aggregate_events_unix_times_and_bad_lines(pipeline, data_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'event_chunk_rows', 500)
+    name = pipeline.problem_name + '_download.csv'
+    with open(name) as f:
+        rows = list(csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONE))
+    time_index = rows[0].index('created_at')
+    with open('unix.csv', 'w') as f:
+        f.write(';'.join(rows[0]) + '\n')
+        for row in rows[1:]:
+            if len(row) == len(rows[0]):
+                row[time_index] = str(pipeline.convert_to_timestamp(row[time_index]))
+            f.write(';'.join(row) + '\n')
+    pipeline.aggregate_events('unix.csv', 'unix_events.csv', bucket='hour', group_by='country')
+    assert read_report('unix_events.csv') == naive_report(pipeline, 'unix.csv', 'hour', 'country')
+
+    with pytest.raises(ValueError):
+        pipeline.aggregate_events('unix.csv', bucket='week')
+    with pytest.raises(ValueError):
+        pipeline.aggregate_events('unix.csv', group_by='referrer')
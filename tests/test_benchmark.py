@@ -0,0 +1,64 @@
+import csv
+import json
+import os
+import re
+import time
+
+import benchmark_pipeline
+from benchmark_pipeline import generate_download, parse_rows, run_benchmark
+
+
+def read_download(file_name):
+    with open(file_name) as f:
+        return list(csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONE))
+
+
+def test_generated_download(pipeline, data_dir):
+    rows = read_download(pipeline.problem_name + '_download.csv')
+    header = rows[0]
+    assert len(rows) == 3001
+    assert header[:3] == ['id', 'action_id', 'created_at']
+    good = [row for row in rows[1:] if len(row) == len(header)]
+    assert 0 < len(rows) - 1 - len(good) < 20 # the bad lines standardize_file drops
+
+    # the same seed gives the same file, another seed another
+    generate_download('again.csv', 3000)
+    assert read_download('again.csv') == rows
+    generate_download('other.csv', 3000, seed=2)
+    assert read_download('other.csv') != rows
+
+    cols = dict([(name, header.index(name)) for name, n, kind in benchmark_pipeline.attr_columns])
+    for name, n, kind in benchmark_pipeline.attr_columns:
+        values = set(benchmark_pipeline.attr_values(name, n, kind))
+        assert set(row[cols[name]] for row in good) <= values
+    # day_of_week and hour_of_day agree with created_at
+    for row in good[:200]:
+        t = time.strptime(row[2][:19].replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+        assert row[cols['day_of_week']] == str(t.tm_wday)
+        assert row[cols['hour_of_day']] == str(t.tm_hour)
+
+    pipeline.standardize_file()
+    assert pipeline.stage_reports[-1]['rows_out'] == len(good) + 1
+
+
+def test_run_benchmark_saves_and_compares_a_baseline(pipeline, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(benchmark_pipeline, 'bench_dir', str(tmp_path / 'bench'))
+    stages = benchmark_pipeline.bench_stages[:4]
+    assert parse_rows('1M') == 1000000 and parse_rows('2000') == 2000
+
+    results = run_benchmark(2000, save_baseline=True, stages=stages)
+    assert [r['label'] for r in results] == ['standardize_file', 'reduce_file', 'create_int_conversion_tables',
+                                             'convert_to_ints']
+    assert results[0]['rows_in'] == 2001
+    assert all(r['rows_per_sec'] > 0 for r in results)
+    with open(benchmark_pipeline.baseline_file) as f:
+        assert sorted(json.load(f)['2000']) == sorted(r['label'] for r in results)
+    # the generated data is kept for the next run
+    assert os.path.exists(os.path.join('bench', '2000', pipeline.problem_name + '_int.csv'))
+
+    capsys.readouterr()
+    run_benchmark(2000, stages=stages)
+    out = capsys.readouterr().out
+    # each stage is compared with the baseline
+    assert len(re.findall(r' \d+\.\d\dx', out)) == len(stages)
@@ -0,0 +1,92 @@
+import csv
+
+import pytest
+
+
+def read_csv_table(attr):
+    with open(attr + '_int.csv') as f:
+        return dict([(row[1], int(row[0])) for row in csv.reader(f)])
+
+
+@pytest.mark.parametrize('top_k', [None, 5])
+def test_binary_tables_match_csv(pipeline, data_dir, monkeypatch, top_k):
+    monkeypatch.setattr(pipeline, 'count_top_k', top_k)
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 20)
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+
+    csv_tables = pipeline.load_int_conversion_tables(attr_list)
+    monkeypatch.setattr(pipeline, 'table_format', 'binary')
+    bin_tables = pipeline.load_int_conversion_tables(attr_list)
+    for attr in attr_list:
+        table = bin_tables[attr]
+        expected = read_csv_table(attr)
+        assert len(table) == len(expected)
+        assert list(table.items()) == sorted(expected.items(), key=lambda item: item[1])
+        for value, code in expected.items():
+            assert value in table
+            assert table[value] == code == csv_tables[attr][value]
+            assert table.decode(code) == value
+        values = list(expected) * 2
+        assert table.encode_many(values) == [expected[v] for v in values]
+        assert table.encode_many(values, as_str=True) == [str(expected[v]) for v in values]
+        assert table.decode_many([str(c) for c in expected.values()]) == list(expected)
+
+        # values the table hasn't seen
+        if pipeline.other_val in expected:
+            assert table['never seen'] == expected[pipeline.other_val] == csv_tables[attr]['never seen']
+        else:
+            assert 'never seen' not in table
+            assert table.get('never seen') is None
+            with pytest.raises(KeyError):
+                table['never seen']
+            with pytest.raises(KeyError):
+                csv_tables[attr]['never seen']
+        with pytest.raises(IndexError):
+            table.decode(len(table))
+        table.close()
+    if top_k is not None:
+        assert any(pipeline.other_val in read_csv_table(attr) for attr in attr_list)
+
+
+def test_binary_table_edge_values(pipeline, tmp_path):
+    file_name = str(tmp_path / 't_int.bin')
+    values = ['', 'café', '日本', 'a;b', '0', '00', pipeline.other_val] + ['v' + str(i) for i in range(1000)]
+    pipeline.write_binary_table(file_name, values)
+    table = pipeline.ConversionTable(file_name)
+    assert [table[v] for v in values] == list(range(len(values)))
+    assert [table.decode(i) for i in range(len(values))] == values
+    assert table['missing'] == values.index(pipeline.other_val)
+    table.close()
+
+    pipeline.write_binary_table(file_name, [])
+    table = pipeline.ConversionTable(file_name)
+    assert len(table) == 0 and table.get('a') is None
+    table.close()
+
+    with open(file_name, 'wb') as f:
+        f.write(b'not a table' * 10)
+    with pytest.raises(ValueError):
+        pipeline.ConversionTable(file_name)
+
+
+def test_incremental_runs_keep_binary_tables_in_step(pipeline, data_dir, monkeypatch):
+    name = pipeline.problem_name + '_download.csv'
+    with open(name) as f:
+        lines = f.readlines()
+    with open(name, 'w') as f:
+        f.writelines(lines[:1500])
+    pipeline.run_incremental(time_cutoff='2014-05-22 00:00:00')
+    with open(name, 'a') as f:
+        f.writelines(lines[1500:])
+    pipeline.run_incremental()
+
+    fields = pipeline.read_field_selections(trace=False)
+    monkeypatch.setattr(pipeline, 'table_format', 'binary')
+    for attr in [fields['depvar_name']] + list(fields['attrs'].keys()):
+        table = pipeline.load_int_conversion_tables([attr])[attr]
+        assert list(table.items()) == sorted(read_csv_table(attr).items(), key=lambda item: item[1])
+        table.close()
@@ -0,0 +1,47 @@
+import csv
+
+import numpy as np
+
+
+def test_bitmap_index_between_uses_values(pipeline, data_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'bitmap_sparse_ratio', 8)
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.sort_by_time()
+    pipeline.split_into_tst_trn()
+    pipeline.sort_for_compress('trn')
+    pipeline.compress_with_copies('trn')
+    idx = pipeline.BitmapIndex(pipeline.build_bitmap_index('trn'))
+
+    fields = pipeline.read_field_selections(trace=False)
+    col_names = [fields['depvar_name']] + list(fields['attrs'].keys()) + list(fields['data'].keys()) + ['copies']
+    hour = col_names.index('hour_of_day')
+    with open('hour_of_day_int.csv') as f:
+        values = dict([(row[0], row[1]) for row in csv.reader(f)])
+    with open(pipeline.problem_name + '_trn.csv') as f:
+        rows = list(csv.reader(f))
+
+    expected = [i for i, row in enumerate(rows) if 9 <= int(values[row[hour]]) <= 17]
+    q = idx.between('hour_of_day', 9, 17)
+    assert 0 < len(expected) < len(rows)
+    assert list(idx.row_ids(q)) == expected
+    assert idx.count(q) == len(expected)
+    assert idx.weighted_count(q) == sum(int(rows[i][-1]) for i in expected)
+
+    # every bitmap, gaps or bits, has the rows of its value
+    kinds = set()
+    for code in idx.values('site'):
+        kinds.add(idx.column('site')['values'][code][2])
+        got = idx.row_ids(idx.eq('site', code))
+        assert list(got) == [i for i, row in enumerate(rows) if row[1] == code]
+    assert kinds == {'gaps', 'bits'}
+
+
+def test_row_ids_to_bits(pipeline):
+    row_ids = np.array([0, 3, 7, 8, 9, 63, 64, 99])
+    mask = np.zeros(100, dtype=bool)
+    mask[row_ids] = True
+    assert pipeline.row_ids_to_bits(row_ids, 100) == np.packbits(mask, bitorder='little').tobytes()
+    assert pipeline.row_ids_to_bits(np.zeros(0, dtype='<u8'), 10) == bytes(2)
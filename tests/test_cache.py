@@ -0,0 +1,98 @@
+import csv
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def int_file(pipeline, data_dir):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    return pipeline.problem_name + '_int.csv'
+
+
+def read_column(file_name, i):
+    with open(file_name) as f:
+        return [int(row[i]) for row in csv.reader(f)]
+
+
+def entries(pipeline):
+    return sorted(name for name in os.listdir(pipeline.cache_dir)
+                  if os.path.isdir(os.path.join(pipeline.cache_dir, name)))
+
+
+# change a file by repeating its first row at the end
+def grow(file_name):
+    with open(file_name) as f:
+        line = f.readline()
+    with open(file_name, 'a') as f:
+        f.write(line)
+
+
+# make an entry look last used seconds ago
+def age(pipeline, name, seconds):
+    t = time.time() - seconds
+    os.utime(os.path.join(pipeline.cache_dir, name), (t, t))
+
+
+def test_cache_hit_matches_csv(pipeline, int_file, monkeypatch):
+    builds = []
+    build = pipeline.build_cache_entry
+    monkeypatch.setattr(pipeline, 'build_cache_entry', lambda *args: builds.append(args) or build(*args))
+
+    t = pipeline.load_tdata(int_file)
+    assert len(builds) == 1
+    assert t[t.columns[0]].tolist() == read_column(int_file, 0)
+    assert t[t.columns[1]].tolist() == read_column(int_file, 1)
+    t.close()
+    t = pipeline.load_tdata(int_file)
+    assert len(builds) == 1
+    assert len(entries(pipeline)) == 1
+    t.close()
+
+    # a changed file gets a new entry
+    grow(int_file)
+    t = pipeline.load_tdata(int_file)
+    assert len(builds) == 2
+    assert len(t) == len(read_column(int_file, 0))
+    assert len(entries(pipeline)) == 2
+    t.close()
+
+
+def test_cache_evicts_least_recently_used(pipeline, int_file, monkeypatch):
+    monkeypatch.setattr(pipeline, 'cache_min_age_seconds', 600)
+    keys = []
+    for i in range(4):
+        grow(int_file)
+        pipeline.load_tdata(int_file).close()
+        keys.append(pipeline.dataset_cache_key(int_file))
+    assert entries(pipeline) == sorted(keys)
+    for i, key in enumerate(keys):
+        age(pipeline, key, 10000 - i)
+
+    # only room for about two entries
+    size = sum(os.path.getsize(os.path.join(pipeline.cache_dir, keys[0], f))
+               for f in os.listdir(os.path.join(pipeline.cache_dir, keys[0])))
+    held = pipeline.CachedDataset(os.path.join(pipeline.cache_dir, keys[0]))
+    age(pipeline, keys[3], 0) # used recently
+    pipeline.evict_cache(budget_mb=2.5 * size / (1024 * 1024), keep=keys[2])
+    # keys[0] is open, keys[2] is kept and keys[3] is too recent, so only keys[1] goes
+    assert entries(pipeline) == sorted([keys[0], keys[2], keys[3]])
+    held.close()
+
+    pipeline.evict_cache(budget_mb=0, keep=keys[2])
+    assert entries(pipeline) == sorted([keys[2], keys[3]])
+
+
+def test_compressed_file_gets_copies_column(pipeline, int_file):
+    with open(int_file) as f:
+        rows = list(csv.reader(f))
+    with open('copies.csv', 'w', newline='') as f:
+        csv.writer(f).writerows([row + [str(i % 3 + 1)] for i, row in enumerate(rows)])
+    t = pipeline.load_tdata('copies.csv')
+    assert t.columns[-1] == 'copies'
+    assert t['copies'].tolist() == [i % 3 + 1 for i in range(len(rows))]
+    t.close()
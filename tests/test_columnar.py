@@ -0,0 +1,79 @@
+import csv
+import os
+
+import numpy as np
+
+
+# the rows of a columnar dataset, with dictionary codes put back to values
+def read_columnar(pipeline, path):
+    header = pipeline.read_columnar_header(path)
+    arrays = pipeline.open_columnar(path)
+    columns = []
+    for col in header['columns']:
+        values = arrays[col['name']].tolist()
+        if col['kind'] == 'dict':
+            table = pipeline.columnar_values(path, col['name'])
+            values = [table[v] for v in values]
+        columns.append([str(v) for v in values])
+    return [list(row) for row in zip(*columns)]
+
+
+def write_columnar(pipeline, path, names, rows, attr_tables=(), chunk_rows=2):
+    writer = pipeline.ColumnarWriter(path, names, attr_tables=attr_tables, chunk_rows=chunk_rows)
+    writer.writerows(rows)
+    writer.close()
+    return dict([(col['name'], col) for col in pipeline.read_columnar_header(path)['columns']])
+
+
+def test_columnar_int_file_round_trip(pipeline, data_dir):
+    name = pipeline.problem_name
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.convert_to_ints(output_format='columnar')
+    with open(name + '_int.csv') as f:
+        expected = list(csv.reader(f))
+    assert read_columnar(pipeline, name + '_int.col') == expected
+
+    # and through the dataset cache
+    t = pipeline.load_tdata()
+    fields = pipeline.read_field_selections(trace=False)
+    assert t.rows == len(expected)
+    assert t[fields['depvar_name']].tolist() == [int(row[0]) for row in expected]
+    t.close()
+
+
+def test_inferred_int_column_widens_without_losing_strings(pipeline, tmp_path):
+    rows = [['1', '5'], ['-2', '-3'], ['0123', '7'], ['x', '8'], ['+4', '9']]
+    cols = write_columnar(pipeline, str(tmp_path / 'd.col'), ['a', 'b'], rows)
+    assert cols['a']['kind'] == 'dict'
+    assert cols['b']['kind'] == 'int'
+    assert read_columnar(pipeline, str(tmp_path / 'd.col')) == rows
+
+    # a first chunk with a zero padded value is dictionary coded from the start
+    rows = [['007', '1'], ['8', '2']]
+    cols = write_columnar(pipeline, str(tmp_path / 'e.col'), ['a', 'b'], rows)
+    assert cols['a']['kind'] == 'dict'
+    assert read_columnar(pipeline, str(tmp_path / 'e.col')) == rows
+
+
+def test_code_column_widens_past_its_table(pipeline, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # a table of 3 values, but data converted against a bigger one
+    with open('site_int.csv', 'w') as f:
+        f.write('0,a,1,0,0.0\n1,b,1,0,0.0\n2,c,1,0,0.0\n')
+    rows = [['0', 'x'], ['2', 'y'], ['256', 'z'], ['1', 'w'], ['70000', 'v']]
+    cols = write_columnar(pipeline, 'd.col', ['site', 'other'], rows, attr_tables=['site'])
+    assert cols['site']['kind'] == 'code'
+    assert cols['site']['dtype'] == 'uint32'
+    assert read_columnar(pipeline, 'd.col') == rows
+
+    cols = write_columnar(pipeline, 'e.col', ['site'], [['1'], ['2']], attr_tables=['site'])
+    assert cols['site']['dtype'] == 'uint8'
+
+    cols = write_columnar(pipeline, 'f.col', ['site'], [['1'], ['2'], ['-1']], attr_tables=['site'])
+    assert cols['site']['dtype'] == 'int64'
+    assert pipeline.open_columnar('f.col')['site'].tolist() == [1, 2, -1]
+    assert sorted(os.listdir('.')) == ['d.col', 'e.col', 'f.col', 'site_int.csv']
+    assert np.dtype(pipeline.open_columnar('d.col')['site'].dtype) == np.dtype('<u4')
@@ -0,0 +1,62 @@
+import os
+import tempfile
+
+import pytest
+
+
+def prepare_trn(pipeline):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.sort_by_time()
+    pipeline.split_into_tst_trn()
+    pipeline.sort_for_compress('trn')
+    # a depvar value of its own in the last group, which is written after the loop
+    name = pipeline.problem_name
+    with open(name + '_trn_sorted.csv') as f:
+        last = f.read().splitlines()[-1].split(',')
+    last[0] = str(int(last[0]) + 1)
+    for suffix in ['_trn_sorted.csv', '_trn_unsorted.csv']:
+        with open(name + suffix, 'a') as f:
+            f.write(','.join(last) + '\n')
+    return last[0]
+
+
+# run compress_with_copies, returning its output and the stats it prints
+def compress(pipeline, monkeypatch, **kwargs):
+    stats = []
+    monkeypatch.setattr(pipeline, 'print_compress_stats', lambda *args: stats.append(args))
+    pipeline.compress_with_copies('trn', **kwargs)
+    with open(pipeline.problem_name + '_trn.csv') as f:
+        return f.read(), stats[0]
+
+
+@pytest.mark.parametrize('memory_mb, partitions', [(None, 16), (0.05, 4), (0.002, 2)])
+def test_hash_compress_matches_sorted(pipeline, data_dir, monkeypatch, memory_mb, partitions):
+    monkeypatch.setattr(pipeline, 'hash_partitions', partitions)
+    # few values per attribute, so rows collapse into copies
+    monkeypatch.setattr(pipeline, 'count_top_k', 2)
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 20)
+    new_depvar = prepare_trn(pipeline)
+    expected, expected_stats = compress(pipeline, monkeypatch)
+    lines_read, lines_written, depvar_read, depvar_written = expected_stats
+    assert depvar_written[new_depvar] == 1
+    assert lines_written < lines_read
+    assert sum(depvar_read.values()) == lines_read
+    assert sum(depvar_written.values()) == lines_written
+
+    os.remove(pipeline.problem_name + '_trn.csv')
+    os.mkdir('spill')
+    monkeypatch.setattr(tempfile, 'tempdir', str(data_dir / 'spill'))
+    # spills with a small memory_mb, and partitions again when a partition is still too big
+    output, stats = compress(pipeline, monkeypatch, mode='hash', memory_mb=memory_mb)
+    assert output == expected
+    assert stats == expected_stats
+    # the partition and run files are removed
+    assert os.listdir('spill') == []
+
+
+def test_unknown_compress_mode(pipeline, data_dir):
+    with pytest.raises(ValueError):
+        pipeline.compress_with_copies('trn', mode='bucket')
@@ -0,0 +1,57 @@
+import os
+import shutil
+
+import pytest
+
+stage_files = ['_raw', '_reduced', '_int', '_int_sorted', '_tst_unsorted', '_trn_unsorted']
+
+
+def run_stages(pipeline):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.sort_by_time()
+    pipeline.split_into_tst_trn()
+
+
+def read_data(pipeline, file_name):
+    with pipeline.open_data(file_name, 'r') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('ext', ['.csv.gz', '.csv.zst', '.csv.lz4'])
+def test_compressed_stages_match_plain(pipeline, data_dir, monkeypatch, ext):
+    if ext == '.csv.zst':
+        pytest.importorskip('zstandard')
+    if ext == '.csv.lz4':
+        pytest.importorskip('lz4')
+    name = pipeline.problem_name
+    assert pipeline.data_ext == '.csv'
+    run_stages(pipeline)
+    expected = dict([(suffix, read_data(pipeline, name + suffix + '.csv')) for suffix in stage_files])
+
+    os.mkdir('compressed')
+    os.chdir('compressed')
+    shutil.copy(data_dir / 'fieldselection.csv', '.')
+    shutil.copy(data_dir / (name + '_download.csv'), '.')
+    # data_ext is read when the stages run, not when the script is loaded
+    monkeypatch.setattr(pipeline, 'data_ext', ext)
+    run_stages(pipeline)
+    for suffix in stage_files:
+        assert not os.path.exists(name + suffix + '.csv')
+        assert read_data(pipeline, name + suffix + ext) == expected[suffix], suffix
+
+
+@pytest.mark.parametrize('use_pigz', [False, True])
+def test_gzip_round_trip(pipeline, tmp_path, monkeypatch, use_pigz):
+    if use_pigz and not shutil.which('pigz'):
+        pytest.skip('pigz is not installed')
+    monkeypatch.setattr(pipeline, 'use_pigz', use_pigz)
+    text = ''.join(['{},café,{}\n'.format(i, i * i) for i in range(20000)])
+    file_name = str(tmp_path / 'rows.csv.gz')
+    with pipeline.open_data(file_name, 'w') as f:
+        f.write(text)
+    assert read_data(pipeline, file_name) == text
+    with open(file_name, 'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import pytest
+
+
+def read_bytes(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def prepare_reduced(pipeline):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    # data values the csv writer has to quote
+    name = pipeline.problem_name + '_reduced.csv'
+    with open(name) as f:
+        lines = f.read().splitlines()
+    for i, value in [(5, 'x,y'), (7, 'q"r')]:
+        lines[i] = lines[i].rsplit(';', 1)[0] + ';' + value
+    with open(name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+@pytest.mark.parametrize('top_k', [None, 5])
+@pytest.mark.parametrize('table_format', ['csv', 'binary'])
+@pytest.mark.parametrize('chunk_rows', [100000, 7])
+def test_chunked_convert_matches_python(pipeline, data_dir, monkeypatch, top_k, table_format, chunk_rows):
+    monkeypatch.setattr(pipeline, 'count_top_k', top_k)
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 20)
+    monkeypatch.setattr(pipeline, 'convert_chunk_rows', chunk_rows)
+    prepare_reduced(pipeline)
+    name = pipeline.problem_name
+    pipeline.convert_to_ints()
+    expected = read_bytes(name + '_int.csv')
+    assert b'"x,y"' in expected
+
+    monkeypatch.setattr(pipeline, 'table_format', table_format)
+    pipeline.convert_to_ints(outfile='chunked.csv', engine='chunked')
+    assert read_bytes('chunked.csv') == expected
+
+
+def test_chunked_convert_uses_binary_tables_if_there(pipeline, data_dir, monkeypatch):
+    prepare_reduced(pipeline)
+    name = pipeline.problem_name
+    pipeline.convert_to_ints()
+    encodes = []
+    encode_many = pipeline.ConversionTable.encode_many
+    monkeypatch.setattr(pipeline.ConversionTable, 'encode_many',
+                        lambda self, values, as_str=False: encodes.append(self) or encode_many(self, values, as_str))
+    fields = pipeline.read_field_selections(trace=False)
+    pipeline.convert_to_ints(outfile='chunked.csv', engine='chunked')
+    assert len(encodes) == 1 + len(fields['attrs'])
+
+    encodes = []
+    for attr in [fields['depvar_name']] + list(fields['attrs'].keys()):
+        os.remove(attr + '_int.bin')
+    pipeline.convert_to_ints(outfile='chunked.csv', engine='chunked')
+    assert encodes == []
+    assert read_bytes('chunked.csv') == read_bytes(name + '_int.csv')
+
+
+def test_chunked_convert_to_columnar(pipeline, data_dir):
+    prepare_reduced(pipeline)
+    name = pipeline.problem_name
+    pipeline.convert_to_ints(output_format='columnar')
+    shutil.move(name + '_int.col', 'python.col')
+    pipeline.convert_to_ints(output_format='columnar', engine='chunked')
+    for file_name in os.listdir('python.col'):
+        assert read_bytes(os.path.join(name + '_int.col', file_name)) == \
+            read_bytes(os.path.join('python.col', file_name)), file_name
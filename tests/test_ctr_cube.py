@@ -0,0 +1,81 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+
+def read_cube(file_name):
+    with open(file_name) as f:
+        return list(csv.DictReader(f))
+
+
+def test_ctr_cube_with_int_coded_action(pipeline, data_dir):
+    with open('fieldselection.csv') as f:
+        selection = f.read()
+    with open('fieldselection.csv', 'w') as f:
+        f.write(selection.replace('data,action_id,str', 'attr,action_id,str'))
+
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    outputs = pipeline.build_ctr_cube(attrs=['site', 'country'], min_support=1, outdir='cube')
+
+    rows = read_cube(outputs[0])
+    impressions = sum(int(row['impressions']) for row in rows)
+    clicks = sum(int(row['clicks']) for row in rows)
+    assert impressions > 0 and clicks > 0
+    assert all(float(row['ctr']) < 1 for row in rows if int(row['impressions']) > 0)
+    assert clicks < impressions
+
+
+def int_coded(pipeline):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    fields = pipeline.read_field_selections(trace=False)
+    return [fields['depvar_name']] + list(fields['attrs'].keys()) + list(fields['data'].keys())
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_ctr_cube_matches_naive_counts(pipeline, data_dir, monkeypatch, processes):
+    monkeypatch.setattr(pipeline, 'cube_chunk_rows', 400)
+    col_names = int_coded(pipeline)
+    with open(pipeline.problem_name + '_int.csv') as f:
+        rows = list(csv.reader(f))
+    combos = [('site', 'country'), ('browser', 'day_of_week'), ('country', 'browser', 'hour_of_day')]
+    outputs = pipeline.build_ctr_cube(attrs=['site', 'country', 'browser', 'day_of_week'], triples=[combos[2]],
+                                      min_support=3, processes=processes, outdir='cube')
+    for combo in combos:
+        counts = dict()
+        for row in rows:
+            key = tuple(row[col_names.index(attr)] for attr in combo)
+            c = counts.setdefault(key, [0, 0])
+            c[row[col_names.index('action_id')] != 'impression'] += 1
+        expected = sorted((key, c) for key, c in counts.items() if sum(c) >= 3)
+        cube = read_cube(os.path.join('cube', '__'.join(combo) + '.csv'))
+        assert os.path.join('cube', '__'.join(combo) + '.csv') in outputs
+        got = [(tuple(row[attr] for attr in combo), [int(row['impressions']), int(row['clicks'])]) for row in cube]
+        assert sorted(got, key=lambda item: tuple(map(int, item[0]))) == \
+            sorted(expected, key=lambda item: tuple(map(int, item[0])))
+
+
+def test_sum_by_key_with_no_keys(pipeline):
+    empty = np.zeros(0, dtype=np.int64)
+    for counts in [pipeline.sum_by_key(empty, empty.astype(bool)), pipeline.sum_by_key(empty, empty, empty)]:
+        assert [len(a) for a in counts] == [0, 0, 0]
+    part = pipeline.sum_by_key(np.array([3, 1, 3]), np.array([True, False, False]))
+    merged = pipeline.merge_key_counts(pipeline.sum_by_key(empty, empty.astype(bool)), part)
+    assert [a.tolist() for a in merged] == [[1, 3], [1, 1], [0, 1]]
+    assert [len(a) for a in pipeline.count_cube_lines([], 3, 2, 'impression', [([0, 1], [4, 4])])[0]] == [0, 0, 0]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_ctr_cube_of_an_empty_file(pipeline, data_dir, processes):
+    int_coded(pipeline)
+    open('empty.csv', 'w').close()
+    outputs = pipeline.build_ctr_cube('empty.csv', attrs=['site', 'country'], min_support=1, processes=processes,
+                                      outdir='cube')
+    assert read_cube(outputs[0]) == []
@@ -0,0 +1,34 @@
+import os
+
+
+def test_dry_run_predicts_run(pipeline, data_dir):
+    targets = ['compress_trn']
+
+    first = pipeline.run_dag(targets, processes=2, dry_run=True)
+    assert first == pipeline.run_dag(targets, processes=2)
+    assert first.count('tables') == 1
+    assert pipeline.run_dag(targets, processes=2, dry_run=True) == []
+    assert pipeline.run_dag(targets, processes=2) == []
+
+    # dropping an attribute recounts the tables in one node and keeps standardize
+    with open('fieldselection.csv') as f:
+        selection = f.read()
+    with open('fieldselection.csv', 'w') as f:
+        f.write(selection.replace('attr,browser,str\n', ''))
+    predicted = pipeline.run_dag(targets, processes=2, dry_run=True)
+    assert 'standardize' not in predicted and 'tables' in predicted
+    assert sorted(predicted) == sorted(pipeline.run_dag(targets, processes=2))
+
+
+def test_counting_processes_are_not_part_of_the_key(pipeline, data_dir, monkeypatch):
+    targets = ['tables']
+    monkeypatch.setattr(pipeline, 'dag_processes', 2)
+    assert pipeline.run_dag(targets) == ['standardize', 'reduce', 'tables']
+    monkeypatch.setattr(pipeline, 'dag_processes', 3)
+    assert pipeline.run_dag(targets) == []
+
+    # the fingerprints are kept in the build state, not in the dataset cache
+    assert not os.path.exists(pipeline.cache_dir)
+    state = pipeline.load_build_state()
+    assert pipeline.problem_name + '_reduced' + pipeline.data_ext in state['fingerprints']
+    assert sorted(state['nodes']) == ['reduce', 'standardize', 'tables']
@@ -0,0 +1,58 @@
+import collections
+import csv
+import os
+import shutil
+
+import pytest
+
+from distributed_pipeline import LocalBackend, run_distributed
+
+
+def read_text(file_name):
+    with open(file_name) as f:
+        return f.read()
+
+
+def read_rows(pipeline, file_name):
+    with pipeline.open_data(file_name, 'r') as f:
+        return list(csv.reader(f))
+
+
+@pytest.mark.parametrize('top_k', [None, 5])
+def test_local_shards_match_single_machine(pipeline, data_dir, monkeypatch, top_k):
+    monkeypatch.setattr(pipeline, 'count_top_k', top_k)
+    # big enough for each shard's sketch to keep the top values of its rows
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 20)
+    name = pipeline.problem_name
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+    tables = [attr + '_int.csv' for attr in attr_list] + [name + '_impression_click_counts.csv']
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    expected_tables = dict([(t, read_text(t)) for t in tables])
+    # compress_with_copies keeps one row per attributes and action, the first column after them
+    key_len = len(attr_list) + 1
+    expected_rows = collections.Counter([tuple(row[:key_len])
+                                         for row in read_rows(pipeline, name + '_int' + pipeline.data_ext)])
+
+    os.mkdir('distributed')
+    os.chdir('distributed')
+    shutil.copy(data_dir / 'fieldselection.csv', '.')
+    shutil.copy(data_dir / (name + '_download.csv'), '.')
+    shard_dirs = run_distributed(backend=LocalBackend(2), num_shards=3)
+    assert len(shard_dirs) == 3
+    for t in tables:
+        assert read_text(t) == expected_tables[t], t
+    if top_k is not None:
+        assert len(expected_tables['site_int.csv'].splitlines()) == top_k + 1
+
+    # every row is in tst or, counted copies times, in trn
+    rows = collections.Counter([tuple(row[:key_len])
+                                for row in read_rows(pipeline, name + '_tst_unsorted' + pipeline.data_ext)])
+    trn = read_rows(pipeline, name + '_trn.csv')
+    assert len(set([tuple(row[:key_len]) for row in trn])) == len(trn)
+    for row in trn:
+        rows[tuple(row[:key_len])] += int(row[-1])
+    assert rows == expected_rows
@@ -0,0 +1,73 @@
+import csv
+import random
+
+import pytest
+
+
+def write_rows(file_name, rows):
+    with open(file_name, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+
+def read_rows(file_name):
+    with open(file_name, newline='') as f:
+        return list(csv.reader(f))
+
+
+def random_rows(n, seed=1):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        code = str(rng.randint(-20, 20)) if rng.random() > 0.05 else ''
+        time = '2014-05-{:02d} {:02d}:{:02d}:00'.format(rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59))
+        rows.append([code, rng.choice(['a', 'b', 'c', 'dd']), time, str(i)])
+    return rows
+
+
+# what external_sort should give: ints before non-ints ascending, latest time first, stable
+def expected_order(pipeline, rows):
+    def key(row):
+        code = (0, int(row[0])) if row[0] else (1, row[0])
+        return (code, -pipeline.convert_to_timestamp(row[2]))
+    return sorted(rows, key=key)
+
+
+@pytest.mark.parametrize('memory_mb, max_merge', [(None, 128), (0.002, 128), (0.002, 3)])
+def test_external_sort_matches_sorted(pipeline, tmp_path, monkeypatch, memory_mb, max_merge):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, 'sort_max_merge', max_merge)
+    rows = random_rows(2000)
+    write_rows('in.csv', [['code', 'name', 'time', 'i']] + rows)
+
+    key_columns = [(0, False), (2, True, 'time')]
+    assert pipeline.external_sort('in.csv', 'out.csv', key_columns, memory_mb=memory_mb, header=True,
+                                  tmp_dir=str(tmp_path)) == len(rows)
+    out = read_rows('out.csv')
+    assert out[0] == ['code', 'name', 'time', 'i']
+    assert out[1:] == expected_order(pipeline, rows)
+    # the spilled runs are removed
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['in.csv', 'out.csv']
+
+
+def test_external_sort_descending_strings(pipeline, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows = random_rows(500, seed=2)
+    write_rows('in.csv', rows)
+    pipeline.external_sort('in.csv', 'out.csv', [(1, True), (3, False)], memory_mb=0.001)
+    assert read_rows('out.csv') == sorted(rows, key=lambda row: (row[1], -int(row[3])), reverse=True)
+
+
+def test_sort_by_time_matches_sorted(pipeline, data_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'sort_max_merge', 2)
+    name = pipeline.problem_name
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.sort_by_time(memory_mb=0.01)
+
+    fields = pipeline.read_field_selections(trace=False)
+    time_index = 1 + len(fields['attrs']) + list(fields['data'].keys()).index('created_at')
+    rows = read_rows(name + '_int.csv')
+    expected = sorted(rows, key=lambda row: -pipeline.convert_to_timestamp(row[time_index]))
+    assert read_rows(name + '_int_sorted.csv') == expected
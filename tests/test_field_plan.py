@@ -0,0 +1,61 @@
+import csv
+import random
+from collections import OrderedDict, namedtuple
+
+
+def make_fields(depvar, attrs, data):
+    return {'depvar_name': depvar, 'depvar_type': 'int',
+            'attrs': OrderedDict([(k, 'str') for k in attrs]),
+            'data': OrderedDict([(k, 'str') for k in data])}
+
+
+# the namedtuple per row projection the plan replaces
+def named_projection(fields, col_names, row):
+    line = namedtuple('Fields', col_names)._make(row)
+    names = [fields['depvar_name']] + list(fields['attrs'].keys()) + list(fields['data'].keys())
+    return tuple([getattr(line, k) for k in names])
+
+
+def test_field_plan_matches_namedtuple(pipeline):
+    rng = random.Random(3)
+    columns = ['c' + str(i) for i in range(12)]
+    for n_data in [0, 1, 3]:
+        for trial in range(20):
+            col_names = rng.sample(columns, len(columns))
+            picked = rng.sample(col_names, 3 + n_data)
+            fields = make_fields(picked[0], picked[1:3], picked[3:])
+            plan = pipeline.compile_field_plan(fields, col_names, filter_name='c0')
+            row = [name + '_' + str(trial) for name in col_names]
+            assert plan.num_cols == len(col_names)
+            assert plan.filter_index == col_names.index('c0')
+            assert plan.project(row) == named_projection(fields, col_names, row)
+            assert plan.project_data(row) == named_projection(fields, col_names, row)[3:]
+            assert [row[plan.depvar_index]] + [row[i] for i in plan.attr_indices] == list(plan.project(row)[:3])
+
+
+def test_field_plan_without_filter_column(pipeline):
+    fields = make_fields('a', ['b'], ['c'])
+    plan = pipeline.compile_field_plan(fields, ['c', 'b', 'a'])
+    assert plan.filter_index is None
+    assert plan.project(['3', '2', '1']) == ('1', '2', '3')
+    assert plan.project_data(['3', '2', '1']) == ('3',)
+
+
+def test_benchmark_field_projection(pipeline, data_dir):
+    pipeline.standardize_file()
+    t_named, t_plan = pipeline.benchmark_field_projection(rows=1000)
+    assert t_named > 0 and t_plan > 0
+
+
+def test_reduce_file_matches_namedtuple(pipeline, data_dir):
+    name = pipeline.problem_name
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    fields = pipeline.read_field_selections(trace=False)
+    with open(name + '_raw.csv') as f:
+        rows = list(csv.reader(f, delimiter=';'))
+    header = rows[0]
+    expected = [named_projection(fields, header, row) for row in rows
+                if namedtuple('Fields', header)._make(row).action_id != 'click']
+    with open(name + '_reduced.csv') as f:
+        assert [tuple(row) for row in csv.reader(f, delimiter=';')] == expected
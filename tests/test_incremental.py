@@ -0,0 +1,86 @@
+import csv
+import os
+import shutil
+
+time_cutoff = '2014-05-22 00:00:00'
+
+
+def read_lines(pipeline, file_name):
+    with pipeline.open_data(file_name, 'r') as f:
+        return f.read().splitlines()
+
+
+# code -> value, and value -> [impressions, clicks], of each table
+def read_tables(attr_list):
+    values = dict()
+    counts = dict()
+    for attr in attr_list:
+        with open(attr + '_int.csv') as f:
+            rows = list(csv.reader(f))
+        values[attr] = dict([(row[0], row[1]) for row in rows])
+        counts[attr] = dict([(row[1], [row[2], row[3]]) for row in rows])
+    return values, counts
+
+
+# the rows of an int coded file with the codes put back to values
+def decode(lines, attr_list, values):
+    rows = []
+    for row in csv.reader(lines):
+        rows.append(tuple([values[attr][v] for attr, v in zip(attr_list, row)] + row[len(attr_list):]))
+    return rows
+
+
+def full_run(pipeline):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.sort_by_time()
+    pipeline.split_into_tst_trn(mode='time', time_cutoff=time_cutoff)
+    pipeline.sort_for_compress('trn')
+    pipeline.compress_with_copies('trn')
+
+
+def outputs(pipeline):
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+    values, counts = read_tables(attr_list)
+    name = pipeline.problem_name
+    ext = pipeline.data_ext
+    with open(name + '_impression_click_counts.csv') as f:
+        totals = f.read()
+    compressed = decode(read_lines(pipeline, name + '_trn.csv'), attr_list, values)
+    return {'counts': counts,
+            'totals': totals,
+            'reduced': read_lines(pipeline, name + '_reduced' + ext),
+            'int': decode(read_lines(pipeline, name + '_int' + ext), attr_list, values),
+            'tst': sorted(decode(read_lines(pipeline, name + '_tst_unsorted' + ext), attr_list, values)),
+            'trn': sorted(decode(read_lines(pipeline, name + '_trn_unsorted' + ext), attr_list, values)),
+            'compressed': sorted(compressed)}
+
+
+def test_incremental_runs_match_full_run(pipeline, data_dir):
+    download = pipeline.problem_name + '_download.csv'
+    with open(download, 'rb') as f:
+        lines = f.readlines()
+
+    os.mkdir('full')
+    os.chdir('full')
+    shutil.copy(data_dir / 'fieldselection.csv', '.')
+    shutil.copy(data_dir / download, '.')
+    full_run(pipeline)
+    expected = outputs(pipeline)
+
+    os.chdir(data_dir)
+    os.mkdir('incremental')
+    os.chdir('incremental')
+    shutil.copy(data_dir / 'fieldselection.csv', '.')
+    for part in [lines[:1200], lines[1200:1201], lines[1201:2500], lines[2500:]]:
+        with open(download, 'ab') as f:
+            f.writelines(part)
+        pipeline.run_incremental(time_cutoff=time_cutoff)
+    got = outputs(pipeline)
+
+    assert got['compressed'] and got['tst']
+    for key in expected:
+        assert got[key] == expected[key], key
@@ -0,0 +1,81 @@
+import csv
+import json
+import os
+
+import pytest
+
+
+def test_stage_reports_rows_and_bytes(pipeline, data_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'stage_reports', [])
+    name = pipeline.problem_name
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    report = pipeline.stage_reports[-1]
+    with open(name + '_raw.csv') as f:
+        lines = f.read().splitlines()
+    with open(name + '_reduced.csv') as f:
+        reduced = f.read().splitlines()
+    assert report['stage'] == 'reduce_file'
+    assert report['rows_in'] == len(lines)
+    assert report['rows_out'] == len(reduced)
+    assert report['bytes_read'] == os.path.getsize(name + '_raw.csv')
+    assert report['bytes_written'] == os.path.getsize(name + '_reduced.csv')
+    assert report['wall_secs'] > 0 and report['cpu_secs'] > 0
+    assert report['peak_rss_mb'] > 0
+    assert report['process_peak_rss_mb'] >= report['peak_rss_mb'] - 1
+    assert [r['stage'] for r in pipeline.stage_reports] == ['standardize_file', 'reduce_file']
+
+    pipeline.write_metrics_report('metrics.json')
+    with open('metrics.json') as f:
+        written = json.load(f)
+    assert [r['rows_in'] for r in written] == [r['rows_in'] for r in pipeline.stage_reports]
+    pipeline.write_metrics_report('metrics.csv')
+    with open('metrics.csv') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['stage'] for r in rows] == ['standardize_file', 'reduce_file']
+    assert rows[1]['rows_out'] == str(len(reduced))
+
+
+def test_nested_stages_report_their_own_rows(pipeline, data_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'stage_reports', [])
+    pipeline.run_pipeline_streaming()
+    stages = [r['stage'] for r in pipeline.stage_reports]
+    # convert_to_ints runs inside run_pipeline_streaming and finishes first
+    assert stages[-2:] == ['convert_to_ints', 'run_pipeline_streaming']
+    inner, outer = pipeline.stage_reports[-2:]
+    assert inner['outputs'] == outer['outputs'] == [pipeline.problem_name + '_int.csv']
+    assert outer['wall_secs'] >= inner['wall_secs']
+
+
+def test_failed_stage_is_reported_and_raises(pipeline, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, 'stage_reports', [])
+
+    @pipeline.stage('broken')
+    def broken():
+        pipeline.record_stage(5, 0)
+        raise RuntimeError("stage failed")
+
+    with pytest.raises(RuntimeError):
+        broken()
+    assert pipeline.stage_reports[-1]['stage'] == 'broken'
+    assert pipeline.stage_reports[-1]['rows_in'] == 5
+    assert pipeline.stage_stack == []
+    # not in a stage, so nothing is recorded
+    pipeline.record_stage(1, 1)
+
+
+@pytest.mark.parametrize('mode, file_name', [('cprofile', 'standardize_file.prof'),
+                                             ('sample', 'standardize_file.samples.txt')])
+def test_profiled_stage_writes_the_same_output(pipeline, data_dir, monkeypatch, mode, file_name):
+    name = pipeline.problem_name
+    pipeline.standardize_file()
+    with open(name + '_raw.csv') as f:
+        expected = f.read()
+    monkeypatch.setattr(pipeline, 'profile_stages', {'standardize_file'})
+    monkeypatch.setattr(pipeline, 'profile_mode', mode)
+    monkeypatch.setattr(pipeline, 'sample_interval', 0.0005)
+    pipeline.standardize_file()
+    assert os.path.exists(file_name)
+    with open(name + '_raw.csv') as f:
+        assert f.read() == expected
@@ -0,0 +1,40 @@
+import pickle
+import sys
+
+import pytest
+
+from pipeline_loader import load_pipeline, module_name
+
+
+def read_tables(attr_list):
+    tables = dict()
+    for attr in attr_list:
+        with open(attr + '_int.csv') as f:
+            tables[attr] = f.read()
+    return tables
+
+
+def test_loader_registers_the_module(pipeline):
+    assert sys.modules[module_name] is pipeline
+    assert load_pipeline() is pipeline
+    assert pickle.loads(pickle.dumps(pipeline.count_chunk)) is pipeline.count_chunk
+
+
+@pytest.mark.parametrize('backend', ['dict', 'compact'])
+def test_parallel_counts_match_serial(pipeline, data_dir, monkeypatch, backend):
+    monkeypatch.setattr(pipeline, 'count_backend', backend)
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+    totals = pipeline.problem_name + '_impression_click_counts.csv'
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    expected = read_tables(attr_list)
+    with open(totals) as f:
+        expected_totals = f.read()
+
+    # the workers get their functions by pickling, which needs the module registered
+    pipeline.create_int_conversion_tables(processes=3)
+    assert read_tables(attr_list) == expected
+    with open(totals) as f:
+        assert f.read() == expected_totals
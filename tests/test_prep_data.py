@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pandas = pytest.importorskip('pandas')
+
+import prep_data
+
+
+def wide_frame(rows, columns, seed=0):
+    rng = np.random.RandomState(seed)
+    index = pandas.bdate_range('2000-01-03', periods=rows, name='date')
+    return pandas.DataFrame(rng.randn(rows, len(columns)), index=index, columns=list(columns))
+
+
+@pytest.mark.parametrize('columns_per_chunk', [1, 3, 64])
+def test_unpivot_chunks_match_unpivot(columns_per_chunk):
+    frame = wide_frame(5, 'ABCDEFG')
+    chunks = list(prep_data.unpivot_chunks(frame, columns_per_chunk))
+    assert len(chunks) == -(-7 // columns_per_chunk)
+    long = pandas.concat(chunks, ignore_index=True)
+    expected = prep_data.unpivot(frame)
+    assert list(long['variable'].astype(str)) == list(expected['variable'])
+    assert (long['date'].to_numpy() == expected['date'].to_numpy()).all()
+    assert np.array_equal(long['value'].to_numpy(), expected['value'].to_numpy())
+
+
+@pytest.mark.parametrize('columns_per_chunk', [1, 3, 64])
+def test_pivot_chunks_matches_pandas_pivot(columns_per_chunk):
+    frame = wide_frame(6, 'ABCDE')
+    expected = prep_data.unpivot(frame).pivot(index='date', columns='variable', values='value')
+
+    pivoted = prep_data.pivot_chunks(prep_data.unpivot_chunks(frame, columns_per_chunk), frame.index, frame.columns)
+    assert np.array_equal(pivoted.to_numpy(), expected.to_numpy())
+    assert list(pivoted.columns) == list(expected.columns)
+    assert (pivoted.index == expected.index).all()
+
+    # labels found from the blocks, and blocks that aren't categorical
+    chunks = [chunk.assign(variable=chunk['variable'].astype(str))
+              for chunk in prep_data.unpivot_chunks(frame, columns_per_chunk)]
+    pivoted = prep_data.pivot_chunks(chunks)
+    assert np.array_equal(pivoted.to_numpy(), expected.to_numpy())
+    assert list(pivoted.columns) == list(expected.columns)
+
+
+def test_pivot_chunks_missing_cells_and_memmap(tmp_path):
+    frame = wide_frame(4, 'ABC')
+    long = prep_data.unpivot(frame).iloc[1:] # one cell missing
+    expected = long.pivot(index='date', columns='variable', values='value')
+    out = np.memmap(str(tmp_path / 'wide.bin'), dtype=np.float64, mode='w+', shape=(4, 3))
+    out[:] = np.nan
+    pivoted = prep_data.pivot_chunks([long], frame.index, frame.columns, out=out)
+    assert np.array_equal(pivoted.to_numpy(), expected.to_numpy(), equal_nan=True)
+    assert np.isnan(out[0, 0])
+
+    with pytest.raises(KeyError):
+        prep_data.pivot_chunks([long], frame.index[1:], frame.columns)
@@ -0,0 +1,113 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+text = 'id;name\n1;café\r\n2;日本語\n3;naïve;x\r4;\n\n5;last'
+
+
+def read_lines(pipeline, file_name, **kwargs):
+    with pipeline.ReadAheadFile(file_name, **kwargs) as f:
+        return [line for lines in f.line_blocks() for line in lines]
+
+
+@pytest.mark.parametrize('block_bytes', [1, 3, 7, 64, 1 << 20])
+@pytest.mark.parametrize('blocks_ahead', [0, 2])
+@pytest.mark.parametrize('ext', ['.csv', '.csv.gz'])
+def test_read_ahead_matches_plain_read(pipeline, tmp_path, block_bytes, blocks_ahead, ext):
+    file_name = str(tmp_path / ('data' + ext))
+    with pipeline.open_data(file_name, 'w', newline='') as f:
+        f.write(text)
+    with pipeline.open_data(file_name, 'r') as f:
+        expected = f.read().splitlines()
+    assert read_lines(pipeline, file_name, block_bytes=block_bytes, blocks_ahead=blocks_ahead) == expected
+
+    with pipeline.ReadAheadFile(file_name, block_bytes=block_bytes, blocks_ahead=blocks_ahead) as f:
+        rows = list(f.rows(';'))
+    assert rows == [line.split(';') if line else [] for line in expected]
+
+
+def test_byte_level_readers_use_the_data_encoding(pipeline, tmp_path):
+    file_name = str(tmp_path / 'data.csv')
+    with open(file_name, 'wb') as f:
+        f.write(text.replace('\r\n', '\n').replace('\r', '\n').encode('utf-8'))
+    with pipeline.open_data(file_name, 'r') as f:
+        expected = f.read().splitlines(True)
+    assert expected[1] == '1;café\n'
+    chunks = pipeline.find_chunk_offsets(file_name, 3, skip_header=False)
+    lines = [line for start, end in chunks for line in pipeline.read_chunk_lines(file_name, start, end)]
+    assert lines == expected
+    assert read_lines(pipeline, file_name, block_bytes=5) == [line.rstrip('\n') for line in expected]
+
+    # written text is the data encoding too
+    with pipeline.open_data(str(tmp_path / 'out.csv'), 'w') as f:
+        f.write('日本語\n')
+    with open(str(tmp_path / 'out.csv'), 'rb') as f:
+        assert f.read() == '日本語\n'.encode('utf-8')
+
+
+# a process whose locale encoding is ASCII still reads the data files as utf-8
+def test_readers_ignore_the_locale(tmp_path):
+    file_name = str(tmp_path / 'data.csv')
+    with open(file_name, 'wb') as f:
+        f.write(text.encode('utf-8'))
+    script = """
+import sys
+from pipeline_loader import load_pipeline
+pipeline = load_pipeline()
+file_name = sys.argv[1]
+with pipeline.open_data(file_name) as f:
+    expected = f.read().splitlines()
+with pipeline.ReadAheadFile(file_name, block_bytes=5) as f:
+    lines = [line for lines in f.line_blocks() for line in lines]
+assert lines == expected, (lines, expected)
+assert expected[1] == '1;caf\\xe9'
+"""
+    env = dict(os.environ, LC_ALL='C', PYTHONUTF8='0', PYTHONCOERCECLOCALE='0', PYTHONIOENCODING='utf-8',
+               PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    subprocess.run([sys.executable, '-c', script, file_name], env=env, check=True)
+
+
+def test_read_ahead_stops_early_and_raises_read_errors(pipeline, tmp_path, monkeypatch):
+    file_name = str(tmp_path / 'data.csv')
+    with open(file_name, 'w') as f:
+        f.write(''.join('{};x\n'.format(i) for i in range(10000)))
+    with pipeline.ReadAheadFile(file_name, block_bytes=16, blocks_ahead=2) as f:
+        first = next(f.rows(';'))
+    assert first == ['0', 'x']
+    assert f.thread is None and f.f is None
+
+    # a read error on the reading thread is raised in the reader
+    class BrokenFile(object):
+        def read(self, n):
+            raise IOError("read failed")
+        def close(self):
+            pass
+    monkeypatch.setattr(pipeline, 'open_data', lambda *args: BrokenFile())
+    for blocks_ahead in [0, 1]:
+        f = pipeline.ReadAheadFile(file_name, block_bytes=16, blocks_ahead=blocks_ahead)
+        with pytest.raises(IOError):
+            list(f.rows(';'))
+        f.close()
+
+
+def test_non_ascii_values_through_the_stages(pipeline, data_dir):
+    name = pipeline.problem_name + '_download.csv'
+    with open(name, encoding='utf-8') as f:
+        download = f.read()
+    with open(name, 'w', encoding='utf-8') as f:
+        f.write(download.replace('site1;', 'sité1;').replace('country2;', '国2;'))
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    with open('site_int.csv', encoding='utf-8') as f:
+        serial = f.read()
+    assert 'sité1' in serial
+    pipeline.create_int_conversion_tables(processes=3)
+    with open('site_int.csv', encoding='utf-8') as f:
+        assert f.read() == serial
+    pipeline.convert_to_ints()
+    pipeline.convert_to_ints(outfile='chunked.csv', engine='chunked')
+    with open(pipeline.problem_name + '_int.csv', 'rb') as f, open('chunked.csv', 'rb') as g:
+        assert f.read() == g.read()
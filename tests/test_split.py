@@ -0,0 +1,79 @@
+import csv
+
+import pytest
+
+
+@pytest.fixture
+def sorted_int(pipeline, data_dir):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    pipeline.sort_by_time()
+    with open(pipeline.problem_name + '_int_sorted.csv') as f:
+        return list(csv.reader(f))
+
+
+def read_split(pipeline):
+    name = pipeline.problem_name
+    with open(name + '_tst_unsorted.csv') as f:
+        tst = list(csv.reader(f))
+    with open(name + '_trn_unsorted.csv') as f:
+        trn = list(csv.reader(f))
+    return tst, trn
+
+
+def column(pipeline, name):
+    fields = pipeline.read_field_selections(trace=False)
+    return ([fields['depvar_name']] + list(fields['attrs'].keys()) + list(fields['data'].keys())).index(name)
+
+
+def test_time_split_is_the_counted_prefix(pipeline, sorted_int):
+    pipeline.split_into_tst_trn(tst_fraction=0.3)
+    with open(pipeline.problem_name + '_impression_click_counts.csv') as f:
+        total = sum(map(int, next(csv.reader(f))))
+    assert total == len(sorted_int)
+    tst_size = int(total * 0.3)
+    assert read_split(pipeline) == (sorted_int[:tst_size], sorted_int[tst_size:])
+
+
+def test_time_cutoff_split(pipeline, sorted_int):
+    cutoff = '2014-05-22 00:00:00'
+    pipeline.split_into_tst_trn(time_cutoff=cutoff)
+    i = column(pipeline, 'created_at')
+    t = pipeline.convert_to_timestamp(cutoff)
+    tst, trn = read_split(pipeline)
+    assert tst == [row for row in sorted_int if pipeline.convert_to_timestamp(row[i]) >= t]
+    assert trn == [row for row in sorted_int if pipeline.convert_to_timestamp(row[i]) < t]
+    assert tst and trn
+
+
+def test_stratified_split(pipeline, sorted_int):
+    pipeline.split_into_tst_trn(mode='stratified', tst_fraction=0.25)
+    action_index, impression_value = pipeline.find_impression_column(pipeline.read_field_selections(trace=False))
+    tst, trn = read_split(pipeline)
+    for click in [False, True]:
+        rows = [row for row in sorted_int if (row[action_index] != impression_value) == click]
+        in_tst = [row for row in tst if (row[action_index] != impression_value) == click]
+        in_trn = [row for row in trn if (row[action_index] != impression_value) == click]
+        assert len(in_tst) == int(len(rows) * 0.25)
+        assert sorted(in_tst + in_trn) == sorted(rows)
+
+
+def test_hash_split_keeps_keys_together(pipeline, sorted_int):
+    pipeline.split_into_tst_trn(mode='hash', key_column='site', tst_fraction=0.5)
+    i = column(pipeline, 'site')
+    tst, trn = read_split(pipeline)
+    assert sorted(tst + trn) == sorted(sorted_int)
+    assert not set(row[i] for row in tst) & set(row[i] for row in trn)
+    assert tst and trn
+
+    pipeline.split_into_tst_trn(mode='hash', key_column='site', tst_fraction=0.5, seed='other')
+    assert read_split(pipeline) != (tst, trn)
+
+
+def test_split_mode_errors(pipeline, sorted_int):
+    with pytest.raises(ValueError):
+        pipeline.split_into_tst_trn(mode='hash')
+    with pytest.raises(ValueError):
+        pipeline.split_into_tst_trn(mode='random')
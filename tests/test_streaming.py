@@ -0,0 +1,57 @@
+import os
+import shutil
+
+import pytest
+
+
+def read_file(file_name):
+    with open(file_name) as f:
+        return f.read()
+
+
+def staged_outputs(pipeline, attr_list):
+    name = pipeline.problem_name
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    files = [name + suffix for suffix in ['_raw.csv', '_reduced.csv', '_int.csv', '_impression_click_counts.csv']]
+    files += [attr + '_int.csv' for attr in attr_list]
+    return dict([(file_name, read_file(file_name)) for file_name in files])
+
+
+def move_to(data_dir, pipeline, dir_name):
+    os.mkdir(dir_name)
+    os.chdir(dir_name)
+    shutil.copy(data_dir / 'fieldselection.csv', '.')
+    shutil.copy(data_dir / (pipeline.problem_name + '_download.csv'), '.')
+
+
+@pytest.mark.parametrize('top_k', [None, 5])
+def test_streaming_matches_staged(pipeline, data_dir, monkeypatch, top_k):
+    monkeypatch.setattr(pipeline, 'count_top_k', top_k)
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 20)
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+    expected = staged_outputs(pipeline, attr_list)
+
+    move_to(data_dir, pipeline, 'streaming')
+    pipeline.run_pipeline_streaming(write_intermediates=True)
+    for file_name in expected:
+        assert read_file(file_name) == expected[file_name], file_name
+
+
+def test_streaming_with_existing_tables(pipeline, data_dir):
+    name = pipeline.problem_name
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+    expected = staged_outputs(pipeline, attr_list)
+
+    # one pass against the staged tables, leaving the reduced file alone
+    os.remove(name + '_int.csv')
+    with open(name + '_reduced.csv', 'w') as f:
+        f.write('old\n')
+    pipeline.run_pipeline_streaming(use_existing_tables=True)
+    assert read_file(name + '_int.csv') == expected[name + '_int.csv']
+    assert read_file(name + '_reduced.csv') == 'old\n'
+    assert read_file(name + '_reduced_header.csv') == expected[name + '_reduced.csv'].splitlines(True)[0]
@@ -0,0 +1,44 @@
+import calendar
+import datetime
+import os
+import time
+
+import pytest
+
+
+def test_winter_time_is_est(pipeline):
+    assert pipeline.convert_to_timestamp('2014-01-15 12:00:00') == calendar.timegm((2014, 1, 15, 17, 0, 0))
+    assert pipeline.convert_to_timestamp('2014-01-15T12:00:00.250') == calendar.timegm((2014, 1, 15, 17, 0, 0))
+
+
+def test_summer_time_is_edt(pipeline):
+    assert pipeline.convert_to_timestamp('2014-07-15 12:00:00') == calendar.timegm((2014, 7, 15, 16, 0, 0))
+
+
+def test_column_matches_single_values(pipeline):
+    values = ['2014-01-15 12:00:00', '2014-03-09 01:59:59', '2014-03-09 03:00:00', '2014-07-15 12:00:00.5',
+              '2014-11-02 00:30:00', '2014-11-02 03:00:00']
+    assert pipeline.convert_to_timestamps(values).tolist() == [pipeline.convert_to_timestamp(v) for v in values]
+
+
+# the old strptime/strftime('%s') conversion, run on a machine in New York
+@pytest.mark.skipif(not hasattr(time, 'tzset'), reason="needs time.tzset")
+def test_matches_old_conversion_all_year(pipeline):
+    old_tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/New_York'
+    time.tzset()
+    try:
+        t = datetime.datetime(2014, 1, 1, 0, 17, 5)
+        while t.year == 2014:
+            s = t.strftime('%Y-%m-%d %H:%M:%S')
+            # skip the hours that don't exist or happen twice around the DST changes
+            if not (t.month in (3, 11) and t.day < 10 and t.hour in (1, 2)):
+                old = int(datetime.datetime.strptime(s + "EDT", "%Y-%m-%d %H:%M:%S%Z").strftime("%s"))
+                assert pipeline.convert_to_timestamp(s) == old, s
+            t += datetime.timedelta(hours=7)
+    finally:
+        if old_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = old_tz
+        time.tzset()
@@ -0,0 +1,85 @@
+import collections
+import csv
+import os
+
+import numpy as np
+
+
+def read_tables(attr_list):
+    tables = dict()
+    for attr in attr_list:
+        with open(attr + '_int.csv') as f:
+            tables[attr] = f.read()
+    return tables
+
+
+def test_streaming_top_k_tables_are_exact(pipeline, data_dir, monkeypatch):
+    monkeypatch.setattr(pipeline, 'count_top_k', 5)
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 2)
+    fields = pipeline.read_field_selections(trace=False)
+    attr_list = [fields['depvar_name']] + list(fields['attrs'].keys())
+
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    expected = read_tables(attr_list)
+    for attr in attr_list:
+        os.remove(attr + '_int.csv')
+
+    pipeline.run_pipeline_streaming()
+    assert read_tables(attr_list) == expected
+    assert pipeline.other_val in expected['site']
+
+
+def test_real_other_value_is_not_the_other_code(pipeline, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cnts = {'site': {'other': [3, 1], 'a': [5, 0]}}
+    pipeline.write_int_conversion_tables(cnts, ['site'], 8, 1, write_totals=False)
+    table = pipeline.load_int_conversion_tables(['site'])['site']
+    assert not isinstance(table, pipeline.OtherTable)
+    assert table['other'] != table['a']
+
+
+# value -> [impressions, clicks] of a conversion table
+def read_counts(attr):
+    with open(attr + '_int.csv') as f:
+        return dict([(row[1], [int(row[2]), int(row[3])]) for row in csv.reader(f)])
+
+
+def test_top_k_tables_are_the_exact_top_k(pipeline, data_dir, monkeypatch):
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    exact = read_counts('site')
+
+    monkeypatch.setattr(pipeline, 'count_top_k', 5)
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 6)
+    pipeline.create_int_conversion_tables()
+    got = read_counts('site')
+    serial = read_tables(['site'])
+    pipeline.create_int_conversion_tables(processes=2)
+    assert read_tables(['site']) == serial
+
+    ranked = sorted(exact.items(), key=lambda item: -sum(item[1]))
+    assert sum(ranked[4][1]) > sum(ranked[5][1]) # no tie at the cut
+    expected = dict(ranked[:5])
+    expected[pipeline.other_val] = [sum(v[0] for k, v in ranked[5:]), sum(v[1] for k, v in ranked[5:])]
+    assert got == expected
+
+
+def test_sketch_candidates_hold_the_exact_top_k(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'count_sketch_factor', 4)
+    top_k = 100
+    rng = np.random.default_rng(1)
+    values = ['v{}'.format(v) for v in rng.zipf(1.4, 100000) % 20000]
+    sketch = pipeline.AttrCounter(top_k)
+    for v in values:
+        sketch.add(v, 0)
+    keep = [v for v, n in sketch.items() if v != pipeline.other_val]
+    recount = pipeline.AttrCounter(top_k, keep=keep)
+    for v in values:
+        recount.add(v, 0)
+    got = dict([(v, n[0]) for v, n in recount.items()])
+    expected = dict(collections.Counter(values).most_common(top_k))
+    expected[pipeline.other_val] = len(values) - sum(expected.values())
+    assert got == expected
@@ -0,0 +1,200 @@
+import json
+import os
+import shutil
+import threading
+
+from benchmark_pipeline import generate_download, generate_fieldselection
+from pipeline_loader import load_pipeline
+from watch_file_s3 import BucketWatcher, Dispatcher, LocalBucket, process_file
+
+
+def put(root, name, data):
+    with open(os.path.join(root, name), 'w') as f:
+        f.write(data)
+
+
+def test_failed_object_is_retried_and_holds_the_marker(tmp_path):
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    for name in ['a', 'b', 'c']:
+        put(root, name, name)
+    state_file = str(tmp_path / 'state.json')
+    handled = []
+
+    def handler(key):
+        if key.name == 'b' and 'b' not in handled:
+            handled.append('b')
+            raise IOError("download failed")
+        handled.append(key.name)
+
+    watcher = BucketWatcher(LocalBucket(root), state_file=state_file)
+    assert watcher.poll(handler) == 2
+    with open(state_file) as f:
+        state = json.load(f)
+    assert state['marker'] == 'a' and list(state['done']) == ['c']
+
+    # a new watcher, as after a restart, only retries b
+    watcher = BucketWatcher(LocalBucket(root), state_file=state_file)
+    assert watcher.poll(handler) == 1
+    assert handled == ['a', 'b', 'c', 'b']
+    assert watcher.state['marker'] == 'c' and watcher.state['done'] == {}
+
+
+def test_deferred_objects_are_done_when_completed(tmp_path):
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    for name in ['a', 'b']:
+        put(root, name, name)
+    state_file = str(tmp_path / 'state.json')
+    queued = []
+
+    watcher = BucketWatcher(LocalBucket(root), state_file=state_file)
+    assert watcher.poll(queued.append, deferred=True) == 2
+    assert watcher.state['marker'] == ''
+    watcher.complete(queued[1])
+    assert watcher.state['marker'] == '' and list(watcher.state['done']) == ['b']
+
+    # a crash now loses nothing: a restarted watcher hands out a again
+    restarted = []
+    assert BucketWatcher(LocalBucket(root), state_file=state_file).poll(restarted.append) == 1
+    assert [key.name for key in restarted] == ['a']
+
+    watcher.complete(queued[0])
+    assert watcher.state['marker'] == 'b'
+
+
+def test_rewritten_object_is_handed_out_again(tmp_path):
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    for name in ['a', 'b']:
+        put(root, name, name)
+    queued = []
+    watcher = BucketWatcher(LocalBucket(root), state_file=None)
+    watcher.poll(queued.append, deferred=True)
+    watcher.complete(queued[1])
+
+    put(root, 'b', 'new contents')
+    queued = []
+    assert watcher.poll(queued.append, deferred=True) == 2
+    assert [key.name for key in queued] == ['a', 'b']
+
+
+def test_object_that_keeps_failing_is_dead_lettered(tmp_path):
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    for name in ['a', 'b', 'c']:
+        put(root, name, name)
+    fieldselection = str(tmp_path / 'fieldselection.csv')
+    put(str(tmp_path), 'fieldselection.csv', '')
+    state_file = str(tmp_path / 'state.json')
+    processed = []
+
+    def process(job_dir):
+        if os.path.basename(job_dir).startswith('b-'):
+            raise IOError("bad file")
+        processed.append(os.path.basename(job_dir)[0])
+        return job_dir
+
+    watcher = BucketWatcher(LocalBucket(root), state_file=state_file)
+    dispatcher = Dispatcher(process, workers=1, pool='thread', max_retries=0, work_dir=str(tmp_path / 'jobs'),
+                            fieldselection=fieldselection, on_done=watcher.complete, on_failed=watcher.fail)
+    try:
+        assert watcher.poll(dispatcher.submit, deferred=True) == 3
+    finally:
+        dispatcher.close()
+    assert processed == ['a', 'c'] and dispatcher.failed == ['b']
+
+    # b no longer holds the marker back and isn't handed out again, even after a restart
+    watcher = BucketWatcher(LocalBucket(root), state_file=state_file)
+    assert watcher.state['marker'] == 'c' and watcher.state['done'] == {}
+    assert list(watcher.state['failed']) == ['b']
+    assert watcher.poll(processed.append) == 0
+
+
+def test_object_handed_out_again_is_not_processed_again(tmp_path):
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    put(root, 'a', 'a')
+    put(str(tmp_path), 'fieldselection.csv', '')
+    processed = []
+    completed = []
+
+    def process(job_dir):
+        processed.append(job_dir)
+        return job_dir
+
+    # as after a crash between processing a and recording it as done
+    for run in range(2):
+        dispatcher = Dispatcher(process, workers=1, pool='thread', work_dir=str(tmp_path / 'jobs'),
+                                fieldselection=str(tmp_path / 'fieldselection.csv'), on_done=completed.append)
+        try:
+            BucketWatcher(LocalBucket(root), state_file=None).poll(dispatcher.submit, deferred=True)
+        finally:
+            dispatcher.close()
+    assert len(processed) == 1
+    assert [key.name for key in completed] == ['a', 'a']
+
+
+def test_pooled_jobs_match_serial_runs(tmp_path):
+    pipeline = load_pipeline()
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    fieldselection = str(tmp_path / 'fieldselection.csv')
+    generate_fieldselection(fieldselection)
+    for i, rows in enumerate([500, 800, 300]):
+        generate_download(os.path.join(root, 'part' + str(i)), rows, seed=i)
+
+    dispatcher = Dispatcher(workers=2, work_dir=str(tmp_path / 'jobs'), fieldselection=fieldselection)
+    try:
+        assert BucketWatcher(LocalBucket(root), state_file=None).poll(dispatcher.submit) == 3
+    finally:
+        dispatcher.close()
+    assert sorted(dispatcher.done) == ['part0', 'part1', 'part2']
+
+    cwd = os.getcwd()
+    try:
+        for i in range(3):
+            serial = str(tmp_path / ('serial' + str(i)))
+            os.mkdir(serial)
+            shutil.copy(fieldselection, serial)
+            shutil.copy(os.path.join(root, 'part' + str(i)), os.path.join(serial, pipeline.problem_name + '_download.csv'))
+            process_file(serial)
+            job_dir = [d for d in os.listdir(str(tmp_path / 'jobs')) if d.startswith('part' + str(i) + '-')][0]
+            for name in ['_int.csv', '_impression_click_counts.csv']:
+                with open(os.path.join(serial, pipeline.problem_name + name)) as f, \
+                     open(os.path.join(str(tmp_path / 'jobs'), job_dir, pipeline.problem_name + name)) as g:
+                    assert f.read() == g.read()
+    finally:
+        os.chdir(cwd)
+
+
+def test_submit_blocks_while_the_queue_is_full(tmp_path):
+    root = str(tmp_path / 'bucket')
+    os.mkdir(root)
+    for name in ['a', 'b', 'c']:
+        put(root, name, name)
+    put(str(tmp_path), 'fieldselection.csv', '')
+    release = threading.Event()
+    keys = dict([(key.name, key) for key in LocalBucket(root).get_all_keys()])
+
+    def process(job_dir):
+        release.wait()
+        return job_dir
+
+    dispatcher = Dispatcher(process, workers=1, pool='thread', queue_size=1, work_dir=str(tmp_path / 'jobs'),
+                            fieldselection=str(tmp_path / 'fieldselection.csv'))
+    try:
+        assert dispatcher.submit(keys['a']) # taken by the worker
+        assert dispatcher.submit(keys['b']) # fills the queue
+        assert not dispatcher.submit(keys['b']) # already queued
+        submitter = threading.Thread(target=dispatcher.submit, args=(keys['c'],))
+        submitter.start()
+        submitter.join(0.5)
+        assert submitter.is_alive()
+        release.set()
+        submitter.join(5)
+        assert not submitter.is_alive()
+    finally:
+        release.set()
+        dispatcher.close()
+    assert sorted(dispatcher.done) == ['a', 'b', 'c']
@@ -1,21 +1,349 @@
-from boto import *
-from boto.s3.connection import S3Connection
+import concurrent.futures
+import hashlib
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
 import time
+
+from pipeline_loader import load_pipeline
+
 aws_access_key="blabla"
 aws_secret_key="blabla"
 bucket_to_watch="my_bucket"
-sleep_in_seconds=5
-
-conn = S3Connection(aws_access_key, aws_secret_key)
-mybucket = conn.get_bucket(bucket_to_watch) 
-# Substitute in your bucket name
-
-# monitoring loop
-while True:
- time.sleep(sleep_in_seconds) 
- file_list=mybucket.list()
- # check number of items in bucket
- if len(file_list) >0:
-  # do something - prep the file in bucket
-  pass
-  
+prefix_to_watch=""
+state_file="watch_state.json"
+min_sleep_in_seconds=5
+max_sleep_in_seconds=300
+page_size=1000
+workers=4
+queue_size=8
+max_retries=2
+retry_sleep_in_seconds=10
+work_dir="watch_jobs"
+done_marker="_done" # written into a job directory once its object has been processed
+
+# connect to the bucket to watch
+def connect_bucket():
+    from boto.s3.connection import S3Connection
+    conn = S3Connection(aws_access_key, aws_secret_key)
+    # Substitute in your bucket name
+    return conn.get_bucket(bucket_to_watch)
+
+
+# Watches a bucket for new objects. Each poll only lists the keys after a
+# marker, a page at a time, so the cost of a poll depends on how many objects
+# arrived, not on the size of the bucket. This relies on new keys sorting
+# after the old ones, as with date stamped names.
+# An object counts as done once complete(key) is called for it: by poll when
+# the handler returns, or, with deferred=True, by whoever finishes it later
+# (e.g. the Dispatcher's on_done). An object that can't be processed is given
+# up on with fail(key), which puts its name and ETag in the state's failed
+# list, a dead letter list to look at by hand, and lets the marker pass it.
+# The state file has the marker, which only moves past keys that are all done
+# or failed, the name and ETag of each done key after it, and the failed list. A key the handler fails on (or that is never completed) is listed
+# again on the next poll, and a crash only repeats the objects that weren't
+# done, so an object can be handed out more than once. The Dispatcher makes
+# that harmless: each object (name and ETag) has its own job directory, which
+# gets a done_marker file when it has been processed, and an object whose job
+# directory has one is not processed again. A done key listed with a
+# different ETag has been rewritten and is handed out again; a key before the
+# marker is not listed again, so rewrites of those go unnoticed.
+# When nothing arrives the wait between polls doubles, up to max_sleep.
+class BucketWatcher(object):
+
+    def __init__(self, bucket, prefix=prefix_to_watch, state_file=state_file,
+                 min_sleep=min_sleep_in_seconds, max_sleep=max_sleep_in_seconds):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.state_file = state_file
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.sleep = min_sleep
+        self.state = {'marker': '', 'done': {}, 'seen': 0, 'failed': {}}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.state.update(json.load(f))
+        self.lock = threading.Lock()
+        self.open_keys = set() # handed out or failed, not done yet
+
+    # list the keys after the marker, in key order
+    def list_new_keys(self):
+        keys = []
+        marker = self.state['marker']
+        while True:
+            page = self.bucket.get_all_keys(prefix=self.prefix, marker=marker, max_keys=page_size)
+            keys.extend(page)
+            if not page.is_truncated or len(page) == 0:
+                break
+            marker = page[-1].name
+        return keys
+
+    # Call handler(key) for each new or rewritten object, in key order. If the
+    # handler raises, the error is printed and the object is tried again on the
+    # next poll. A handler returns False for an object it already has in hand.
+    # Returns the number of objects handed out.
+    def poll(self, handler, deferred=False):
+        keys = self.list_new_keys()
+        with self.lock:
+            # a key done since the listing may be behind the marker by now
+            keys = [key for key in keys if key.name > self.state['marker']
+                    and self.state['done'].get(key.name) != key.etag
+                    and self.state['failed'].get(key.name) != key.etag]
+            self.open_keys.update([key.name for key in keys])
+        cnt = 0
+        for key in keys:
+            try:
+                if handler(key) is False:
+                    continue
+            except Exception as e:
+                print("Failed", key.name, ":", e)
+                continue
+            if not deferred:
+                self.complete(key)
+            cnt += 1
+        return cnt
+
+    # record that an object is done, and move the marker up to the last key
+    # before the first one that isn't. Can be called from any thread.
+    def complete(self, key):
+        with self.lock:
+            self.state['seen'] += 1
+            self.close_key(key)
+
+    # give up on an object: record it in the failed list and let the marker
+    # pass it like a done one. Can be called from any thread.
+    def fail(self, key):
+        with self.lock:
+            self.state['failed'][key.name] = key.etag
+            self.close_key(key)
+
+    # with the lock held
+    def close_key(self, key):
+        self.open_keys.discard(key.name)
+        done = self.state['done']
+        done[key.name] = key.etag
+        first_open = min(self.open_keys) if self.open_keys else None
+        for name in sorted(done):
+            if first_open is not None and name > first_open:
+                break
+            self.state['marker'] = name
+            del done[name]
+        self.save_state()
+
+    def save_state(self):
+        if self.state_file is None:
+            return
+        tmp_name = self.state_file + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_name, self.state_file)
+
+    # Monitoring loop. Stops after max_polls polls if it is given. A poll that
+    # fails (e.g. listing the bucket) is printed and counts as finding nothing.
+    def watch(self, handler, max_polls=None, deferred=False):
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            try:
+                cnt = self.poll(handler, deferred)
+            except Exception as e:
+                print("Poll failed:", e)
+                cnt = 0
+            if cnt > 0:
+                print("Found", cnt, "new objects, marker:", self.state['marker'])
+                self.sleep = self.min_sleep
+            else:
+                self.sleep = min(self.sleep * 2, self.max_sleep)
+            if max_polls is None or polls < max_polls:
+                time.sleep(self.sleep)
+
+
+# Stand-in for a boto bucket backed by a local directory, for testing the
+# watcher without S3. Keys are the file paths under root, with '/' separators.
+# Write files elsewhere and move them in, so a partly written file is never listed.
+class LocalBucket(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_all_keys(self, prefix='', marker='', max_keys=1000):
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for fname in filenames:
+                name = os.path.relpath(os.path.join(dirpath, fname), self.root).replace(os.sep, '/')
+                if name.startswith(prefix) and name > marker:
+                    names.append(name)
+        names.sort()
+        page = LocalResultSet([LocalKey(self, name) for name in names[:max_keys]])
+        page.is_truncated = len(names) > max_keys
+        return page
+
+
+class LocalResultSet(list):
+    is_truncated = False
+
+
+class LocalKey(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, *name.split('/'))
+        self.size = os.path.getsize(self.path)
+        self.last_modified = os.path.getmtime(self.path)
+        h = hashlib.md5()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.etag = '"' + h.hexdigest() + '"'
+
+    def get_contents_to_filename(self, file_name):
+        with open(self.path, 'rb') as src, open(file_name, 'wb') as dst:
+            for block in iter(lambda: src.read(1 << 20), b''):
+                dst.write(block)
+
+
+# Run the parsing pipeline, standardize_file through convert_to_ints, in a job
+# directory holding the downloaded file and fieldselection.csv. The stages use
+# fixed file names in the current directory, so this changes directory and
+# has to run in its own process.
+def process_file(job_dir):
+    pipeline = load_pipeline()
+    os.chdir(job_dir)
+    pipeline.standardize_file()
+    pipeline.reduce_file()
+    pipeline.create_int_conversion_tables()
+    pipeline.convert_to_ints()
+    return job_dir
+
+# run process_file in a child process, for use from a thread pool
+def process_file_subprocess(job_dir):
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--process', job_dir], check=True)
+    return job_dir
+
+
+# Feeds new objects from the watcher to a pool of workers. submit() puts an
+# object on a bounded queue and blocks while the queue is full, which holds up
+# the watcher until the workers catch up. Feeder threads take objects off the
+# queue, download each one into its own job directory under work_dir and run
+# process_func on it in the pool, retrying up to max_retries times.
+# An object (name and ETag) that is queued or being processed is not queued
+# again, and one whose job directory has a done_marker is not processed again.
+# on_done(key) is called when an object has been processed, e.g. the watcher's
+# complete, so it is only marked done then, and on_failed(key) when it has
+# failed max_retries + 1 times, e.g. the watcher's fail, so that it stops
+# holding the marker back and isn't handed out again.
+# With pool='thread' the pipeline runs in a child process per job.
+class Dispatcher(object):
+
+    def __init__(self, process_func=None, workers=workers, pool='process', queue_size=queue_size,
+                 max_retries=max_retries, work_dir=work_dir, fieldselection='fieldselection.csv', on_done=None,
+                 on_failed=None):
+        if pool == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+            self.process_func = process_func or process_file
+        elif pool == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+            self.process_func = process_func or process_file_subprocess
+        else:
+            raise ValueError("Unknown pool: " + str(pool))
+        self.max_retries = max_retries
+        self.work_dir = work_dir
+        self.fieldselection = fieldselection
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.problem_name = load_pipeline().problem_name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.done = []
+        self.failed = []
+        self.feeders = [threading.Thread(target=self.run, daemon=True) for i in range(workers)]
+        for t in self.feeders:
+            t.start()
+
+    # queue a new object, returns False if it is already queued or in progress
+    def submit(self, key):
+        ident = (key.name, key.etag)
+        with self.lock:
+            if ident in self.in_flight:
+                return False
+            self.in_flight.add(ident)
+        self.queue.put(key)
+        return True
+
+    def run(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                break
+            try:
+                self.handle(key)
+            finally:
+                with self.lock:
+                    self.in_flight.discard((key.name, key.etag))
+
+    def handle(self, key):
+        job_dir = self.job_dir(key)
+        if os.path.exists(os.path.join(job_dir, done_marker)):
+            print("Already processed", key.name, "in", job_dir)
+            if self.on_done is not None:
+                self.on_done(key)
+            return
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.make_job_dir(key, job_dir)
+                self.executor.submit(self.process_func, job_dir).result()
+                open(os.path.join(job_dir, done_marker), 'w').close()
+                print("Processed", key.name, "in", job_dir)
+                self.done.append(key.name)
+                if self.on_done is not None:
+                    self.on_done(key)
+                return
+            except Exception as e:
+                print("Failed", key.name, "attempt", attempt + 1, ":", e)
+                if attempt < self.max_retries:
+                    time.sleep(retry_sleep_in_seconds * 2 ** attempt)
+        self.failed.append(key.name)
+        if self.on_failed is not None:
+            self.on_failed(key)
+
+    # the job directory of an object, named after its key and ETag
+    def job_dir(self, key):
+        name = key.name.replace('/', '_') + '-' + str(key.etag).strip('"')
+        return os.path.abspath(os.path.join(self.work_dir, name))
+
+    # download an object into a fresh job directory with a copy of fieldselection.csv
+    def make_job_dir(self, key, job_dir):
+        if os.path.exists(job_dir):
+            shutil.rmtree(job_dir)
+        os.makedirs(job_dir)
+        shutil.copy(self.fieldselection, job_dir)
+        key.get_contents_to_filename(os.path.join(job_dir, self.problem_name + '_download.csv'))
+        return job_dir
+
+    # wait for the queued objects to finish and stop the workers
+    def close(self):
+        for t in self.feeders:
+            self.queue.put(None)
+        for t in self.feeders:
+            t.join()
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--process']:
+        process_file(sys.argv[2])
+        sys.exit()
+    mybucket = connect_bucket()
+    watcher = BucketWatcher(mybucket)
+    dispatcher = Dispatcher(on_done=watcher.complete, on_failed=watcher.fail)
+    try:
+        # prep the files in bucket
+        watcher.watch(dispatcher.submit, deferred=True)
+    finally:
+        dispatcher.close()